@@ -0,0 +1,88 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Benchmark of encoding (and compressing) large API responses: a
+# rotation with all its projects embedded and a page of embedded users.
+# Run with:
+#
+#     python -m benchmarks.json_encoding
+
+import json
+import timeit
+from datetime import date
+from typing import Any, Callable, Dict
+
+from cogs.db.models import Project, ProjectGroup, User
+from cogs.routes._middleware import _COMPRESSORS
+from cogs.routes.api._format import JSON_ENCODERS
+from cogs.routes.api.projects import serialise_project_to_json
+from cogs.routes.api.users import _serialise_user
+
+
+def _rotation(projects: int) -> Dict[str, Any]:
+    group = ProjectGroup(id=1, series=2019, part=1, student_uploadable=True)
+    items = []
+    for n in range(projects):
+        project = Project(
+            id=n, title=f"Project {n}", small_info="Dr A. N. Other, Dr S. O. Meone",
+            abstract="<p>An abstract of a few hundred characters.</p>" * 6,
+            is_computational=bool(n % 2), is_wetlab=not n % 2, programmes="Genomics|Bioinformatics",
+            uploaded=False, grace_passed=False, group=group, group_id=1,
+            supervisor=User(id=n, name=f"Supervisor {n}"), supervisor_id=n,
+            student=User(id=1000 + n, name=f"Student {n}"), student_id=1000 + n,
+            version=1)
+        item = serialise_project_to_json(project, include_mark_ids=True)
+        item["people"] = {"supervisor": {"id": n, "name": f"Supervisor {n}"},
+                          "cogs_marker": None,
+                          "student": {"id": 1000 + n, "name": f"Student {n}"}}
+        items.append(item)
+    return {"links": {"parent": "/api/series/2019/1"}, "items": items, "status_message": "success"}
+
+
+def _users(users: int) -> Dict[str, Any]:
+    group = ProjectGroup(id=1, student_uploadable=True)
+    items = []
+    for n in range(users):
+        user = User(id=n, name=f"User {n}", user_type="supervisor|cogs_member",
+                    email=f"user{n}@sanger.ac.uk", priority=50, version=1)
+        projects = [Project(id=10 * n + p, group=group, group_id=1) for p in range(3)]
+        items.append(_serialise_user(user, projects, projects[:1], []))
+    return {"links": {"parent": "/api/users"}, "items": items, "status_message": "success"}
+
+
+def main(number: int = 20) -> None:
+    encoders: Dict[str, Callable[[Any], bytes]] = {
+        "json (indent=4)": lambda obj: json.dumps(obj, indent=4).encode(),
+        **{f"{name} (compact)": encoder for name, encoder in JSON_ENCODERS.items()}}
+
+    for name, payload in (("rotation, 300 projects", _rotation(300)),
+                          ("users, 1000 users", _users(1000))):
+        print(name)
+        for encoder_name, encoder in encoders.items():
+            body = encoder(payload)
+            encode = min(timeit.repeat(lambda: encoder(payload), number=number, repeat=5)) / number
+            gzipped = _COMPRESSORS["gzip"](body)
+            compress = min(timeit.repeat(lambda: _COMPRESSORS["gzip"](body), number=number, repeat=5)) / number
+            print(f"  {encoder_name:<18} {len(body):>9,} bytes  {encode * 1e3:6.2f} ms"
+                  f"   gzip: {len(gzipped):>7,} bytes  {compress * 1e3:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
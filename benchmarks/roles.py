@@ -0,0 +1,70 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Microbenchmark of the permission checks made on every authenticated
+# request. Run with:
+#
+#     python -m benchmarks.roles
+
+import timeit
+from typing import Callable, Dict
+
+from cogs.db.models import ProjectGroup, User
+from cogs.security.middleware import permit, permit_any
+
+
+async def _noop(request):
+    pass
+
+
+def _drive(coroutine) -> None:
+    """Run a coroutine that never suspends, without an event loop."""
+    try:
+        coroutine.send(None)
+    except StopIteration:
+        pass
+
+
+def main(number: int = 100000, repeat: int = 5) -> None:
+    user = User(user_type="supervisor|cogs_member")
+    group = ProjectGroup(student_viewable=False)
+    request = {"user": user}
+
+    permit_all = permit("create_projects", "view_projects_predeadline")(_noop)
+    permit_either = permit_any("modify_permissions", "review_other_projects")(_noop)
+
+    cases: Dict[str, Callable[[], object]] = {
+        "user.role":                 lambda: user.role,
+        "bool(user.role)":           lambda: bool(user.role),
+        "user.role.<permission>":    lambda: user.role.create_projects,
+        "user.can_view_group":       lambda: user.can_view_group(group),
+        "permit (2 permissions)":    lambda: _drive(permit_all(request)),
+        "permit_any (2 permissions)": lambda: _drive(permit_either(request)),
+        "user.role.serialise":       lambda: user.role.serialise(),
+    }
+
+    width = max(map(len, cases))
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=number, repeat=repeat))
+        print(f"{name:<{width}}  {best / number * 1e9:8.0f} ns/call")
+
+
+if __name__ == "__main__":
+    main()
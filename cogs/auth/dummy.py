@@ -18,18 +18,19 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
-from cogs.db.interface import Database
+from cogs.db.asynchronous import AsyncDatabase
 from cogs.db.models import User
 from .abc import BaseAuthenticator
+from .exceptions import UnknownUserError
 
 
 class DummyAuthenticator(BaseAuthenticator):
     """Dummy authenticator for debugging."""
 
-    _db: Database
+    _db: AsyncDatabase
     authenticator_template = "dummy_login.jinja2"
 
-    def __init__(self, database: Database) -> None:
+    def __init__(self, database: AsyncDatabase) -> None:
         """
         Constructor: Inject the database dependency
         """
@@ -37,4 +38,7 @@ class DummyAuthenticator(BaseAuthenticator):
 
     async def get_user_from_request(self, _source) -> User:
         # Always return the root user if there's no authentication
-        return self._db.get_user_by_id(1)
+        user = await self._db.get_user_by_id(1)
+        if user is None:
+            raise UnknownUserError("Root user not found in database")
+        return user
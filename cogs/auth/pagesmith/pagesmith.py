@@ -32,7 +32,7 @@ import MySQLdb
 from cogs.auth.abc import BaseAuthenticator
 from cogs.auth.exceptions import UnknownUserError
 from cogs.common import logging
-from cogs.db.interface import Database
+from cogs.db.asynchronous import AsyncDatabase
 from cogs.db.models import User
 from .crypto import BlowfishCBCDecrypt
 from .exceptions import InvalidPagesmithUser, NoPagesmithUser, PagesmithSessionTimeoutError
@@ -49,22 +49,27 @@ def _b64decode(data: bytes) -> bytes:
 
 
 class _AuthenticatedUser(NamedTuple):
-    """Authenticated user cache record"""
-    user: User
+    """Authenticated user cache record
+
+    NOTE We cache the user's ID, rather than the user model itself,
+    because models belong to the database session of the request that
+    loaded them
+    """
+    user_id: int
     expiry: datetime
 
 
 class PagesmithAuthenticator(BaseAuthenticator, logging.LogWriter):
     """Pagesmith authentication"""
 
-    _cogs_db: Database
+    _cogs_db: AsyncDatabase
     _pagesmith_db: MySQLdb.Connection
     _cache: Dict[str, _AuthenticatedUser]
     _crypto: BlowfishCBCDecrypt
 
     max_attempts = 3
 
-    def __init__(self, database: Database, config: Dict) -> None:
+    def __init__(self, database: AsyncDatabase, config: Dict) -> None:
         """
         Constructor: Set up necessary state for authentication,
         including a cache of already-authenticated users
@@ -138,11 +143,13 @@ class PagesmithAuthenticator(BaseAuthenticator, logging.LogWriter):
 
         # Get from cache, if available
         if pagesmith_user in self._cache:
-            user, expiry = self._cache[pagesmith_user]
+            user_id, expiry = self._cache[pagesmith_user]
             if expiry > datetime.utcnow():
-                return user
+                cached_user = await self._cogs_db.get_user_by_id(user_id)
+                if cached_user is not None:
+                    return cached_user
 
-            # Invalidate expired logins
+            # Invalidate expired logins (and those of deleted users)
             del self._cache[pagesmith_user]
 
         try:
@@ -160,11 +167,11 @@ class PagesmithAuthenticator(BaseAuthenticator, logging.LogWriter):
             raise PagesmithSessionTimeoutError("Session expired")
 
         email = await self.get_email_by_uuid(uuid)
-        maybe_user = self._cogs_db.get_user_by_email(email)
+        maybe_user = await self._cogs_db.get_user_by_email(email)
         if not maybe_user:
             raise UnknownUserError("User not found in CoGS database")
         user = maybe_user
 
-        self._cache[pagesmith_user] = _AuthenticatedUser(user, expiry)
+        self._cache[pagesmith_user] = _AuthenticatedUser(user.id, expiry)
 
         return user
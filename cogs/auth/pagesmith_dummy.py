@@ -18,9 +18,10 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
-from cogs.db.interface import Database
+from cogs.db.asynchronous import AsyncDatabase
 from cogs.db.models import User
 from .abc import BaseAuthenticator
+from .exceptions import UnknownUserError
 from aiohttp.web import Request
 
 
@@ -28,9 +29,9 @@ class PagesmithDummyAuthenticator(BaseAuthenticator):
     """Dummy Pagesmith-like authenticator for debugging."""
 
     authenticator_template = "dummy_pagesmith_login.jinja2"
-    _cogs_db: Database
+    _cogs_db: AsyncDatabase
 
-    def __init__(self, database: Database) -> None:
+    def __init__(self, database: AsyncDatabase) -> None:
         """
         Constructor: Inject the database dependency
         """
@@ -46,7 +47,9 @@ class PagesmithDummyAuthenticator(BaseAuthenticator):
         """
         user = None
         if "email_address" in request.cookies:
-            user = self._cogs_db.get_user_by_email(request.cookies["email_address"])
+            user = await self._cogs_db.get_user_by_email(request.cookies["email_address"])
         if user is None:
-            user = self._cogs_db.get_user_by_id(1)
+            user = await self._cogs_db.get_user_by_id(1)
+        if user is None:
+            raise UnknownUserError("Root user not found in database")
         return user
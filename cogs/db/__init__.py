@@ -0,0 +1,2 @@
+# This is purely for nicer imports in main
+from ._middleware import session_scope as middleware
@@ -0,0 +1,46 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from aiohttp.web import Request, StreamResponse, middleware
+
+from cogs.common.types import Handler
+
+
+@middleware
+async def session_scope(request: Request, handler: Handler) -> StreamResponse:
+    """
+    Database session middleware: Give each request its own session,
+    which is removed (and so rolled back, if it hasn't been committed)
+    once the response has been produced
+
+    NOTE The database interface is threaded through the application
+    under the "db" key. This middleware must come before anything else
+    that touches the database (e.g., authentication), so that their
+    queries happen in the request's session.
+    """
+    session = request.app["db"].session
+
+    # Instantiate the session now, so it is bound to this request's
+    # context, rather than to whichever context happens to use it first
+    session()
+    try:
+        return await handler(request)
+    finally:
+        session.remove()
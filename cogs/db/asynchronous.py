@@ -0,0 +1,190 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from typing import Any, Callable, Collection, Dict, List, Optional, TypeVar
+
+from sqlalchemy.orm import scoped_session
+
+from cogs.common import logging
+from .interface import Database
+from .models import Base, EmailTemplate, Project, ProjectGroup, User
+
+
+T = TypeVar("T")
+
+
+class AsyncDatabase(logging.LogWriter):
+    """Asynchronous database interface.
+
+    This wraps the (synchronous) database interface, running its queries
+    on a bounded thread pool so that they don't block the event loop:
+
+    >>> project = await db.get_project_by_id(123)
+
+    Queries are run in a copy of the caller's context, so they use the
+    caller's database session (see cogs.db.session); that session must
+    therefore already exist, which is taken care of for requests by the
+    database session middleware. A session is never used by more than
+    one thread at a time, as long as the caller awaits each query before
+    issuing the next one.
+
+    NOTE Lazy-loaded relationships on the returned models are still
+    loaded synchronously, when they are first accessed; the query
+    methods eagerly load those that are routinely serialised.
+    """
+
+    _database: Database
+    _executor: ThreadPoolExecutor
+
+    def __init__(self, database: Database, max_workers: int = 10) -> None:
+        self._database = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="database")
+        atexit.register(self._executor.shutdown)
+
+    @property
+    def database(self) -> Database:
+        """The underlying synchronous database interface."""
+        return self._database
+
+    @property
+    def session(self) -> scoped_session:
+        return self._database.session
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run a blocking function on the thread pool.
+
+        The function is run in a copy of the current context, so it can
+        be anything that uses the current database session (not just a
+        method of the database interface).
+        """
+        context = copy_context()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(context.run, fn, *args, **kwargs))
+
+    ## Convenience methods #############################################
+
+    def add(self, model: Base) -> None:
+        # This doesn't touch the database until the session is flushed
+        self._database.add(model)
+
+    async def commit(self) -> None:
+        await self.run(self._database.commit)
+
+    async def flush(self) -> None:
+        await self.run(self._database.session.flush)
+
+    async def rollback(self) -> None:
+        await self.run(self._database.session.rollback)
+
+    async def delete(self, model: Base) -> None:
+        await self.run(self._database.session.delete, model)
+
+    ## E-Mail Template Methods #########################################
+
+    async def get_template_by_name(self, name: str) -> Optional[EmailTemplate]:
+        return await self.run(self._database.get_template_by_name, name)
+
+    async def get_all_templates(self) -> List[EmailTemplate]:
+        return await self.run(self._database.get_all_templates)
+
+    ## Outbox Methods ##################################################
+
+    async def get_outbox_depth(self) -> Dict[str, Any]:
+        return await self.run(self._database.get_outbox_depth)
+
+    ## Project Methods #################################################
+
+    async def get_project_by_id(self, project_id: int) -> Optional[Project]:
+        return await self.run(self._database.get_project_by_id, project_id)
+
+    async def get_projects_by_student(self, student: User, group: Optional[ProjectGroup] = None) -> Any:
+        # The return type depends on whether a group was given; see
+        # the overloads of Database.get_projects_by_student
+        return await self.run(self._database.get_projects_by_student, student, group)
+
+    async def get_projects_by_supervisor(self, supervisor: User, group: Optional[ProjectGroup] = None) -> List[Project]:
+        return await self.run(self._database.get_projects_by_supervisor, supervisor, group)
+
+    async def get_projects_by_cogs_marker(self, cogs_marker: User, group: Optional[ProjectGroup] = None) -> List[Project]:
+        return await self.run(self._database.get_projects_by_cogs_marker, cogs_marker, group)
+
+    async def get_projects_by_users(self, users: Collection[User]) -> List[Project]:
+        return await self.run(self._database.get_projects_by_users, users)
+
+    async def get_projects_by_group(self, group: ProjectGroup) -> List[Project]:
+        return await self.run(self._database.get_projects_by_group, group)
+
+    async def get_projects_by_series(self, series: int) -> List[Project]:
+        return await self.run(self._database.get_projects_by_series, series)
+
+    ## Project Group Methods ###########################################
+
+    async def get_project_group(self, series: int, part: int) -> Optional[ProjectGroup]:
+        return await self.run(self._database.get_project_group, series, part)
+
+    async def get_rotation_by_id(self, id: int) -> Optional[ProjectGroup]:
+        return await self.run(self._database.get_rotation_by_id, id)
+
+    async def get_project_groups_by_series(self, series: int) -> List[ProjectGroup]:
+        return await self.run(self._database.get_project_groups_by_series, series)
+
+    async def get_most_recent_group(self) -> Optional[ProjectGroup]:
+        return await self.run(self._database.get_most_recent_group)
+
+    ## Series Methods ##################################################
+
+    async def get_students_in_series(self, series: int) -> List[User]:
+        return await self.run(self._database.get_students_in_series, series)
+
+    async def get_series_version(self, series: int) -> str:
+        return await self.run(self._database.get_series_version, series)
+
+    async def get_all_years(self) -> List[int]:
+        return await self.run(self._database.get_all_years)
+
+    async def get_all_series(self) -> List[ProjectGroup]:
+        return await self.run(self._database.get_all_series)
+
+    ## User Methods ####################################################
+
+    async def get_user_by_id(self, uid: int) -> Optional[User]:
+        return await self.run(self._database.get_user_by_id, uid)
+
+    async def get_user_by_email(self, email: str) -> Optional[User]:
+        return await self.run(self._database.get_user_by_email, email)
+
+    async def get_users_by_permission(self, *permissions: str) -> List[User]:
+        return await self.run(self._database.get_users_by_permission, *permissions)
+
+    async def get_users(self, *,
+                        ids: Optional[Collection[int]] = None,
+                        permissions: Optional[Collection[str]] = None,
+                        offset: int = 0,
+                        limit: Optional[int] = None) -> List[User]:
+        return await self.run(self._database.get_users, ids=ids, permissions=permissions, offset=offset, limit=limit)
+
+    async def get_all_users(self) -> List[User]:
+        return await self.run(self._database.get_all_users)
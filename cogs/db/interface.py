@@ -20,41 +20,102 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import atexit
+import hashlib
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional, overload
+from typing import Any, Collection, Dict, Iterator, List, Optional, Set, Tuple, Type, overload
 from typing_extensions import Literal
 
-from sqlalchemy import create_engine, desc
+from sqlalchemy import create_engine, desc, func, inspect
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm import Query, Session, aliased, joinedload, scoped_session, sessionmaker
+from sqlalchemy.orm.interfaces import MapperOption
 from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.schema import CreateColumn
 
 
 from cogs.common import logging
 from cogs.common.constants import PERMISSIONS
-from .models import Base, EmailTemplate, Project, ProjectGroup, User
+from cogs.security import roles
+from .models import Base, EmailTemplate, OutboxMessage, Project, ProjectGroup, User, UserRole
+from .session import context_scoped_session
+
+
+# Connection pool settings, used where the configuration doesn't
+# override them (see the "pool" section of the database configuration)
+_POOL_DEFAULTS = {
+    "size":         10,     # Connections kept open in the pool
+    "max_overflow": 20,     # Additional connections allowed under load
+    "pre_ping":     True,   # Test connections for liveness on checkout
+    "recycle":      1800}   # Replace connections older than this (seconds)
+
+
+# Named loader profiles: the relationships that are eagerly loaded with
+# a model, so that fetching it and whatever its serialisation walks
+# takes a fixed number of queries, rather than one per lazy load
+_PROFILES: Dict[str, Tuple[MapperOption, ...]] = {
+    "project_with_group":  (joinedload(Project.group),),
+    "project_with_people": (joinedload(Project.group),
+                            joinedload(Project.supervisor),
+                            joinedload(Project.cogs_marker),
+                            joinedload(Project.student)),
+    "project_with_marks":  (joinedload(Project.group),
+                            joinedload(Project.supervisor),
+                            joinedload(Project.cogs_marker),
+                            joinedload(Project.student),
+                            joinedload(Project.supervisor_feedback),
+                            joinedload(Project.cogs_feedback))}
 
 
 class Database(logging.LogWriter):
     """Database interface."""
 
     _engine: Engine
-    _session: Session
+    _session: scoped_session
 
     def __init__(self, config: Dict) -> None:
         """Constructor: Connect to and initialise the database session."""
         # Connect to database and instantiate models
-        self.log(logging.DEBUG, "Connecting to PostgreSQL database \"{name}\" at {host}:{port}".format(**config))
-        self._engine = create_engine("postgresql://{user}:{passwd}@{host}:{port}/{name}".format(**config))
+        self._engine = self._connect(config)
         Base.metadata.create_all(self._engine)
+        self._add_missing_columns()
+        atexit.register(self._engine.dispose)
+
+        # Sessions are scoped to the current asynchronous context (e.g.,
+        # a request or a scheduled job), rather than shared across the
+        # whole application; see cogs.db.session
+        self._session = context_scoped_session(sessionmaker(bind=self._engine))
 
-        # Start session (and register close on exit)
-        # TODO: don't share a single session across the whole app! (#19)
-        Session = sessionmaker(bind=self._engine)
-        self._session = Session()
-        atexit.register(self._session.close)
+        with self.session_scope():
+            self._create_minimal()
+
+    def _connect(self, config: Dict) -> Engine:
+        """Create the engine for the configured database."""
+        self.log(logging.DEBUG, "Connecting to PostgreSQL database \"{name}\" at {host}:{port}".format(**config))
+        pool = {**_POOL_DEFAULTS, **(config.get("pool") or {})}
+        return create_engine("postgresql://{user}:{passwd}@{host}:{port}/{name}".format(**config),
+                             pool_size=int(pool["size"]),
+                             max_overflow=int(pool["max_overflow"]),
+                             pool_pre_ping=bool(pool["pre_ping"]),
+                             pool_recycle=int(pool["recycle"]))
+
+    def _add_missing_columns(self) -> None:
+        """Add any columns that are missing from existing tables.
+
+        create_all only creates missing tables, so columns which have
+        been added to existing models since the database was created are
+        added here. (They must therefore be nullable or have defaults.)
+        """
+        inspector = inspect(self._engine)
+        preparer = self._engine.dialect.identifier_preparer
 
-        self._create_minimal()
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    self.log(logging.INFO, f"Adding column {column.name} to {table.name}.")
+                    definition = CreateColumn(column).compile(dialect=self._engine.dialect)
+                    self._engine.execute(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {definition}")
 
     def _create_minimal(self) -> None:
         """Create minimal data in the database for a working system."""
@@ -82,6 +143,15 @@ class Database(logging.LogWriter):
             self._session.add(User(name="Christopher Harrison", email="ch12@sanger.ac.uk", **_admin_args))
             self._session.add(User(name="Josh Holland"        , email="jh36@sanger.ac.uk", **_admin_args))
 
+        # Users from before roles were normalised won't have any yet
+        unnormalised = self._session.query(User) \
+                                    .filter((User.user_type != "") & ~User.user_roles.any()) \
+                                    .all()
+        if unnormalised:
+            self.log(logging.INFO, f"Normalising the roles of {len(unnormalised)} users.")
+            for user in unnormalised:
+                user.normalise_roles(user.user_type)
+
         if not self._session.query(ProjectGroup).all():
             # NB: this rotation has its state attributes set to provoke
             # special handling in the frontend -- it's important that
@@ -104,6 +174,7 @@ class Database(logging.LogWriter):
 
     def reset_all(self) -> None:
         """Reset everything in the database. For debugging use only!"""
+        self._session.remove()
         for table in Base.metadata.tables.values():
             try:
                 self.engine.execute(f"DROP TABLE {table} CASCADE;")
@@ -113,7 +184,33 @@ class Database(logging.LogWriter):
                 except ProgrammingError:
                     pass
         Base.metadata.create_all(self._engine)
-        self._create_minimal()
+        with self.session_scope():
+            self._create_minimal()
+
+    @contextmanager
+    def session_scope(self) -> Iterator[Session]:
+        """Provide a dedicated session for work outside of a request.
+
+        Any session inherited from the enclosing context (e.g., that of
+        the request which scheduled a job) is left untouched. The new
+        session is committed if the block completes, rolled back if it
+        raises, and removed from the context either way:
+
+        >>> with db.session_scope():
+        ...     do_database_things(db)
+        """
+        # Forget, but don't close, whichever session we may have
+        # inherited; it still belongs to whoever created it
+        self._session.registry.clear()
+        session = self._session()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            self._session.remove()
 
     ## Convenience methods and properties ##############################
 
@@ -122,9 +219,19 @@ class Database(logging.LogWriter):
         return self._engine
 
     @property
-    def session(self) -> Session:
+    def session(self) -> scoped_session:
+        """The session for the current context.
+
+        This can be used directly as if it were a Session, or called to
+        obtain the underlying Session object.
+        """
         return self._session
 
+    def _query(self, model: Type[Base], profile: Optional[str] = None) -> Query:
+        """Start a query for the model, using the named loader profile."""
+        q = self._session.query(model)
+        return q.options(*_PROFILES[profile]) if profile else q
+
     def add(self, model: Base) -> None:
         self._session.add(model)
 
@@ -145,11 +252,69 @@ class Database(logging.LogWriter):
                             .order_by(EmailTemplate.name) \
                             .all()
 
+    ## Outbox Methods ##################################################
+
+    def get_outbox_keys(self, idempotency_keys: Collection[str]) -> Set[str]:
+        """Get which of the given idempotency keys are in the outbox."""
+        if not idempotency_keys:
+            return set()
+        q = self._session.query(OutboxMessage.idempotency_key)
+        return {key for key, in q.filter(OutboxMessage.idempotency_key.in_(idempotency_keys))}
+
+    def get_due_outbox_messages(self, limit: int) -> List[OutboxMessage]:
+        """
+        Get (and lock, until the end of the transaction) the outbox
+        messages that are due to be sent, oldest first, including those
+        whose claims have expired; messages locked by other transactions
+        are skipped
+        """
+        return self._session.query(OutboxMessage) \
+                            .filter(OutboxMessage.status.in_(("pending", "sending")),
+                                    OutboxMessage.next_attempt <= datetime.now()) \
+                            .order_by(OutboxMessage.next_attempt, OutboxMessage.id) \
+                            .limit(limit) \
+                            .with_for_update(skip_locked=True) \
+                            .all()
+
+    def get_outbox_messages(self, message_ids: Collection[int]) -> List[OutboxMessage]:
+        """Get the outbox messages with the given IDs."""
+        if not message_ids:
+            return []
+        return self._session.query(OutboxMessage) \
+                            .filter(OutboxMessage.id.in_(message_ids)) \
+                            .all()
+
+    def get_outbox_depth(self) -> Dict[str, Any]:
+        """
+        Get the number of outbox messages in each status, the number of
+        pending messages that are due, and when the oldest pending
+        message was created (or None, if nothing is pending)
+        """
+        depth: Dict[str, Any] = {"pending": 0, "sending": 0, "sent": 0, "dead": 0}
+        for status, count in self._session.query(OutboxMessage.status, func.count(OutboxMessage.id)) \
+                                          .group_by(OutboxMessage.status):
+            depth[status] = count
+
+        pending = self._session.query(OutboxMessage).filter(OutboxMessage.status == "pending")
+        depth["due"] = pending.filter(OutboxMessage.next_attempt <= datetime.now()).count()
+        depth["oldest_pending"] = pending.with_entities(func.min(OutboxMessage.created)).scalar()
+        return depth
+
+    def purge_outbox(self, sent_before: datetime) -> int:
+        """
+        Delete the messages that were sent before the given time,
+        returning how many were deleted
+        """
+        return self._session.query(OutboxMessage) \
+                            .filter(OutboxMessage.status == "sent",
+                                    OutboxMessage.sent < sent_before) \
+                            .delete(synchronize_session=False)
+
     ## Project Methods #################################################
 
     def get_project_by_id(self, project_id: int) -> Optional[Project]:
         """Get a project by its ID."""
-        q = self._session.query(Project)
+        q = self._query(Project, "project_with_people")
         return q.filter(Project.id == project_id) \
                 .first()
 
@@ -164,7 +329,7 @@ class Database(logging.LogWriter):
         Get the list of projects for the specified student or, if a
         project group is specified, that student's project in that group
         """
-        q = self._session.query(Project)
+        q = self._query(Project, "project_with_group")
         attr = "all"
 
         clause = (Project.student == student)
@@ -180,7 +345,7 @@ class Database(logging.LogWriter):
 
         Optionally, the list can be restricted to a given rotation.
         """
-        q = self._session.query(Project)
+        q = self._query(Project, "project_with_group")
 
         clause = (Project.supervisor == supervisor)
         if group:
@@ -195,7 +360,7 @@ class Database(logging.LogWriter):
 
         Optionally, the list can be restricted to a given rotation.
         """
-        q = self._session.query(Project)
+        q = self._query(Project, "project_with_group")
 
         clause = (Project.cogs_marker == cogs_marker)
         if group:
@@ -205,6 +370,69 @@ class Database(logging.LogWriter):
                 .order_by(Project.id) \
                 .all()
 
+    def get_projects_by_users(self, users: Collection[User]) -> List[Project]:
+        """
+        Get the list of projects that any of the specified users are
+        involved in, as supervisor, CoGS marker or student
+        """
+        ids = [user.id for user in users]
+        if not ids:
+            return []
+
+        q = self._query(Project, "project_with_group")
+        return q.filter(Project.supervisor_id.in_(ids)
+                        | Project.cogs_marker_id.in_(ids)
+                        | Project.student_id.in_(ids)) \
+                .order_by(Project.id) \
+                .all()
+
+    def get_projects_by_group(self, group: ProjectGroup) -> List[Project]:
+        """
+        Get the list of projects in the specified rotation, along with
+        the people involved in them
+        """
+        q = self._query(Project, "project_with_people")
+        return q.filter(Project.group == group) \
+                .order_by(Project.id) \
+                .all()
+
+    def get_projects_by_series(self, series: int) -> List[Project]:
+        """
+        Get the list of projects in all the rotations of the specified
+        series, along with the people involved and their marks
+        """
+        q = self._query(Project, "project_with_marks")
+        return q.join(ProjectGroup, Project.group_id == ProjectGroup.id) \
+                .filter(ProjectGroup.series == series) \
+                .order_by(Project.id) \
+                .all()
+
+    def pass_grace_deadlines(self, now: datetime) -> List[Project]:
+        """
+        Set grace_passed on every project whose grace deadline is no
+        later than the given time (in UTC), in a single update, and get
+        those projects, along with the people involved in them
+        """
+        due = self._session.query(Project.id) \
+                           .filter(Project.grace_passed.is_(False),
+                                   Project.grace_deadline <= now) \
+                           .with_for_update(skip_locked=True)
+        project_ids = [project_id for project_id, in due]
+        if not project_ids:
+            return []
+
+        self._session.query(Project) \
+                     .filter(Project.id.in_(project_ids)) \
+                     .update({Project.grace_passed: True,
+                              Project.version: Project.version + 1},
+                             synchronize_session=False)
+
+        q = self._query(Project, "project_with_people")
+        return q.filter(Project.id.in_(project_ids)) \
+                .order_by(Project.id) \
+                .populate_existing() \
+                .all()
+
     ## Project Group Methods ###########################################
 
     def get_project_group(self, series: int, part: int) -> Optional[ProjectGroup]:
@@ -254,13 +482,36 @@ class Database(logging.LogWriter):
         Get the list of all students who are enrolled on projects in the
         given series
         """
-        # TODO This would be better implemented as a join in the
-        # database, rather than rolling our own.
-        return list({
-            project.student
-            for rotation in self.get_project_groups_by_series(series)
-            for project in rotation.projects
-            if project.student is not None})
+        q = self._session.query(User)
+        return q.join(Project, Project.student_id == User.id) \
+                .join(ProjectGroup, Project.group_id == ProjectGroup.id) \
+                .filter(ProjectGroup.series == series) \
+                .distinct() \
+                .all()
+
+    def get_series_version(self, series: int) -> str:
+        """
+        Get an opaque version for the data in the given series, which
+        changes whenever its rotations, their projects (including their
+        marks, which are attached by updating the project) or the people
+        on those projects change
+        """
+        supervisor, cogs_marker, student = aliased(User), aliased(User), aliased(User)
+        q = self._session.query(ProjectGroup.id, ProjectGroup.version,
+                                Project.id, Project.version,
+                                supervisor.version, cogs_marker.version, student.version)
+        rows = q.outerjoin(Project, Project.group_id == ProjectGroup.id) \
+                .outerjoin(supervisor, Project.supervisor_id == supervisor.id) \
+                .outerjoin(cogs_marker, Project.cogs_marker_id == cogs_marker.id) \
+                .outerjoin(student, Project.student_id == student.id) \
+                .filter(ProjectGroup.series == series) \
+                .order_by(ProjectGroup.id, Project.id) \
+                .all()
+
+        digest = hashlib.sha1()
+        for row in rows:
+            digest.update(repr(tuple(row)).encode())
+        return digest.hexdigest()[:16]
 
     def get_all_years(self) -> List[int]:
         """Get the complete, sorted list of years."""
@@ -289,9 +540,9 @@ class Database(logging.LogWriter):
         ...
     def get_user_by_id(self, uid):
         """Get a user by their ID."""
-        q = self._session.query(User)
-        return q.filter(User.id == uid) \
-                .first()
+        # This checks the session's identity map before the database, so
+        # the authenticated user can be fetched again for free
+        return self._session.query(User).get(uid)
 
     def get_user_by_email(self, email: str) -> Optional[User]:
         """Get a user by their e-mail address."""
@@ -306,10 +557,36 @@ class Database(logging.LogWriter):
         assert permissions
         assert set(permissions) <= set(PERMISSIONS)
 
-        return [
-            user
-            for user in self.get_all_users()
-            if any(getattr(user.role, p) for p in permissions)]
+        return self.get_users(permissions=permissions)
+
+    def get_users(self, *,
+                  ids: Optional[Collection[int]] = None,
+                  permissions: Optional[Collection[str]] = None,
+                  offset: int = 0,
+                  limit: Optional[int] = None) -> List[User]:
+        """Get users, ordered by their ID.
+
+        Optionally, the users can be restricted to those with the given
+        IDs and/or any of the given permissions, and paginated.
+        """
+        q = self._session.query(User)
+
+        if ids is not None:
+            if not ids:
+                return []
+            q = q.filter(User.id.in_(ids))
+
+        if permissions is not None:
+            assert set(permissions) <= set(PERMISSIONS)
+            role_names = roles.with_any_permission(*permissions)
+            if not role_names:
+                return []
+            q = q.filter(User.user_roles.any(UserRole.role.in_(role_names)))
+
+        return q.order_by(User.id) \
+                .offset(offset) \
+                .limit(limit) \
+                .all()
 
     def get_all_users(self) -> List[User]:
         """Get all users in the system."""
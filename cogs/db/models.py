@@ -19,13 +19,12 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
-from datetime import date
-from functools import reduce
+from datetime import date, datetime
 from typing import Dict, Optional
 
-from sqlalchemy import Integer, String, Column, Date, ForeignKey, Boolean
+from sqlalchemy import Integer, String, Column, Date, DateTime, ForeignKey, Boolean, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 
 from cogs.common.constants import GRADES
 from cogs.scheduler.constants import DEADLINES
@@ -51,7 +50,25 @@ Base = declarative_base()
 Base.__repr__ = _base_repr  # type: ignore
 
 
-class ProjectGroup(Base):
+class Versioned(object):
+    """Mixin for models whose rows carry a version number.
+
+    The version is incremented whenever the row is updated, so it can
+    be used to tell whether a client's copy is still current (e.g., to
+    compute HTTP entity tags).
+    """
+
+    version                = Column(Integer, nullable=False, default=1, server_default="1")
+
+
+@event.listens_for(Versioned, "before_update", propagate=True)
+def _increment_version(mapper, connection, target: Versioned) -> None:
+    # Increment in the database, rather than from our copy, so that
+    # concurrent updates can't end up with the same version
+    target.version = type(target).version + 1
+
+
+class ProjectGroup(Versioned, Base):
     """Represents a single rotation."""
 
     __tablename__          = "project_groups"
@@ -125,7 +142,7 @@ class ProjectGrade(Base):
                 "bad_feedback": self.bad_feedback}
 
 
-class Project(Base):
+class Project(Versioned, Base):
     """Represents a single project."""
 
     __tablename__          = "projects"
@@ -140,6 +157,7 @@ class Project(Base):
 
     uploaded               = Column(Boolean)
     grace_passed           = Column(Boolean)
+    grace_deadline         = Column(DateTime) # When grace_passed is due to be set (in UTC)
 
     supervisor_id          = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"))
     cogs_marker_id         = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"))
@@ -179,10 +197,26 @@ class Project(Base):
             serialised["programmes"] = serialised["programmes"].split("|")
         else:
             serialised["programmes"] = []
+        if serialised["grace_deadline"] is not None:
+            serialised["grace_deadline"] = serialised["grace_deadline"].isoformat()
         return serialised
 
 
-class User(Base):
+class UserRole(Base):
+    """Represents one of the roles held by a user.
+
+    These are derived from the user's type, which is the authoritative
+    (pipe-separated) record of their roles, but are normalised into
+    their own indexed table so users can be looked up by role.
+    """
+
+    __tablename__          = "user_roles"
+
+    user_id                = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    role                   = Column(String, primary_key=True, index=True)
+
+
+class User(Versioned, Base):
     """Represents a user of the system."""
 
     __tablename__          = "users"
@@ -210,17 +244,41 @@ class User(Base):
     projects_as_cogs_marker = relationship(Project, foreign_keys=Project.cogs_marker_id, back_populates="cogs_marker", uselist=True)
     projects_as_student = relationship(Project, foreign_keys=Project.student_id, back_populates="student", uselist=True)
 
+    user_roles             = relationship(UserRole, cascade="all, delete-orphan", passive_deletes=True, uselist=True)
+
+    @validates("user_type")
+    def _validate_user_type(self, _key: str, user_type: Optional[str]) -> Optional[str]:
+        """Keep the normalised roles in step with the user type."""
+        self.normalise_roles(user_type)
+        return user_type
+
+    def normalise_roles(self, user_type: Optional[str]) -> None:
+        """Set the user's normalised roles from the given user type.
+
+        This is done automatically whenever the user type is set, so it
+        should only be necessary to call this directly for users whose
+        roles predate the user_roles table.
+        """
+        wanted = {role for role in (user_type or "").split("|") if role}
+        existing = {user_role.role: user_role for user_role in self.user_roles}
+        self.user_roles = [existing.get(role) or UserRole(role=role)
+                           for role in sorted(wanted)]
+
     @property
     def role(self) -> Role:
         """
         Get the user's permissions based on the disjunction of their
         roles, deserialised from their user type
         """
-        assert self.user_type is not None
-        return reduce(
-            lambda acc, this: acc | this,
-            [getattr(roles, role) for role in self.user_type.split("|") if role],
-            roles.zero)
+        user_type = self.user_type
+        assert user_type is not None
+
+        # Cached until the user type changes; instances loaded from the
+        # database bypass __init__, hence getattr
+        cached = getattr(self, "_role_cache", None)
+        if cached is None or cached[0] != user_type:
+            cached = self._role_cache = (user_type, roles.for_user_type(user_type))
+        return cached[1]
 
     @property
     def best_email(self) -> Optional[str]:
@@ -241,6 +299,17 @@ class User(Base):
             or group.student_viewable
         )
 
+    def can_download_report(self, project: Project) -> bool:
+        """Can the user download the project's report?
+
+        Only if they're involved in the project, or their role allows
+        them to see all submitted projects.
+        """
+        return bool(
+            self in (project.student, project.cogs_marker, project.supervisor)
+            or self.role.view_all_submitted_projects
+        )
+
     def can_choose_project(self, project: Project) -> bool:
         """Can the given user (student) choose the specified project?
 
@@ -281,7 +350,7 @@ class User(Base):
         return serialised
 
 
-class EmailTemplate(Base):
+class EmailTemplate(Versioned, Base):
     """Represents an email template (subject and contents)."""
 
     __tablename__          = "email_templates"
@@ -297,10 +366,42 @@ class EmailTemplate(Base):
         return {key: getattr(self, key) for key in self.__table__.columns.keys()}
 
 
+class OutboxMessage(Base):
+    """Represents an e-mail in the outbox (see cogs.mail.outbox).
+
+    E-mails are stored fully rendered, bar their attachments, which are
+    stored as a JSON list of [filename, link] pairs and read when they're
+    sent.
+    """
+
+    __tablename__          = "outbox"
+
+    id                     = Column(Integer, primary_key=True)
+    idempotency_key        = Column(String, nullable=False, unique=True)
+    status                 = Column(String, nullable=False, default="pending", index=True)  # pending, sending, sent or dead
+
+    created                = Column(DateTime, nullable=False, default=datetime.now)
+    next_attempt           = Column(DateTime, nullable=False, default=datetime.now)
+    attempts               = Column(Integer, nullable=False, default=0)
+    sent                   = Column(DateTime)
+    last_error             = Column(String)
+
+    sender                 = Column(String, nullable=False)
+    recipient              = Column(String, nullable=False)
+    cc                     = Column(String)
+    bcc                    = Column(String)
+    subject                = Column(String, nullable=False)
+    body                   = Column(String, nullable=False)
+    attachments            = Column(String, nullable=False, default="[]")
+
+
 __all__ = [
+    "Versioned",
     "ProjectGroup",
     "ProjectGrade",
     "Project",
     "User",
+    "UserRole",
     "EmailTemplate",
+    "OutboxMessage",
 ]
@@ -19,8 +19,9 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
 from contextvars import ContextVar
-from typing import Any
+from typing import Any, Callable
 
+from sqlalchemy.orm import Session, scoped_session
 from sqlalchemy.util import ThreadLocalRegistry
 
 
@@ -80,3 +81,14 @@ class ContextLocalRegistry(ThreadLocalRegistry):
         # Probably clearer/cleaner to call .reset(token) here, but it's
         # not obvious where to store the token.
         _context.set(_MISSING)
+
+
+def context_scoped_session(session_factory: Callable[[], Session]) -> scoped_session:
+    """Create a scoped_session whose sessions are local to a context.
+
+    This does the wiring described in the ContextLocalRegistry
+    documentation, above.
+    """
+    Session = scoped_session(session_factory)
+    Session.registry = ContextLocalRegistry(session_factory)
+    return Session
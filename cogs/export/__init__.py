@@ -0,0 +1,3 @@
+# This is purely for nicer imports
+from .cache import ExportCache
+from .workbook import GroupExportWriter, write_group_export
@@ -0,0 +1,231 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import os
+import re
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp.web import Application
+
+from cogs.common import logging
+from cogs.db.asynchronous import AsyncDatabase
+from .workbook import write_group_export
+
+
+# Cached workbooks are named after their series and data version
+_FILENAME = re.compile(r"^series-(?P<series>\d+)-(?P<version>[0-9a-f]+)\.xlsx$")
+
+
+class ExportCache(logging.LogWriter):
+    """On-disk cache of rendered series exports.
+
+    Workbooks are keyed by their series and the version of the data in
+    that series (see Database.get_series_version), so a cached export is
+    never stale: as soon as anything in the series changes, the version
+    changes and the next download renders a new workbook. Superseded
+    workbooks are simply left for eviction, which removes the least
+    recently used workbooks once there are too many of them or they are
+    too large in total. Workbooks used within the last grace seconds are
+    never evicted, even if that leaves the cache over its limits for a
+    while, so that a workbook can't be removed between get returning its
+    filename and the download opening it.
+
+    Rendering is expensive, so a background task periodically looks for
+    cached series whose data has changed and renders them ahead of the
+    next download. It only does so once the data has stopped changing
+    for a whole interval, so a burst of marking results in one render,
+    rather than one per mark.
+    """
+
+    _db: AsyncDatabase
+    _directory: str
+    _link_template: str
+    _max_entries: int
+    _max_size: int
+    _refresh_interval: float
+    _grace: float
+
+    _locks: Dict[int, asyncio.Lock]
+    _pending: Dict[int, str]
+    _refresher: Optional[asyncio.Task]
+
+    def __init__(self, db: AsyncDatabase, directory: str, download_link_template: str, *,
+                 max_entries: int = 20,
+                 max_size: int = 100 * 1024 * 1024,
+                 refresh_interval: float = 300,
+                 grace: float = 60) -> None:
+        self._db = db
+        self._directory = os.path.normpath(os.path.expanduser(directory))
+        self._link_template = download_link_template
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._refresh_interval = refresh_interval
+        self._grace = grace
+
+        self._locks = {}
+        self._pending = {}
+        self._refresher = None
+
+        os.makedirs(self._directory, exist_ok=True)
+
+    def _filename(self, series: int, version: str) -> str:
+        return os.path.join(self._directory, f"series-{series}-{version}.xlsx")
+
+    def _entries(self) -> List[Tuple[os.stat_result, str, int]]:
+        """List the cached workbooks, least recently used first."""
+        entries = []
+        for name in os.listdir(self._directory):
+            match = _FILENAME.match(name)
+            if match is None:
+                continue
+            filename = os.path.join(self._directory, name)
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((stat, filename, int(match["series"])))
+
+        entries.sort(key=lambda entry: entry[0].st_mtime)
+        return entries
+
+    def _lookup(self, filename: str) -> bool:
+        """Check for a cached workbook, marking it as recently used."""
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _render(self, series: int, filename: str) -> None:
+        """Render the series' workbook into the cache.
+
+        NOTE This runs in the database thread pool
+        """
+        # Written to a temporary file and moved into place, so a
+        # partially-written workbook can't be served
+        fd, temporary = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w+b") as output:
+                write_group_export(self._db.database, series, self._link_template, output)
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temporary, filename)
+        except:
+            os.unlink(temporary)
+            raise
+
+        self._evict(keep=filename)
+
+    def _evict(self, keep: str) -> None:
+        """Remove least recently used workbooks to bring the cache within its limits."""
+        # Workbooks are marked as used when they're looked up, so these
+        # may still be about to be downloaded
+        in_use = time.time() - self._grace
+        entries = self._entries()
+        count = len(entries)
+        size = sum(stat.st_size for stat, _, _ in entries)
+
+        for stat, filename, _ in entries:
+            if count <= self._max_entries and size <= self._max_size:
+                break
+            if filename == keep or stat.st_mtime > in_use:
+                continue
+
+            self.log(logging.DEBUG, f"Evicting cached export {filename}")
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
+            count -= 1
+            size -= stat.st_size
+
+    async def get(self, series: int) -> str:
+        """Get the filename of an up-to-date export for the series.
+
+        The workbook is rendered, if it isn't already cached, using the
+        current context's database session.
+        """
+        version = await self._db.get_series_version(series)
+        filename = self._filename(series, version)
+
+        # Concurrent downloads of the same series wait for one render
+        async with self._locks.setdefault(series, asyncio.Lock()):
+            loop = asyncio.get_event_loop()
+            if not await loop.run_in_executor(None, self._lookup, filename):
+                self.log(logging.INFO, f"Rendering export for series {series} (version {version})")
+                await self._db.run(self._render, series, filename)
+
+        return filename
+
+    async def refresh(self) -> None:
+        """Render the workbooks for cached series whose data has settled.
+
+        A series is rendered once its version is the same as it was the
+        last time this was run, but there's no workbook for it.
+        """
+        loop = asyncio.get_event_loop()
+        cached = {series for _, _, series in await loop.run_in_executor(None, self._entries)}
+
+        for series in cached:
+            version = await self._db.run(self._in_own_session, self._db.database.get_series_version, series)
+            filename = self._filename(series, version)
+
+            if os.path.exists(filename):
+                self._pending.pop(series, None)
+            elif self._pending.get(series) != version:
+                # Still changing, so wait for it to settle
+                self._pending[series] = version
+            else:
+                del self._pending[series]
+                async with self._locks.setdefault(series, asyncio.Lock()):
+                    if not os.path.exists(filename):
+                        self.log(logging.INFO, f"Refreshing export for series {series} (version {version})")
+                        await self._db.run(self._in_own_session, self._render, series, filename)
+
+    def _in_own_session(self, fn, *args):
+        with self._db.database.session_scope():
+            return fn(*args)
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log(logging.ERROR, f"Could not refresh cached exports: {e!r}")
+
+    async def start(self, _app: Application) -> None:
+        """Start refreshing exports in the background (an on_startup signal handler)."""
+        self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self, _app: Application) -> None:
+        """Stop refreshing exports (an on_cleanup signal handler)."""
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
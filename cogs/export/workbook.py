@@ -0,0 +1,453 @@
+"""
+Copyright (c) 2017, 2018 Genome Research Ltd.
+
+Authors:
+* Simon Beal <sb48@sanger.ac.uk>
+* Christopher Harrison <ch12@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from types import TracebackType
+from typing import Dict, IO, List, MutableSequence, Optional, Sequence, Tuple, Type, Union
+
+import xlsxwriter
+from xlsxwriter.workbook import Workbook
+from xlsxwriter.worksheet import Worksheet
+from xlsxwriter.format import Format
+
+from cogs.common import HTMLRenderer
+from cogs.db.interface import Database
+from cogs.db.models import Project, ProjectGroup, User
+
+_render_html = HTMLRenderer()
+
+# Each cell is either a string or a tuple of arguments to the writer which may contain formatting
+_CellT = Union[str, Tuple[str, Format]]
+
+
+def write_group_export(db: Database, series: int, download_link_template: str, output: IO[bytes]) -> None:
+    """
+    Write the export workbook for the series to the output file object
+
+    NOTE This makes blocking database queries and does a lot of work, so
+    shouldn't be run on the event loop
+    """
+    with GroupExportWriter(db, download_link_template, output) as workbook:
+        workbook.create_schedule(series)
+        workbook.create_feedback(series)
+        workbook.create_summary(series)
+        workbook.create_checklist(series)
+
+
+# FIXME This thing is in serious need of some documentation! While the
+# interface has been refactored (i.e., using a class with a context
+# manager, etc.), I have not done much/anything to the methods. Many of
+# them are very obtuse :P
+
+
+class _SeriesData:
+    """Everything in a series that goes into the export.
+
+    This is fetched up front, in a fixed number of queries, and shared
+    between the worksheets.
+    """
+
+    groups: List[ProjectGroup]
+    students: List[User]
+    _projects: Dict[Tuple[int, int], Project]
+
+    def __init__(self, db: Database, series: int) -> None:
+        self.groups = db.get_project_groups_by_series(series)
+
+        # Projects are ordered by ID, so if a student somehow has more
+        # than one project in a rotation, the first is used
+        self._projects = {}
+        students: Dict[int, User] = {}
+        for project in db.get_projects_by_series(series):
+            if project.student is not None:
+                # Projects with students are always in a rotation
+                assert project.student_id is not None and project.group_id is not None
+                self._projects.setdefault((project.student_id, project.group_id), project)
+                students[project.student_id] = project.student
+
+        self.students = sorted(students.values(), key=lambda student: (student.name or "", student.id))
+
+    def project(self, student: User, group: ProjectGroup) -> Optional[Project]:
+        """Get the student's project in the rotation, if any."""
+        return self._projects.get((student.id, group.id))
+
+
+class GroupExportWriter:
+    """Group export Excel preparation.
+
+    The workbook is written in xlsxwriter's constant memory mode, so
+    the cells of each worksheet are flushed to disk row by row, rather
+    than being held in memory until the workbook is closed.
+    """
+
+    _db: Database
+    _open: bool
+    _output: IO[bytes]
+    _workbook: Workbook
+    _series: Dict[int, _SeriesData]
+
+    def __init__(self, db: Database, download_link_template: str, output: IO[bytes]) -> None:
+        """
+        Constructor: The workbook will be written to the output file
+        object when the writer is closed
+        """
+        self._db = db
+        self._download_link_template = download_link_template
+        self._output = output
+        self._open = False
+        self._series = {}
+
+    def __enter__(self) -> "GroupExportWriter":
+        """
+        Context management: Open the file descriptor to set up the
+        workbook and add cell formatters
+        """
+        if self._open:
+            raise RuntimeError("Workbook already open")
+
+        self._workbook = workbook = xlsxwriter.Workbook(self._output, {"constant_memory": True})
+        self._open = True
+
+        highlighted = workbook.add_format()
+        highlighted.set_bg_color("FF99FF")
+        bold = workbook.add_format()
+        bold.set_bg_color("FF99FF")
+        bold.set_bold(True)
+
+        # FIXME? Should these be added to the workbook object? They're
+        # not used anywhere in the worksheet creation methods...
+        # Usage was removed in commit e467de5066efb6095b8bb267fdf29add634a6db7
+        # Appeared to be a cleanup. Maybe forgot to reimplement?
+        workbook.bold = bold
+        workbook.highlighted = highlighted
+
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        """
+        Context management exit: Close the workbook (exceptions are
+        propagated)
+        """
+        self._open = False
+        self._workbook.close()
+
+    @staticmethod
+    def _gen_student_cells(students: List[User], series: int, title: str, gap: int = 0) -> List[_CellT]:
+        """
+        Generate the starting 6 heading rows and then a row for each student
+        There are `gap` empty cells between each student
+        """
+        student_cells: List[_CellT] = [
+            "",
+            title,
+            f"Year: {series}-{series + 1}",
+            "",
+            "",
+            "Student"]
+
+        for student in students:
+            student_cells.append(student.name or "")
+            student_cells.extend([""] * gap)
+
+        return student_cells
+
+    @staticmethod
+    def _write_cells(worksheet: Worksheet, cells: List[List[_CellT]], max_size: int = 30) -> None:
+        """Write a 2D array of cells, given by column, to a worksheet.
+
+        The `max_size` parameter denotes the maximum width, in
+        characters, of any column.
+        """
+        length_list = [min(max(len(str(row)) for row in column), max_size) for column in cells]
+        for i in range(len(cells)):
+            worksheet.set_column(i, i, length_list[i])
+
+        # In constant memory mode, cells must be written row by row
+        for j in range(max(map(len, cells), default=0)):
+            for i, column in enumerate(cells):
+                if j < len(column):
+                    row = column[j]
+                    worksheet.write(j, i, *(row if isinstance(row, tuple) else (row,)))
+
+    def _data(self, series: int) -> _SeriesData:
+        """Get the data for the series, fetching it on first use."""
+        if series not in self._series:
+            self._series[series] = _SeriesData(self._db, series)
+        return self._series[series]
+
+    def create_schedule(self, series: int) -> None:
+        """
+        Output the schedule for all rotations currently defined
+        """
+        if not self._open:
+            raise RuntimeError("Workbook not open")
+
+        worksheet = self._workbook.add_worksheet("schedule")
+
+        data = self._data(series)
+        groups = data.groups
+        students = data.students
+
+        student_cells = self._gen_student_cells(students, series, "Student rotations")
+        group_cells = [student_cells]
+
+        for group in groups:
+            columns: MutableSequence[Sequence[_CellT]] = list(zip(*[
+                ["", "", "", f"Rotation {group.part} - supervisor and project", "Supervisor", ""],
+                ["", "", "", "", f"Others involved", ""],
+                ["", "", "", "", f"Project title", ""]
+            ]))
+
+            for student in students:
+                project = data.project(student, group)
+
+                if project:
+                    columns.append([
+                        project.supervisor.name or "",
+                        project.small_info or "",
+                        project.title or "",
+                    ])
+                else:
+                    columns.append(["", "", ""])
+
+            group_cells.extend(zip(*columns))
+
+        self._write_cells(worksheet, group_cells)
+
+    def create_feedback(self, series: int) -> None:
+        """
+        Create a detailed table of supervisor and CoGS feedback
+        """
+        if not self._open:
+            raise RuntimeError("Workbook not open")
+
+        worksheet = self._workbook.add_worksheet("feedback")
+
+        data = self._data(series)
+        groups = data.groups
+        students = data.students
+
+        student_cells = self._gen_student_cells(students, series, "Student rotations", gap=19)
+        group_cells = [student_cells]
+
+        for group in groups:
+            assert group.student_choice is not None
+            start_date = group.student_choice.strftime("%d %B")
+            assert group.student_complete is not None
+            end_date = group.student_complete.strftime("%d %B")
+
+            column: List[_CellT] = [
+                "", "", "",
+                f"Rotation {group.part} - supervisor and project",
+                f"{start_date} - {end_date}",
+                ""
+            ]
+
+            for student in students:
+                project = data.project(student, group)
+                if not project:
+                    column.extend([
+                        f"",
+                        f"Supervisor/s: (No Project)",
+                        f"Title: (No Project)",
+                        f"Score:",
+                        "What did the student do particularly well?",
+                        "",
+                        "What improvements could the student make?",
+                        "",
+                        "General comments on the project and report:",
+                        "",
+                        "",
+                        "CoGS marker: (No Project)",
+                        "Score: ",
+                        "What did the student do particularly well?",
+                        "",
+                        "What improvements could the student make?",
+                        "",
+                        "General comments on the project and report:",
+                        "",
+                        ""
+                    ])
+                    continue
+
+                supervisor_feedback = project.supervisor_feedback
+
+                # NOTE This used to use a sentinel object (similarly,
+                # below), which was quite a neat approach, but I feel
+                # this is much clearer
+                grade = good_feedback = bad_feedback = general_feedback = ""
+                if supervisor_feedback:
+                    grade = supervisor_feedback.to_grade().name
+                    good_feedback = supervisor_feedback.good_feedback or ""
+                    bad_feedback = supervisor_feedback.bad_feedback or ""
+                    general_feedback = supervisor_feedback.general_feedback or ""
+
+                column.extend([
+                    f"Download link: {self._download_link_template.format(project.id)}",
+                    f"Supervisor/s: {project.supervisor.name}{', ' if project.small_info else ''}{project.small_info}",
+                    f"Title: {project.title}",
+                    f"Score: {grade}",
+                    "What did the student do particularly well?",
+                    _render_html(good_feedback),
+                    "What improvements could the student make?",
+                    _render_html(bad_feedback),
+                    "General comments on the project and report:",
+                    _render_html(general_feedback),
+                    ""
+                ])
+
+                if project.cogs_marker:
+                    cogs_feedback = project.cogs_feedback
+
+                    grade = good_feedback = bad_feedback = general_feedback = ""
+                    if cogs_feedback:
+                        grade = cogs_feedback.to_grade().name
+                        good_feedback = cogs_feedback.good_feedback or ""
+                        bad_feedback = cogs_feedback.bad_feedback or ""
+                        general_feedback = cogs_feedback.general_feedback or ""
+
+                    column.extend([
+                        f"CoGS marker: {project.cogs_marker.name}",
+                        f"Score: {grade}",
+                        "What did the student do particularly well?",
+                        _render_html(good_feedback),
+                        "What improvements could the student make?",
+                        _render_html(bad_feedback),
+                        "General comments on the project and report:",
+                        _render_html(general_feedback),
+                        ""
+                    ])
+
+                else:
+                    column.extend([
+                        "CoGS marker: ",
+                        "Score: ",
+                        "What did the student do particularly well?",
+                        "",
+                        "What improvements could the student make?",
+                        "",
+                        "General comments on the project and report:",
+                        "",
+                        ""
+                    ])
+
+            group_cells.append(column)
+
+        self._write_cells(worksheet, group_cells)
+
+    def create_summary(self, series: int) -> None:
+        """
+        Get a summary of results for students' projects in a series
+        In the form:
+            Student|R1 |R2 |R3
+                   |S|C|S|C|S|C
+            Bob    |A|B|C|D|E|F
+        """
+        if not self._open:
+            raise RuntimeError("Workbook not open")
+
+        worksheet = self._workbook.add_worksheet("summary")
+
+        data = self._data(series)
+        groups = data.groups
+        students = data.students
+
+        student_cells = self._gen_student_cells(students, series, "Student rotations - feedback score summary")
+        group_cells = [student_cells]
+
+        for group in groups:
+            s_column: List[_CellT] = ["", "", "", "", f"Rotation {group.part}", "Supervisor/s"]
+            c_column: List[_CellT] = ["", "", "", "", "", "CoGS"]
+
+            for student in students:
+                project = data.project(student, group)
+
+                if project:
+                    if project.supervisor_feedback is not None:
+                        s_column.append(project.supervisor_feedback.to_grade().name)
+                    else:
+                        s_column.append("")
+
+                    if project.cogs_feedback is not None:
+                        c_column.append(project.cogs_feedback.to_grade().name)
+                    else:
+                        c_column.append("")
+
+                else:
+                    s_column.append("")
+                    c_column.append("")
+
+            group_cells.append(s_column)
+            group_cells.append(c_column)
+
+        self._write_cells(worksheet, group_cells)
+
+    def create_checklist(self, series: int) -> None:
+        """
+        Synopsis of which markers have given feedback for projects in a series
+        """
+        if not self._open:
+            raise RuntimeError("Workbook not open")
+
+        worksheet = self._workbook.add_worksheet("checklist")
+
+        data = self._data(series)
+        groups = data.groups
+        students = data.students
+
+        student_cells = self._gen_student_cells(students, series, "Student rotations - has feedback been given to the student?")
+        group_cells = [student_cells]
+
+        for group in groups:
+            uploaded_yn_col: List[_CellT] = ["", "", "", "", f"Rotation {group.part}", "Student Uploaded?"]
+            supervisor_col: List[_CellT] = ["", "", "", "", "", "Supervisor/s"]
+            supervisor_yn_col: List[_CellT] = ["", "", "", "", "", "Marked?"]
+            cogs_col: List[_CellT] = ["", "", "", "", "", "CoGS"]
+            cogs_yn_col: List[_CellT] = ["", "", "", "", "", "Marked?"]
+
+            for student in students:
+                project = data.project(student, group)
+                if not project:
+                    uploaded_yn_col.append("")
+                    supervisor_col.append("")
+                    supervisor_yn_col.append("")
+                    cogs_col.append("")
+                    cogs_yn_col.append("")
+                    continue
+
+                uploaded_yn_col.append("Y" if project.uploaded else "")
+                supervisor_col.append(project.supervisor.name or "")
+                supervisor_yn_col.append("Y" if project.supervisor_feedback else "")
+
+                if project.cogs_marker:
+                    cogs_col.append(project.cogs_marker.name or "")
+                    cogs_yn_col.append("Y" if project.cogs_feedback else "")
+                else:
+                    cogs_col.append("")
+                    cogs_yn_col.append("")
+
+            group_cells.append(uploaded_yn_col)
+            group_cells.append(supervisor_col)
+            group_cells.append(supervisor_yn_col)
+            group_cells.append(cogs_col)
+            group_cells.append(cogs_yn_col)
+
+        self._write_cells(worksheet, group_cells)
@@ -1 +1,3 @@
-from .interface import FileHandler
+from .archive import write_archive
+from .interface import FileHandler, Manifest, ReportUpload
+from .storage import ContentAddressedStorage, LocalStorage, SharedStorage, Storage, create_storage
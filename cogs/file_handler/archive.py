@@ -0,0 +1,49 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import shutil
+from typing import IO, Iterable, Tuple
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
+
+
+# Size of the chunks in which files are copied into archives
+_CHUNK_SIZE = 64 * 1024
+
+
+def write_archive(files: Iterable[Tuple[str, str]], output: IO[bytes]) -> None:
+    """Write a ZIP archive of the given files to the output.
+
+    The files are given as pairs of their name in the archive and their
+    filename; files that don't exist are skipped. They're stored without
+    compression (reports are ZIP archives already, so there's nothing to
+    gain) and copied in chunks, so this uses constant memory, and the
+    output needn't be seekable (e.g., it can be a network stream).
+
+    NOTE This blocks, so shouldn't be run on the event loop
+    """
+    with ZipFile(output, "w", ZIP_STORED) as archive:
+        for name, filename in files:
+            try:
+                source = open(filename, "rb")
+            except FileNotFoundError:
+                continue
+
+            with source, archive.open(ZipInfo.from_file(filename, name), "w") as destination:
+                shutil.copyfileobj(source, destination, _CHUNK_SIZE)
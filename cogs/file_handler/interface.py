@@ -18,47 +18,212 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
-import os.path
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, IO, Optional
+from zipfile import BadZipFile, ZipFile
 
 from cogs.common import logging
 from cogs.db.models import Project
+from .storage import ContentAddressedStorage, Storage
+
+
+# A summary of the contents of a report; see build_manifest
+Manifest = Dict[str, Any]
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def manifest_filename(filename: str) -> str:
+    """Return the filename of the manifest for the given report."""
+    return f"{filename}.manifest.json"
+
+
+def build_manifest(filename: str, sha256: Optional[str] = None) -> Manifest:
+    """Summarise the report with the given filename.
+
+    The manifest records the files in the archive (if it is one), with
+    their uncompressed sizes and CRCs, the report's SHA-256 digest (which
+    is computed, unless it's already known) and the size and
+    modification time of the report it was built from, so that it can
+    be rebuilt if the report changes.
+    """
+    stat = os.stat(filename)
+
+    if sha256 is None:
+        digest = hashlib.sha256()
+        with open(filename, "rb") as report:
+            for chunk in iter(lambda: report.read(_HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+
+    try:
+        with ZipFile(filename) as archive:
+            files = [{"name": info.filename, "size": info.file_size, "crc": info.CRC}
+                     for info in archive.infolist()]
+    except BadZipFile:
+        files = []
+
+    return {"size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+            "files": files,
+            "uncompressed_size": sum(file["size"] for file in files)}
+
+
+def _write_manifest(filename: str, manifest: Manifest) -> None:
+    """Atomically write the manifest for the given report."""
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".part")
+    try:
+        with os.fdopen(fd, "w") as output:
+            json.dump(manifest, output)
+        os.replace(temporary, manifest_filename(filename))
+    except:
+        os.unlink(temporary)
+        raise
+
+
+class ReportUpload:
+    """A new report for a project, which replaces the existing one.
+
+    The report is written to a temporary file in the storage's staging
+    directory, and is only stored, atomically replacing the existing
+    report, when the upload is committed; until then (or if it's aborted
+    instead) the existing report is left untouched. Either commit() or
+    abort() must be called.
+
+    NOTE These methods block, so shouldn't be run on the event loop
+    """
+
+    _storage: Storage
+    _key: str
+    _temporary: str
+    _file: IO[bytes]
+    _sha256: Any
+
+    def __init__(self, storage: Storage, key: str) -> None:
+        self._storage = storage
+        self._key = key
+        fd, self._temporary = tempfile.mkstemp(dir=storage.staging_directory(key), suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._sha256.update(data)
+
+    def commit(self) -> Manifest:
+        """Replace the existing report with the uploaded one, returning its manifest."""
+        sha256 = self._sha256.hexdigest()
+        try:
+            self._file.close()
+            filename = self._storage.store(self._key, self._temporary, sha256)
+        except:
+            self.abort()
+            raise
+
+        manifest = build_manifest(filename, sha256)
+        _write_manifest(filename, manifest)
+        return manifest
+
+    def abort(self) -> None:
+        """Discard the upload, leaving the existing report untouched."""
+        self._file.close()
+        try:
+            os.unlink(self._temporary)
+        except FileNotFoundError:
+            pass
 
 
 class FileHandler(logging.LogWriter):
-    """Project file handling interface."""
+    """Project file handling interface.
 
-    _upload_dir: str
+    Reports are kept in a storage backend (see cogs.file_handler.storage),
+    which by default stores them in the upload directory, once for each
+    distinct report.
+    """
+
+    _storage: Storage
     _max_filesize: int
 
-    def __init__(self, upload_directory: str, max_filesize: int) -> None:
-        self._upload_dir = os.path.normpath(os.path.expanduser(upload_directory))
+    def __init__(self, upload_directory: str, max_filesize: int, storage: Optional[Storage] = None) -> None:
+        self._storage = storage or ContentAddressedStorage(upload_directory)
         self._max_filesize = max_filesize
 
     def get_max_filesize(self):
         return self._max_filesize
 
+    def get_key_for_project(self, project: Project) -> str:
+        """Return the key under which the given project's report is stored."""
+        group = project.group
+        return f"{project.student.id}/{group.series}_{group.part}_{project.id}.zip"
+
     def get_filename_for_project(self, project: Project) -> str:
         """Return the filename for the report for the given project.
 
         Note that this does not guarantee that said file exists.
+
+        NOTE This may block, so shouldn't be run on the event loop
         """
-        group = project.group
-        return os.path.join(
-            self._upload_dir,
-            f"{project.student.id}",
-            f"{group.series}_{group.part}_{project.id}.zip"
-        )
+        return self._storage.path(self.get_key_for_project(project))
+
+    def upload_project(self, project: Project) -> ReportUpload:
+        """Start uploading a new report for a project.
+
+        NOTE This blocks, so shouldn't be run on the event loop
+        """
+        return ReportUpload(self._storage, self.get_key_for_project(project))
 
-    def get_project(self, project, mode):
-        """Obtain a file handle for a project's file.
+    def get_manifest(self, project: Project) -> Optional[Manifest]:
+        """Get the manifest for a project's report, or None if there's no report.
+
+        Manifests are written when reports are uploaded, but are rebuilt
+        here if the report has since changed (or never had one).
+
+        NOTE This blocks, so shouldn't be run on the event loop
+        """
+        filename = self.get_filename_for_project(project)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+
+        try:
+            with open(manifest_filename(filename)) as sidecar:
+                manifest = json.load(sidecar)
+            if (manifest["size"], manifest["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                return manifest
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        self.log(logging.DEBUG, f"Rebuilding manifest for {filename}")
+        manifest = build_manifest(filename)
+        _write_manifest(filename, manifest)
+        return manifest
+
+    def collect_garbage(self) -> int:
+        """
+        Remove stored content that no report refers to any more,
+        returning the number of files removed
+
+        NOTE This blocks, so shouldn't be run on the event loop
+        """
+        return self._storage.collect_garbage()
+
+    def get_project(self, project, mode="rb"):
+        """Obtain a file handle for reading a project's file.
 
         This should be used in the same way as open(), i.e.:
 
         >>> with get_project(...) as f:
         ...     ...
+
+        Stored reports must not be modified in place (as their content
+        may be shared); use upload_project to replace them.
         """
-        user_path = os.path.join(self._upload_dir, str(project.student.id))
-        if not os.path.isdir(user_path):
-            os.makedirs(user_path)
+        if set(mode) & set("wax+"):
+            raise ValueError(f"Reports can only be opened for reading, not with mode {mode!r}")
 
         return open(self.get_filename_for_project(project), mode=mode)
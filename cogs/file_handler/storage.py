@@ -0,0 +1,353 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from abc import ABCMeta, abstractmethod
+from typing import Dict, Iterator, Set
+
+from cogs.common import logging
+
+
+# Stored content which is no longer referenced is only removed once it's
+# this old (in seconds), so content that's in the process of being
+# stored isn't mistaken for garbage
+_GARBAGE_GRACE_TIME = 60 * 60
+
+# Likewise for abandoned temporary files
+_STAGING_GRACE_TIME = 24 * 60 * 60
+
+
+def _fsync(filename: str) -> None:
+    """Flush a file (or directory) to disk."""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _files(directory: str) -> Iterator[str]:
+    """Walk the files beneath a directory."""
+    for path, _, files in os.walk(directory):
+        for name in files:
+            yield os.path.join(path, name)
+
+
+def _older_than(filename: str, seconds: float) -> bool:
+    try:
+        return os.stat(filename).st_mtime < time.time() - seconds
+    except FileNotFoundError:
+        return False
+
+
+class Storage(logging.LogWriter, metaclass=ABCMeta):
+    """Where uploaded files are kept.
+
+    Stored files are identified by keys, which are relative paths (e.g.,
+    "123/2018_1_456.zip"), and are only ever stored whole: a new file is
+    written into the staging directory, then handed to store() once it's
+    complete, which moves it into storage under its key, atomically
+    replacing whatever was stored under that key before.
+
+    Stored files are read from the local path that path() gives, but
+    must never be modified in place, as storage may share their content
+    with other keys.
+    """
+
+    @abstractmethod
+    def staging_directory(self, key: str) -> str:
+        """
+        Return the directory in which a new file for the key should be
+        written, before it's stored (this will exist)
+        """
+
+    @abstractmethod
+    def store(self, key: str, temporary: str, sha256: str) -> str:
+        """Store a complete file, given its SHA-256, under the key.
+
+        The file must be in the staging directory; it's moved into
+        storage (or discarded, if the content is already stored), and
+        the local path of the stored file is returned.
+        """
+
+    @abstractmethod
+    def path(self, key: str) -> str:
+        """Return the local path of the file stored under the key.
+
+        Note that this does not guarantee that said file exists, i.e.,
+        that anything is stored under the key.
+        """
+
+    def collect_garbage(self) -> int:
+        """Remove content that is no longer stored under any key.
+
+        This returns the number of files removed.
+        """
+        return 0
+
+
+class LocalStorage(Storage):
+    """Files stored under their keys in a local directory."""
+
+    _root: str
+
+    def __init__(self, root: str) -> None:
+        self._root = os.path.normpath(os.path.expanduser(root))
+
+    def staging_directory(self, key: str) -> str:
+        directory = os.path.dirname(self.path(key))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def store(self, key: str, temporary: str, sha256: str) -> str:
+        filename = self.path(key)
+        _fsync(temporary)
+        os.replace(temporary, filename)
+        _fsync(os.path.dirname(filename))
+        return filename
+
+    def path(self, key: str) -> str:
+        return os.path.join(self._root, key)
+
+
+class ContentAddressedStorage(LocalStorage):
+    """Files stored once per distinct content, in a local directory.
+
+    The content is stored in a blob store (in the ".blobs" directory),
+    named after its SHA-256, and each key is a hard link to its blob, so
+    storing content that's already stored (e.g., an identical re-upload)
+    costs no more disk space and no writes. A blob is garbage once its
+    only link is from the blob store. The keys are laid out exactly as
+    LocalStorage lays them out, so either can be used with the other's
+    files.
+    """
+
+    _blobs: str
+
+    def __init__(self, root: str) -> None:
+        super().__init__(root)
+        self._blobs = os.path.join(self._root, ".blobs")
+
+    def _blob(self, sha256: str) -> str:
+        return os.path.join(self._blobs, sha256[:2], sha256)
+
+    def staging_directory(self, key: str) -> str:
+        os.makedirs(self._blobs, exist_ok=True)
+        return self._blobs
+
+    def store(self, key: str, temporary: str, sha256: str) -> str:
+        filename = self.path(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        blob = self._blob(sha256)
+
+        try:
+            if os.path.samefile(blob, filename):
+                # Nothing has changed
+                os.unlink(temporary)
+                return filename
+        except FileNotFoundError:
+            pass
+
+        # The key is linked to the blob under a temporary name, then
+        # renamed over whatever the key referred to before
+        link = os.path.join(os.path.dirname(filename), f".{uuid.uuid4().hex}.link")
+        try:
+            os.link(blob, link)
+        except FileNotFoundError:
+            self.log(logging.DEBUG, f"Storing new blob {sha256}")
+            _fsync(temporary)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(temporary, blob)
+            _fsync(os.path.dirname(blob))
+            os.link(blob, link)
+        else:
+            self.log(logging.DEBUG, f"Reusing existing blob {sha256}")
+            os.unlink(temporary)
+
+        os.replace(link, filename)
+        _fsync(os.path.dirname(filename))
+        return filename
+
+    def collect_garbage(self) -> int:
+        removed = 0
+        for filename in _files(self._blobs):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+
+            if os.path.dirname(filename) == self._blobs:
+                # Abandoned uploads
+                garbage = stat.st_mtime < time.time() - _STAGING_GRACE_TIME
+            else:
+                garbage = stat.st_nlink == 1 and stat.st_mtime < time.time() - _GARBAGE_GRACE_TIME
+
+            if garbage:
+                self.log(logging.DEBUG, f"Removing {filename}")
+                os.unlink(filename)
+                removed += 1
+
+        return removed
+
+
+class SharedStorage(Storage):
+    """Files stored in a directory shared between several replicas.
+
+    This stands in for an object store: content is stored once, as
+    immutable objects named after its SHA-256, and each key is a small
+    reference file containing the SHA-256 of its content. Every replica
+    keeps its own cache of the objects it reads, hard-linked (or copied,
+    if the shared directory is on another filesystem) from the shared
+    directory; as objects never change, neither do cached copies, so
+    they never go stale.
+    """
+
+    _directory: str
+    _cache: str
+
+    def __init__(self, directory: str, cache_directory: str) -> None:
+        self._directory = os.path.normpath(os.path.expanduser(directory))
+        self._cache = os.path.normpath(os.path.expanduser(cache_directory))
+
+    def _object(self, sha256: str) -> str:
+        return os.path.join(self._directory, "objects", sha256[:2], sha256)
+
+    def _ref(self, key: str) -> str:
+        return os.path.join(self._directory, "refs", key)
+
+    def _refs(self) -> Set[str]:
+        """Get the SHA-256 of everything that's stored under a key."""
+        referenced = set()
+        for ref in _files(os.path.join(self._directory, "refs")):
+            try:
+                with open(ref) as contents:
+                    referenced.add(contents.read().strip())
+            except FileNotFoundError:
+                pass
+        return referenced
+
+    def staging_directory(self, key: str) -> str:
+        directory = os.path.join(self._directory, "staging")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def store(self, key: str, temporary: str, sha256: str) -> str:
+        obj = self._object(sha256)
+        if os.path.exists(obj):
+            self.log(logging.DEBUG, f"Reusing existing object {sha256}")
+            os.unlink(temporary)
+            # Keep it from being collected before it's referenced
+            os.utime(obj)
+        else:
+            self.log(logging.DEBUG, f"Storing new object {sha256}")
+            _fsync(temporary)
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.replace(temporary, obj)
+            _fsync(os.path.dirname(obj))
+
+        ref = self._ref(key)
+        os.makedirs(os.path.dirname(ref), exist_ok=True)
+        fd, temporary_ref = tempfile.mkstemp(dir=os.path.dirname(ref), suffix=".part")
+        try:
+            with os.fdopen(fd, "w") as contents:
+                contents.write(sha256)
+                contents.flush()
+                os.fsync(contents.fileno())
+            os.replace(temporary_ref, ref)
+        except:
+            os.unlink(temporary_ref)
+            raise
+        _fsync(os.path.dirname(ref))
+
+        return self.path(key)
+
+    def path(self, key: str) -> str:
+        try:
+            with open(self._ref(key)) as contents:
+                sha256 = contents.read().strip()
+        except FileNotFoundError:
+            return os.path.join(self._cache, "absent", key)
+
+        # Cached copies keep the key's file name, as that's what
+        # they're sent as (e.g., as e-mail attachments)
+        cached = os.path.join(self._cache, sha256[:2], sha256, os.path.basename(key))
+        if not os.path.exists(cached):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            temporary = f"{cached}.{uuid.uuid4().hex}.part"
+            try:
+                os.link(self._object(sha256), temporary)
+            except FileNotFoundError:
+                # The object has gone; the caller will find out
+                return cached
+            except OSError:
+                # e.g., the shared directory is on another filesystem
+                shutil.copyfile(self._object(sha256), temporary)
+            os.replace(temporary, cached)
+
+        return cached
+
+    def collect_garbage(self) -> int:
+        referenced = self._refs()
+        removed = 0
+
+        for directory, grace_time in ((os.path.join(self._directory, "objects"), _GARBAGE_GRACE_TIME),
+                                      (os.path.join(self._directory, "staging"), _STAGING_GRACE_TIME)):
+            for filename in _files(directory):
+                if os.path.basename(filename) not in referenced and _older_than(filename, grace_time):
+                    self.log(logging.DEBUG, f"Removing {filename}")
+                    os.unlink(filename)
+                    removed += 1
+
+        # This replica's cached copies of unreferenced objects
+        if os.path.isdir(self._cache):
+            for prefix in os.listdir(self._cache):
+                if len(prefix) != 2:
+                    continue
+                for sha256 in os.listdir(os.path.join(self._cache, prefix)):
+                    if sha256 not in referenced:
+                        shutil.rmtree(os.path.join(self._cache, prefix, sha256), ignore_errors=True)
+                        removed += 1
+
+        return removed
+
+
+# Storage backends, by the name they're configured with
+BACKENDS = {
+    "local":              LocalStorage,
+    "content_addressed":  ContentAddressedStorage,
+    "shared":             SharedStorage}
+
+
+def create_storage(upload_directory: str, config: Dict) -> Storage:
+    """Create the storage backend described by the configuration.
+
+    The shared backend is configured with a "directory", which replicas
+    share, and a "cache_directory", which they don't (by default, in
+    the upload directory); the local backends use the upload directory.
+    """
+    backend = config.get("backend", "content_addressed")
+    if backend == "shared":
+        return SharedStorage(config["directory"],
+                             config.get("cache_directory", os.path.join(upload_directory, "cache")))
+    return BACKENDS[backend](upload_directory)
@@ -1,2 +1,3 @@
+from .attachments import Attachment
 from .postman import Postman
 from ._sanitise import sanitise
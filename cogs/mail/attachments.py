@@ -0,0 +1,127 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from email.message import EmailMessage
+from typing import NamedTuple, Optional, Tuple
+
+from cogs.common import logging
+
+
+class Attachment(NamedTuple):
+    """A file to attach to an e-mail.
+
+    If the file has a link (e.g., to download it from the web service),
+    it may be linked to, rather than attached, if it's large (see
+    AttachmentProvider).
+    """
+    filename: str
+    link: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.filename)
+
+
+# Cached parts are keyed by filename, modification time and size, so a
+# file that's replaced is never sent from the cache
+_Key = Tuple[str, int, int]
+
+
+class AttachmentProvider(logging.LogWriter):
+    """Produces the MIME parts for e-mail attachments.
+
+    Encoded parts for files up to max_cached_size bytes are kept in an
+    in-memory LRU cache, which is limited to cache_size bytes in total,
+    so a file that's attached to many e-mails (e.g., the job hazard
+    form) is only read and encoded once. Larger files aren't cached, so
+    they don't push everything else out of it; if they're larger than
+    link_threshold bytes and can be linked to, they aren't attached at
+    all (see TemplatedEMail.render).
+
+    NOTE This is shared between the delivery engine's threads
+    """
+
+    _cache_size: int
+    _max_cached_size: int
+    _link_threshold: Optional[int]
+
+    _cache: "OrderedDict[_Key, EmailMessage]"
+    _cached_bytes: int
+    _lock: threading.Lock
+
+    def __init__(self, *, cache_size: int = 32 * 1024 * 1024,
+                 max_cached_size: int = 1024 * 1024,
+                 link_threshold: Optional[int] = None) -> None:
+        self._cache_size = cache_size
+        self._max_cached_size = max_cached_size
+        self._link_threshold = link_threshold
+
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def should_link(self, attachment: Attachment) -> bool:
+        """Whether the attachment should be linked to, rather than attached."""
+        if attachment.link is None or self._link_threshold is None:
+            return False
+        return os.stat(attachment.filename).st_size > self._link_threshold
+
+    def part(self, attachment: Attachment) -> EmailMessage:
+        """Get the (encoded) MIME part for the attachment.
+
+        Parts may be shared between e-mails, so they mustn't be modified.
+        """
+        stat = os.stat(attachment.filename)
+        key = (attachment.filename, stat.st_mtime_ns, stat.st_size)
+        cacheable = stat.st_size <= self._max_cached_size
+
+        if cacheable:
+            with self._lock:
+                part = self._cache.get(key)
+                if part is not None:
+                    self._cache.move_to_end(key)
+                    return part
+
+        with open(attachment.filename, "rb") as data:
+            part = EmailMessage()
+            part.set_content(data.read(),
+                             maintype="application",
+                             subtype="octet-stream",
+                             disposition="attachment",
+                             filename=attachment.name)
+
+        if cacheable:
+            self._store(key, part)
+        return part
+
+    def _store(self, key: _Key, part: EmailMessage) -> None:
+        size = len(part.get_payload())
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = part
+            self._cached_bytes += size
+
+            while self._cached_bytes > self._cache_size:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted.get_payload())
@@ -0,0 +1,232 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from email.message import EmailMessage
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
+from typing import Dict, List, Optional
+
+from cogs.common import logging
+from .attachments import AttachmentProvider
+from .message import TemplatedEMail
+
+
+# Connections that have been idle for this long (in seconds) are checked
+# with a NOOP before they're used again
+_HEALTH_CHECK_AFTER = 10
+
+# Errors after which a message is retried on a new connection
+_CONNECTION_ERRORS = (SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class _Connection(logging.LogWriter):
+    """A long-lived SMTP connection, which is (re)opened as necessary."""
+
+    _host: str
+    _port: int
+    _timeout: float
+    _smtp: Optional[SMTP]
+    _last_used: float
+
+    def __init__(self, host: str, port: int, timeout: float) -> None:
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._smtp = None
+        self._last_used = 0
+
+    def _connect(self) -> SMTP:
+        if self._smtp is not None and time.monotonic() - self._last_used > _HEALTH_CHECK_AFTER:
+            try:
+                healthy = self._smtp.noop()[0] == 250
+            except (SMTPException, OSError):
+                healthy = False
+            if not healthy:
+                self.log(logging.DEBUG, "SMTP connection failed health check; reconnecting")
+                self.close()
+
+        if self._smtp is None:
+            self.log(logging.DEBUG, f"Opening SMTP connection to {self._host}:{self._port}")
+            self._smtp = SMTP(self._host, self._port, timeout=self._timeout)
+
+        return self._smtp
+
+    def send(self, message: EmailMessage) -> None:
+        """Send a message, reconnecting (once) if the connection has failed."""
+        try:
+            self._connect().send_message(message)
+        except _CONNECTION_ERRORS:
+            self.close()
+            self._connect().send_message(message)
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self, idle_timeout: float) -> None:
+        if self._smtp is not None and time.monotonic() - self._last_used > idle_timeout:
+            self.log(logging.DEBUG, "Closing idle SMTP connection")
+            self.close()
+
+    def close(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+
+class _RateLimiter(object):
+    """Token bucket, shared between threads."""
+
+    _rate: float
+    _burst: float
+    _tokens: float
+    _updated: float
+    _lock: threading.Lock
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Wait for, and take, a token."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+
+class DeliveryEngine(logging.LogWriter):
+    """Sends e-mails over a bounded set of long-lived SMTP connections.
+
+    E-mails are queued, then sent by a fixed number of worker threads,
+    each of which keeps its own SMTP connection open between messages
+    (checking it's still alive if it's been idle for a while, closing it
+    once it's been idle for idle_timeout seconds, and reconnecting if it
+    fails). Each worker sends whatever has queued up, up to batch_size
+    messages at a time, back-to-back over its connection, so a burst of
+    e-mails costs one handshake per worker, rather than one per message.
+    Optionally, sending is limited to rate messages per second overall.
+    Attachments are read via the attachment provider, if one is given.
+    """
+
+    _server: Dict
+    _queue: queue.Queue
+    _workers: List[threading.Thread]
+    _rate_limiter: Optional[_RateLimiter]
+
+    def __init__(self, host: str, port: int, timeout: float, *,
+                 connections: int = 4,
+                 rate: Optional[float] = None,
+                 batch_size: int = 20,
+                 idle_timeout: float = 60,
+                 attachments: Optional[AttachmentProvider] = None) -> None:
+        self._server = {"host": host, "port": port, "timeout": timeout}
+        self._attachments = attachments
+        self._connections = connections
+        self._batch_size = batch_size
+        self._idle_timeout = idle_timeout
+        self._rate_limiter = _RateLimiter(rate, burst=max(1, connections)) if rate else None
+
+        self._queue = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def submit(self, mail: TemplatedEMail) -> Future:
+        """Queue a prepared e-mail for sending.
+
+        This returns a future, which is resolved once the e-mail has
+        been sent, or fails with whatever prevented it from being sent.
+        """
+        with self._lock:
+            if len(self._workers) < self._connections:
+                # Workers are started as they're needed
+                worker = threading.Thread(target=self._work, name=f"smtp-{len(self._workers)}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+        future: Future = Future()
+        self._queue.put((mail, future))
+        return future
+
+    def join(self) -> None:
+        """Wait until everything queued so far has been sent (or failed)."""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Send everything queued so far, then stop the workers."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _work(self) -> None:
+        connection = _Connection(**self._server)
+        while True:
+            try:
+                item = self._queue.get(timeout=self._idle_timeout)
+            except queue.Empty:
+                connection.close_if_idle(self._idle_timeout)
+                continue
+
+            # Whatever else is waiting goes over the same connection
+            batch = [item]
+            while item is not None and len(batch) < self._batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+
+            for item in batch:
+                if item is None:
+                    continue
+                mail, future = item
+                try:
+                    if self._rate_limiter is not None:
+                        self._rate_limiter.wait()
+                    self.log(logging.DEBUG, f"Sending e-mail to {mail.recipient}")
+                    connection.send(mail.render(self._attachments))
+                except Exception as e:
+                    self.log(logging.DEBUG, f"Could not send e-mail to {mail.recipient}: {e!r}")
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+
+            for _ in batch:
+                self._queue.task_done()
+
+            if None in batch:
+                connection.close()
+                return
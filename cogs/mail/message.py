@@ -18,7 +18,8 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
-import os.path
+import html
+import os
 from email.message import EmailMessage
 from os import PathLike
 from typing import Any, Dict, List, Optional, Union
@@ -26,15 +27,30 @@ from typing import Any, Dict, List, Optional, Union
 from jinja2 import Template
 
 from cogs.common import HTMLRenderer
+from .attachments import Attachment, AttachmentProvider
 
 
 _render_html = HTMLRenderer()
 
+_EMPTY = Template("")
+
+# Used when rendering without a provider: nothing's cached or linked
+_UNCACHED = AttachmentProvider(cache_size=0, max_cached_size=-1)
+
+# Appended to the body of e-mails whose attachments are linked to
+_LINKED = """
+<p>The following files were too large to attach, but can be downloaded:</p>
+<ul>
+{}
+</ul>
+"""
+
 
 class TemplatedEMail(object):
     """E-mail message generated from a pair of templates.
 
-    Has setters for sender, recipient, CC and BCC; use add_attachment()
+    Has setters for sender, recipient, CC and BCC (and, optionally, the
+    Message-ID header, as message_id); use add_attachment()
     with a filename to add attachments (can be used multiple times), and
     set_context() to add variables to the Jinja2 template context.
     """
@@ -44,8 +60,11 @@ class TemplatedEMail(object):
     _bcc: Optional[str]
     _subject_template: Template
     _body_template: Template
-    _attached_files: List[Union[str, PathLike]]  # List of filenames, which are loaded on expansion
+    _attached_files: List[Attachment]  # Loaded on expansion
     _context: Dict
+    _subject: Optional[str]
+    _html_body: Optional[str]
+    message_id: Optional[str]
 
     def __init__(self, subject: Template, body: Template, signature: str = "") -> None:
         """Construct an e-mail from a subject and body template."""
@@ -56,15 +75,51 @@ class TemplatedEMail(object):
         self.cc = None
         self.bcc = None
         self._signature = signature
+        self._subject = None
+        self._html_body = None
+        self.message_id = None
+
+    @classmethod
+    def prerendered(cls, subject: str, html_body: str) -> "TemplatedEMail":
+        """Construct an e-mail whose templates have already been rendered."""
+        mail = cls(_EMPTY, _EMPTY)
+        mail._subject = subject
+        mail._html_body = html_body
+        return mail
 
-    def render(self) -> EmailMessage:
+    def render_templates(self) -> None:
+        """Render the subject and body templates against the context.
+
+        The context usually contains database models, which may need to
+        lazy-load their relationships; this should therefore be called
+        from the context (and so, with the database session) in which
+        the e-mail was prepared. The final render() can then be done
+        elsewhere (e.g., in another thread).
+        """
+        self._subject = self._subject_template.render(**self._context).rstrip()
+        self._html_body = self._body_template.render(**self._context) + self._signature
+
+    def render(self, attachments: Optional[AttachmentProvider] = None) -> EmailMessage:
         """Render the e-mail message.
 
-        Attachments are read into memory here.
+        Attachments are read into memory here, via the given provider
+        (which may cache them); any which the provider decides to link
+        to, rather than attach, are listed, with their links, at the end
+        of the message. (Attached files are read whole, as smtplib sends
+        whole messages; large files should be linked to, by setting the
+        provider's link_threshold.) The templates are rendered too,
+        unless render_templates() has already been called.
         """
+        attachments = attachments or _UNCACHED
         assert self._recipient and self._sender
 
+        if self._subject is None or self._html_body is None:
+            self.render_templates()
+            assert self._subject is not None and self._html_body is not None
+
         mail = EmailMessage()
+        if self.message_id is not None:
+            mail["Message-ID"] = self.message_id
         mail["To"] = self._recipient
         mail["From"] = self._sender
         if self._cc is not None:
@@ -72,20 +127,27 @@ class TemplatedEMail(object):
         if self._bcc is not None:
             mail["Bcc"] = self._bcc
 
-        mail["Subject"] = self._subject_template.render(**self._context).rstrip()
+        mail["Subject"] = self._subject
 
-        html_body = self._body_template.render(**self._context) + self._signature
+        html_body = self._html_body
+        attached: List[Attachment] = []
+        linked: List[Attachment] = []
+        for attachment in self._attached_files:
+            (linked if attachments.should_link(attachment) else attached).append(attachment)
+        if linked:
+            # (Only attachments with links are linked to)
+            html_body += _LINKED.format("\n".join(
+                f'<li><a href="{html.escape(attachment.link or "")}">{html.escape(attachment.name)}</a></li>'
+                for attachment in linked))
         text_body = _render_html(html_body)
 
         mail.set_content(text_body)
         mail.add_alternative(html_body, subtype="html")
 
-        for attachment in self._attached_files:
-            with open(attachment, "rb") as data:
-                mail.add_attachment(data.read(),
-                                    filename=os.path.basename(attachment),
-                                    maintype="application",
-                                    subtype="octet-stream")
+        if attached:
+            mail.make_mixed()
+            for attachment in attached:
+                mail.attach(attachments.part(attachment))
         return mail
 
     @property
@@ -120,7 +182,23 @@ class TemplatedEMail(object):
     def bcc(self, address: Optional[str]) -> None:
         self._bcc = address
 
-    def add_attachment(self, attachment: Union[str, PathLike]) -> None:
+    @property
+    def subject(self) -> Optional[str]:
+        """The rendered subject (None, until the templates are rendered)."""
+        return self._subject
+
+    @property
+    def html_body(self) -> Optional[str]:
+        """The rendered body (None, until the templates are rendered)."""
+        return self._html_body
+
+    @property
+    def attachments(self) -> List[Attachment]:
+        return list(self._attached_files)
+
+    def add_attachment(self, attachment: Union[str, PathLike, Attachment]) -> None:
+        if not isinstance(attachment, Attachment):
+            attachment = Attachment(os.fspath(attachment))
         self._attached_files.append(attachment)
 
     def set_context(self, key: str, value: Any) -> None:
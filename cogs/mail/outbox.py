@@ -0,0 +1,320 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp.web import Application
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from cogs.common import logging
+from cogs.db.interface import Database
+from cogs.db.models import OutboxMessage
+from .attachments import Attachment
+from .delivery import DeliveryEngine
+from .message import TemplatedEMail
+
+
+def _permanent(error: Exception) -> bool:
+    """Whether an error means that retrying would be pointless."""
+    if isinstance(error, SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in error.recipients.values())
+    if isinstance(error, SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+    return False
+
+
+class Outbox(logging.LogWriter):
+    """Durable queue of outgoing e-mails.
+
+    E-mails are enqueued by adding them to the current database session,
+    so they're stored if, and only if, the change that prompted them is
+    committed. They're then sent in the background, in batches, over the
+    delivery engine; an e-mail that can't be sent is retried, with the
+    delay doubling after each attempt (up to max_retry_delay), until
+    max_attempts have been made, or the mail server rejects it outright,
+    whereupon it's dead-lettered: it stays in the outbox, but nothing
+    more is done with it. Sent e-mails are kept for the retention period,
+    so their idempotency keys still prevent duplicates, then deleted.
+
+    Every e-mail has an idempotency key, which is also its Message-ID:
+    enqueueing an e-mail with the same key as one that's already in the
+    outbox does nothing, and should an e-mail be sent twice anyway (e.g.,
+    if the process dies between sending it and recording that it was
+    sent), its recipients' mail clients can tell that it's a duplicate.
+    """
+
+    _database: Database
+    _delivery: DeliveryEngine
+    _domain: str
+
+    _poll_interval: float
+    _batch_size: int
+    _max_attempts: int
+    _retry_delay: float
+    _max_retry_delay: float
+    _retention: timedelta
+    _claim_timeout: timedelta
+
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _wake: Optional[asyncio.Event]
+    _drainer: Optional[asyncio.Task]
+
+    def __init__(self, database: Database, delivery: DeliveryEngine, domain: str, *,
+                 poll_interval: float = 30,
+                 batch_size: int = 50,
+                 max_attempts: int = 8,
+                 retry_delay: float = 60,
+                 max_retry_delay: float = 6 * 60 * 60,
+                 retention: float = 30 * 24 * 60 * 60,
+                 claim_timeout: float = 10 * 60) -> None:
+        self._database = database
+        self._delivery = delivery
+        self._domain = domain
+
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._retention = timedelta(seconds=retention)
+        self._claim_timeout = timedelta(seconds=claim_timeout)
+
+        self._loop = None
+        self._wake = None
+        self._drainer = None
+
+        # The outbox is drained as soon as anything is committed to it,
+        # rather than at the next poll
+        event.listen(database.session, "after_commit", self._after_commit)
+
+    def enqueue(self, mail: TemplatedEMail, idempotency_key: Optional[str] = None) -> bool:
+        """Add a prepared e-mail to the outbox, in the current session.
+
+        The e-mail's templates must already have been rendered. This
+        returns False, and does nothing, if there's already an e-mail
+        with the same idempotency key in the outbox. Nothing is sent
+        until the current session is committed.
+        """
+        return self.enqueue_all([(mail, idempotency_key)])[0]
+
+    def enqueue_all(self, mails: Sequence[Tuple[TemplatedEMail, Optional[str]]]) -> List[bool]:
+        """Add prepared e-mails, with their idempotency keys, to the outbox.
+
+        This is equivalent to calling enqueue() for each e-mail, but only
+        checks the outbox for existing keys once.
+        """
+        # E-mails without idempotency keys get unique ones, which can't
+        # already be in the outbox
+        keys = [key if key is not None else uuid.uuid4().hex for _, key in mails]
+        given = {key for _, key in mails if key is not None}
+        session = self._database.session()
+
+        for attempt in range(2):
+            existing = self._database.get_outbox_keys(given)
+
+            enqueued: List[bool] = []
+            messages: List[OutboxMessage] = []
+            for (mail, _), idempotency_key in zip(mails, keys):
+                assert mail.subject is not None and mail.html_body is not None
+
+                if idempotency_key in existing:
+                    self.log(logging.DEBUG, f"E-mail {idempotency_key!r} is already in the outbox")
+                    enqueued.append(False)
+                    continue
+                existing.add(idempotency_key)
+
+                messages.append(OutboxMessage(
+                    idempotency_key=idempotency_key,
+                    sender=mail.sender,
+                    recipient=mail.recipient,
+                    cc=mail.cc,
+                    bcc=mail.bcc,
+                    subject=mail.subject,
+                    body=mail.html_body,
+                    attachments=json.dumps([list(attachment) for attachment in mail.attachments])))
+                enqueued.append(True)
+
+            try:
+                # The e-mails are inserted in a savepoint, so if any of
+                # them have been enqueued concurrently (i.e., since the
+                # keys were checked), only they are undone, rather than
+                # the caller's whole transaction, and they can be
+                # checked again (the concurrent transaction having
+                # committed by the time the insertion fails)
+                with session.begin_nested():
+                    session.add_all(messages)
+            except IntegrityError:
+                if attempt:
+                    raise
+                self.log(logging.DEBUG, "E-mails were enqueued concurrently; checking the outbox again")
+                continue
+            break
+
+        if any(enqueued):
+            session.info["outbox"] = True
+        return enqueued
+
+    def _email(self, message: OutboxMessage) -> TemplatedEMail:
+        mail = TemplatedEMail.prerendered(message.subject, message.body)
+        mail.message_id = f"<{message.idempotency_key}@{self._domain}>"
+        mail.sender = message.sender
+        mail.recipient = message.recipient
+        mail.cc = message.cc
+        mail.bcc = message.bcc
+        for attachment in json.loads(message.attachments):
+            # Attachments are stored as [filename, link] (or, originally,
+            # just as filenames)
+            mail.add_attachment(Attachment(*attachment) if isinstance(attachment, list) else attachment)
+        return mail
+
+    def _failed(self, message: OutboxMessage, error: Exception) -> None:
+        message.attempts += 1
+        message.last_error = repr(error)
+
+        if message.attempts >= self._max_attempts or _permanent(error):
+            self.log(logging.ERROR, f"Giving up on e-mail {message.id} to {message.recipient} "
+                                    f"after {message.attempts} attempt(s): {error!r}")
+            message.status = "dead"
+        else:
+            delay = min(self._retry_delay * 2 ** (message.attempts - 1), self._max_retry_delay)
+            self.log(logging.WARNING, f"Could not send e-mail {message.id} to {message.recipient} "
+                                      f"(attempt {message.attempts}); retrying in {delay:.0f}s: {error!r}")
+            message.status = "pending"
+            message.next_attempt = datetime.now() + timedelta(seconds=delay)
+
+    def _claim_batch(self) -> List[Tuple[int, TemplatedEMail]]:
+        """Claim a batch of due e-mails, returning them with their IDs.
+
+        The e-mails are marked as being sent, in a transaction of their
+        own, so they can be sent without holding a transaction open,
+        and without other drainers sending them too. If they're not
+        sent, or given up on, within the claim timeout (e.g., because
+        the process died), they're due again.
+        """
+        with self._database.session_scope():
+            messages = self._database.get_due_outbox_messages(self._batch_size)
+            claimed_until = datetime.now() + self._claim_timeout
+            for message in messages:
+                message.status = "sending"
+                message.next_attempt = claimed_until
+            return [(message.id, self._email(message)) for message in messages]
+
+    def _drain_batch(self) -> int:
+        """Send a batch of due e-mails, returning how many there were."""
+        batch = self._claim_batch()
+
+        sending = [(message_id, self._delivery.submit(mail)) for message_id, mail in batch]
+        errors: Dict[int, Optional[Exception]] = {}
+        for message_id, outcome in sending:
+            try:
+                outcome.result()
+            except Exception as e:
+                errors[message_id] = e
+            else:
+                errors[message_id] = None
+
+        with self._database.session_scope():
+            for message in self._database.get_outbox_messages(errors.keys()):
+                error = errors[message.id]
+                if error is not None:
+                    self._failed(message, error)
+                else:
+                    message.attempts += 1
+                    message.status = "sent"
+                    message.sent = datetime.now()
+
+        return len(batch)
+
+    def drain(self) -> int:
+        """Send every due e-mail, returning how many were attempted.
+
+        NOTE This blocks, and uses its own database session
+        """
+        attempted = 0
+        while True:
+            batch = self._drain_batch()
+            attempted += batch
+            if batch < self._batch_size:
+                break
+
+        with self._database.session_scope():
+            self._database.purge_outbox(datetime.now() - self._retention)
+
+        if attempted:
+            depth = self.depth()
+            self.log(logging.INFO, "Outbox drained {attempted} e-mail(s); {pending} pending, "
+                                   "{dead} dead-lettered".format(attempted=attempted, **depth))
+        return attempted
+
+    def depth(self) -> Dict[str, Any]:
+        """Get the outbox's queue depth (see Database.get_outbox_depth).
+
+        NOTE This blocks, and uses its own database session
+        """
+        with self._database.session_scope():
+            return self._database.get_outbox_depth()
+
+    def _after_commit(self, session: Session) -> None:
+        # NOTE This is called from whichever thread committed
+        if session.info.pop("outbox", False) and self._wake is not None:
+            assert self._loop is not None
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _drain_forever(self) -> None:
+        assert self._wake is not None
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            try:
+                await loop.run_in_executor(None, self.drain)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log(logging.ERROR, f"Could not drain the outbox: {e!r}")
+
+    async def start(self, _app: Application) -> None:
+        """Start draining the outbox in the background (an on_startup signal handler)."""
+        self._loop = asyncio.get_event_loop()
+        self._wake = asyncio.Event()
+        self._wake.set()
+        self._drainer = asyncio.ensure_future(self._drain_forever())
+
+    async def stop(self, _app: Application) -> None:
+        """Stop draining the outbox (an on_cleanup signal handler)."""
+        if self._drainer is not None:
+            self._drainer.cancel()
+            try:
+                await self._drainer
+            except asyncio.CancelledError:
+                pass
+            self._drainer = None
+        self._wake = None
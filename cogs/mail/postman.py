@@ -19,20 +19,23 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
-import atexit
-from smtplib import SMTP
-from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from email.utils import parseaddr
 from os import PathLike
-from typing import Collection, Dict, NamedTuple, Optional, Sequence, Sized, Union
+from typing import Callable, Collection, Dict, Iterable, List, NamedTuple, Optional, Sequence, Sized, Tuple, Union
 
 import inflect
-from jinja2 import FileSystemLoader, Environment, Template
+from jinja2 import BytecodeCache, FileSystemBytecodeCache, FileSystemLoader, Environment, Template
 
 from cogs.common import logging
 from cogs.db.interface import Database
 from cogs.db.models import User
 from .constants import SIGNATURE
+from .attachments import Attachment, AttachmentProvider
+from .delivery import DeliveryEngine
 from .message import TemplatedEMail
+from .outbox import Outbox
 
 
 def to_ordinal(value) -> str:
@@ -76,27 +79,49 @@ def plural_noun(noun: str, n: Union[int, Sized]) -> str:
     return inflect.engine().plural_noun(noun, n)
 
 
-class _Server(NamedTuple):
-    """SMTP server connection details."""
-    host: str
-    port: int
-    timeout: int
+class _CompiledTemplate(NamedTuple):
+    """An e-mail template from the database, compiled."""
+    version: int
+    subject: Template
+    body: Template
+    checked: float  # When the version was last checked (monotonic time)
 
 
 class Postman(logging.LogWriter):
     """E-mail sender."""
 
     _database: Database
-    _server: _Server
+    outbox: Outbox
+    _compiled: Dict[str, _CompiledTemplate]
+    _revalidate_after: float
     _sender: str
     _templates: Dict[str, Template]
-    _threadpool: ThreadPoolExecutor
     environment: Environment
 
-    def __init__(self, database: Database, host: str, port: int, timeout: int, sender: str, bcc: str, url: str) -> None:
+    def __init__(self, database: Database, host: str, port: int, timeout: int, sender: str, bcc: str, url: str, delivery: Optional[Dict] = None, outbox: Optional[Dict] = None, template_cache: Optional[Dict] = None, attachments: Optional[Dict] = None) -> None:
+        """
+        Constructor: the delivery, outbox and attachment settings (see
+        DeliveryEngine, Outbox and AttachmentProvider) are optional, and
+        override the defaults.
+
+        The template cache settings are also optional: how long (in
+        seconds) a compiled database template is used before checking
+        that it's still current ("revalidate_after") and, if set, a
+        directory in which to cache templates' bytecode across restarts
+        ("bytecode_directory").
+        """
         self._database = database
 
-        self._server = _Server(host, port, timeout)
+        template_cache = template_cache or {}
+        self._compiled = {}
+        self._revalidate_after = float(template_cache.get("revalidate_after", 60))
+        bytecode_cache: Optional[BytecodeCache] = None
+        if template_cache.get("bytecode_directory"):
+            bytecode_cache = FileSystemBytecodeCache(template_cache["bytecode_directory"])
+
+        domain = parseaddr(sender)[1].rpartition("@")[2] or "localhost"
+        delivery_engine = DeliveryEngine(host, port, timeout, attachments=AttachmentProvider(**(attachments or {})), **(delivery or {}))
+        self.outbox = Outbox(database, delivery_engine, domain, **(outbox or {}))
         self._sender = sender
         self._bcc = bcc
         self._url = url
@@ -104,7 +129,7 @@ class Postman(logging.LogWriter):
 
         # Load the filesystem e-mail templates into memory
         fs_loader = FileSystemLoader("cogs/mail/templates")
-        self.environment = Environment(loader=fs_loader)
+        self.environment = Environment(loader=fs_loader, bytecode_cache=bytecode_cache)
         self.environment.filters["ordinal"] = to_ordinal
         self.environment.filters["st"] = to_ordinal
         self.environment.filters["nd"] = to_ordinal
@@ -119,57 +144,101 @@ class Postman(logging.LogWriter):
             for template in fs_loader.list_templates()
         }
 
-        # We use a threadpool, rather than asyncio
-        self._threadpool = ThreadPoolExecutor()
-        # TODO: does this actually do anything useful? (related to #18?)
-        atexit.register(self._threadpool.shutdown)
+    def _compile(self, name: str, source: str) -> Template:
+        """Compile a template, via the bytecode cache, if there is one."""
+        bytecode_cache = self.environment.bytecode_cache
+        if bytecode_cache is None:
+            return self.environment.from_string(source)
+
+        # This is what Jinja2 does for templates from its loaders
+        bucket = bytecode_cache.get_bucket(self.environment, name, None, source)
+        if bucket.code is None:
+            bucket.code = self.environment.compile(source, name)
+            bytecode_cache.set_bucket(bucket)
+        return self.environment.template_class.from_code(
+            self.environment, bucket.code, self.environment.make_globals(None))
+
+    def _compiled_template(self, template: str) -> Optional[_CompiledTemplate]:
+        """Get a template from the database, compiled.
+
+        Compiled templates are cached, and only recompiled when their
+        version changes; the version is only checked (which costs a
+        query) once the cached template is revalidate_after seconds old,
+        or if the template has been invalidated (see invalidate()).
+        """
+        compiled = self._compiled.get(template)
+        now = time.monotonic()
+        if compiled is not None and now - compiled.checked < self._revalidate_after:
+            return compiled
 
-    def _email_from_db_template(self, template: str) -> Optional[TemplatedEMail]:
-        """Create an e-mail based on a template from the database."""
         email_template = self._database.get_template_by_name(template)
         if email_template is None:
+            self._compiled.pop(template, None)
             return None
 
-        assert email_template.subject is not None
-        assert email_template.content is not None
-        subject_template = self.environment.from_string(email_template.subject)
-        body_template = self.environment.from_string(email_template.content)
+        if compiled is not None and compiled.version == email_template.version:
+            compiled = compiled._replace(checked=now)
+        else:
+            self.log(logging.DEBUG, f"Compiling e-mail template \"{template}\" (version {email_template.version})")
+            assert email_template.subject is not None
+            assert email_template.content is not None
+            compiled = _CompiledTemplate(version=email_template.version,
+                                         subject=self._compile(f"{template}:subject", email_template.subject),
+                                         body=self._compile(f"{template}:content", email_template.content),
+                                         checked=now)
+
+        # NOTE Concurrent senders may both compile the template; that's
+        # harmless, as they'll compile the same thing
+        self._compiled[template] = compiled
+        return compiled
+
+    def invalidate(self, template: str) -> None:
+        """Discard the compiled template, e.g., because it's been edited."""
+        self._compiled.pop(template, None)
+
+    def _resolve(self, template: str) -> Tuple[Template, Template]:
+        """Get the subject and body templates with the given name."""
+        compiled = self._compiled_template(template)
+        if compiled is None:
+            # Mail isn't in the DB -- should never happen
+            self.log(logging.WARNING, "Template {} not found in DB".format(template))
+            return (self._templates[f"{template}_subject.jinja2"],
+                    self._templates[f"{template}_contents.jinja2"])
 
-        return TemplatedEMail(subject_template, body_template, self._signature)
+        return compiled.subject, compiled.body
 
-    def send(self, user: Union[User, Collection[User]], template: str, *attachments: Union[str, PathLike], **context) -> None:
-        """Prepare an e-mail from a template and context, then send it.
+    def _attachment(self, attachment: Union[str, PathLike, Attachment]) -> Attachment:
+        """
+        Normalise an attachment, making its link (if it's relative to
+        the web service) absolute
+        """
+        if not isinstance(attachment, Attachment):
+            return Attachment(os.fspath(attachment))
+        if attachment.link is not None and attachment.link.startswith("/"):
+            return attachment._replace(link=self._url + attachment.link)
+        return attachment
 
-        If multiple users are passed in the first argument, all users
-        but the first will be CC'd (the first will be used in the To:
-        header).
+    def _prepare(self, templates: Tuple[Template, Template], user: Union[User, Collection[User]], attachments: Sequence[Attachment], context: Dict) -> Optional[TemplatedEMail]:
+        """
+        Prepare and render an e-mail to the user(s), returning None if
+        there's no-one to send it to
         """
         if not isinstance(user, User):
             try:
                 user, *cc_users = user
             except ValueError:
-                self.log(logging.ERROR, f"No users to email for {template!r}, not sending mail")
-                return
+                self.log(logging.ERROR, "No users to email, not sending mail")
+                return None
         else:
             cc_users = []
 
-        self.log(logging.DEBUG, f"Preparing e-mail from \"{template}\" template for {user.best_email}")
-
-        mail = self._email_from_db_template(template)
-        if mail is None:
-            # Mail isn't in the DB -- should never happen
-            self.log(logging.WARNING, "Template {} not found in DB".format(template))
-            mail = TemplatedEMail(
-                self._templates[f"{template}_subject.jinja2"],
-                self._templates[f"{template}_contents.jinja2"],
-                self._signature,
-            )
-
-        mail.sender = self._sender
         recipient = user.best_email
         if recipient is None:
             self.log(logging.WARNING, f"No address for user {user.id}, not sending mail")
-            return
+            return None
+
+        mail = TemplatedEMail(*templates, self._signature)
+        mail.sender = self._sender
         mail.recipient = recipient
         mail.cc = ", ".join(u.best_email for u in cc_users if u.best_email is not None) or None
         mail.bcc = self._bcc
@@ -182,17 +251,92 @@ class Postman(logging.LogWriter):
             mail.set_context(k, v)
         mail.set_context("web_service", self._url)
 
-        self._threadpool.submit(self._send_mail, mail).add_done_callback(self._on_done)
+        # The templates must be rendered here, rather than when the
+        # e-mail is sent, as they may need to use the caller's database
+        # session (and the models in the context won't be around then)
+        mail.render_templates()
+        return mail
 
-    def _send_mail(self, mail: TemplatedEMail) -> None:
-        """Render the prepared e-mail and send it."""
-        with SMTP(**self._server._asdict()) as smtp:
-            self.log(logging.DEBUG, f"Sending e-mail to {mail.recipient}")
-            smtp.send_message(mail.render())
+    def send(self, user: Union[User, Collection[User]], template: str, *attachments: Union[str, PathLike, Attachment], idempotency_key: Optional[str] = None, **context) -> None:
+        """Prepare an e-mail from a template and context, then send it.
 
-    def _on_done(self, future):
-        # Propagate exceptions to main thread
-        future.result()
+        If multiple users are passed in the first argument, all users
+        but the first will be CC'd (the first will be used in the To:
+        header). Attachments are filenames, or Attachments, whose links
+        may be relative to the web service (e.g., "/projects/1/download").
+
+        The e-mail is put in the outbox, in the current database session,
+        so it's only sent once that session is committed (see Outbox);
+        if an idempotency key is given, and there's already an e-mail
+        with that key in the outbox, this does nothing.
+
+        NOTE This queries the database, so request handlers should run it
+        on the database thread pool, rather than on the event loop
+        """
+        self.log(logging.DEBUG, f"Preparing e-mail from \"{template}\" template")
+
+        mail = self._prepare(self._resolve(template), user, [self._attachment(a) for a in attachments], context)
+        if mail is not None:
+            self.outbox.enqueue(mail, idempotency_key)
+
+    def send_bulk(self, users: Iterable[Union[User, Collection[User]]], template: str, *attachments: Union[str, PathLike, Attachment], per_user_context: Optional[Callable[[User], Dict]] = None, idempotency_key: Optional[str] = None, **context) -> List[Tuple[Optional[User], str]]:
+        """Prepare an e-mail from the same template for each user, then send them.
+
+        This is equivalent to calling send() for each user (or each
+        collection of users, to CC all but the first), except that the
+        template is only resolved once, and the outbox is only checked
+        for duplicates once. Each e-mail's context is the shared context,
+        plus whatever per_user_context returns for its user; if an
+        idempotency key is given, each e-mail's key is that key with the
+        user's ID appended.
+
+        This returns the status of each user's e-mail, in order: one of
+        "queued", "duplicate", "no address" or "failed" (if it couldn't
+        be rendered; this doesn't stop the others from being sent).
+
+        NOTE Mailings can be large, so request handlers should run this
+        on the database thread pool, rather than on the event loop. The
+        e-mails are rendered one after another, in the calling thread,
+        because rendering can load models through the caller's database
+        session, which can't be shared with other threads.
+        """
+        templates = self._resolve(template)
+        resolved = [self._attachment(a) for a in attachments]
+
+        statuses: List[Tuple[Optional[User], str]] = []
+        prepared: List[Tuple[int, TemplatedEMail, Optional[str]]] = []
+        for user in users:
+            first: Optional[User]
+            if isinstance(user, User):
+                first = user
+            else:
+                first = next(iter(user), None)
+            if first is None:
+                statuses.append((first, "no address"))
+                continue
+
+            try:
+                user_context = {**context, **per_user_context(first)} if per_user_context else context
+                mail = self._prepare(templates, user, resolved, user_context)
+            except Exception as e:
+                self.log(logging.ERROR, f"Could not prepare \"{template}\" e-mail for user {first.id}: {e!r}")
+                statuses.append((first, "failed"))
+                continue
+
+            if mail is None:
+                statuses.append((first, "no address"))
+            else:
+                key = idempotency_key and f"{idempotency_key}-{first.id}"
+                prepared.append((len(statuses), mail, key))
+                statuses.append((first, "queued"))
+
+        enqueued = self.outbox.enqueue_all([(mail, key) for _, mail, key in prepared])
+        for (index, _, _), queued in zip(prepared, enqueued):
+            if not queued:
+                statuses[index] = (statuses[index][0], "duplicate")
+
+        self.log(logging.INFO, f"Queued {sum(enqueued)} of {len(statuses)} \"{template}\" e-mails")
+        return statuses
 
 
 def get_filesystem_templates(exclude=[]):
@@ -28,11 +28,14 @@ from signal import SIGINT, SIGTERM
 from aiohttp import web
 
 from cogs.mail import Postman
+from cogs.db.asynchronous import AsyncDatabase
 from cogs.db.interface import Database
+from cogs.export import ExportCache
 
 from cogs import __version__, auth, config, routes
 from cogs.common import logging
-from cogs.file_handler import FileHandler
+from cogs.db import middleware as session_middleware
+from cogs.file_handler import FileHandler, create_storage
 from cogs.scheduler.scheduler import Scheduler
 
 
@@ -58,20 +61,41 @@ if __name__ == "__main__":
     loop = asyncio.SelectorEventLoop(selector)  # type: ignore
     asyncio.set_event_loop(loop)
 
-    app = web.Application(logger=logger, middlewares=[auth.middleware])
+    # NOTE The database session middleware must come first, so that
+    # authentication happens within the request's session
+    app = web.Application(logger=logger, middlewares=[session_middleware, auth.middleware, routes.middleware])
 
     app["config"] = c
-    app["db"] = db = Database(c["database"])
-    app["mailer"] = mail = Postman(database=db, sender=c["email"]["sender"], bcc=c["email"]["bcc"], url=c["webserver"]["service"], **c["email"]["smtp"])
-    app["file_handler"] = file_handler = FileHandler(c["general"]["upload_directory"], int(c["general"]["max_filesize"]))
-
-    app["scheduler"] = scheduler = Scheduler(db, mail, file_handler)
+    app["pretty_json"] = bool(c["webserver"].get("pretty_json", False))
+    database = Database(c["database"])
+    app["db"] = db = AsyncDatabase(database, int(c["database"].get("threads", 10)))
+    app["mailer"] = mail = Postman(database=database, sender=c["email"]["sender"], bcc=c["email"]["bcc"], url=c["webserver"]["service"], delivery=c["email"].get("delivery"), outbox=c["email"].get("outbox"), template_cache=c["email"].get("template_cache"), attachments=c["email"].get("attachments"), **c["email"]["smtp"])
+    app.on_startup.append(mail.outbox.start)
+    app.on_cleanup.append(mail.outbox.stop)
+    storage = create_storage(c["general"]["upload_directory"], c["general"].get("storage", {}))
+    app["file_handler"] = file_handler = FileHandler(c["general"]["upload_directory"], int(c["general"]["max_filesize"]), storage)
+
+    export_cache = c["general"].get("export_cache", {})
+    app["exports"] = exports = ExportCache(
+        db, os.path.join(c["general"]["upload_directory"], "exports"),
+        f"{c['webserver']['service']}/projects/{{}}/download",
+        max_entries=int(export_cache.get("max_entries", 20)),
+        max_size=int(export_cache.get("max_size", 100 * 1024 * 1024)),
+        refresh_interval=float(export_cache.get("refresh_interval", 300)),
+        grace=float(export_cache.get("grace", 60)))
+    app.on_startup.append(exports.start)
+    app.on_cleanup.append(exports.stop)
+
+    scheduler_config = c.get("scheduler") or {}
+    app["scheduler"] = scheduler = Scheduler(database, mail, file_handler, executor=scheduler_config.get("executor"), election=scheduler_config.get("election"))
+    app.on_startup.append(scheduler.election.start)
+    app.on_cleanup.append(scheduler.election.stop)
 
     if "reset_db" in sys.argv:
         # NOTE For debugging purposes only!
         logger.warning("Removing all previously scheduled jobs and clearing database.")
         scheduler.reset_all()
-        db.reset_all()
+        database.reset_all()
 
     if c["pagesmith_auth"]["enabled"]:
         from cogs.auth.pagesmith import PagesmithAuthenticator
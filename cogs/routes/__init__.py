@@ -1,2 +1,3 @@
 # This is purely for nicer imports in main
-from ._setup import setup
\ No newline at end of file
+from ._middleware import responses as middleware
+from ._setup import setup
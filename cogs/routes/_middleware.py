@@ -0,0 +1,107 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import zlib
+from typing import Callable, Dict, Optional
+
+from aiohttp import hdrs
+from aiohttp.web import HTTPNotModified, Request, Response, StreamResponse, middleware
+
+from cogs.common.types import Handler
+from .api._format import CONTENT_CODINGS, coded_etag, get_query_flag, matching_etag, pretty_json
+
+
+# Bodies smaller than this many bytes aren't worth compressing
+COMPRESSION_THRESHOLD = 1024
+
+_COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    "gzip":    lambda body: gzip.compress(body, compresslevel=6),
+    "deflate": lambda body: zlib.compress(body, 6)}
+
+
+def _choose_coding(request: Request) -> Optional[str]:
+    """Choose the preferred content coding the client accepts, if any."""
+    accepted = set()
+    for part in request.headers.get(hdrs.ACCEPT_ENCODING, "").split(","):
+        coding, _, params = part.partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+
+    return next((coding for coding in CONTENT_CODINGS if coding in accepted), None)
+
+
+@middleware
+async def responses(request: Request, handler: Handler) -> StreamResponse:
+    """
+    Response middleware: Thread the preferred JSON formatting through
+    the request, tag successful responses to GET requests with a strong
+    entity tag (responding with 304 Not Modified if it matches the
+    request's If-None-Match header) and compress large responses, if the
+    client accepts that
+
+    Handlers which can compute an entity tag cheaply (see
+    cogs.routes.api._format.entity_tag) should set it themselves, ideally
+    before doing the work of building the response; otherwise it is
+    derived from the body.
+
+    JSON is indented if the "pretty" query parameter is set, or the
+    application's "pretty_json" setting is; otherwise it's compact.
+    """
+    token = pretty_json.set(get_query_flag(request, "pretty") or request.app.get("pretty_json", False))
+    try:
+        response = await handler(request)
+    finally:
+        pretty_json.reset(token)
+
+    if not isinstance(response, Response) or not isinstance(response.body, bytes):
+        return response
+
+    body = response.body
+    coding = _choose_coding(request) if len(body) >= COMPRESSION_THRESHOLD else None
+
+    if request.method in {"GET", "HEAD"} and response.status == 200:
+        etag = response.headers.get(hdrs.ETAG)
+        if etag is None:
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if coding:
+            etag = coded_etag(etag, coding)
+        response.headers[hdrs.ETAG] = etag
+
+        matched = matching_etag(request, etag)
+        if matched:
+            raise HTTPNotModified(headers={hdrs.ETAG: matched})
+
+    if coding:
+        # Compression is CPU-bound, so keep it off the event loop
+        loop = asyncio.get_event_loop()
+        response.body = await loop.run_in_executor(None, _COMPRESSORS[coding], body)
+        response.headers[hdrs.CONTENT_ENCODING] = coding
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+
+    return response
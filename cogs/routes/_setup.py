@@ -39,6 +39,8 @@ def setup(app: Application) -> None:
     app.router.add_get('/api/series/{group_series}', api.series.get)
     app.router.add_get('/api/series/{group_series}/export.xlsx', export_group)
     app.router.add_get('/api/series/{group_series}/{group_part}/remind', api.rotations.remind)
+    app.router.add_get('/api/series/{group_series}/{group_part}/projects', api.rotations.projects)
+    app.router.add_get('/api/series/{group_series}/{group_part}/files.zip', api.rotations.files)
     app.router.add_get('/api/series/{group_series}/{group_part}', api.rotations.get)
     app.router.add_put('/api/series/{group_series}/{group_part}', api.rotations.edit)
 
@@ -66,6 +68,7 @@ def setup(app: Application) -> None:
     app.router.add_put('/api/users/{user_id}', api.users.edit)
 
     app.router.add_get('/api/emails', api.emails.get_all)
+    app.router.add_get('/api/emails/outbox', api.emails.get_outbox)
     app.router.add_get('/api/emails/{email_name}', api.emails.get)
     app.router.add_put('/api/emails/{email_name}', api.emails.edit)
 
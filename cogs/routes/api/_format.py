@@ -1,15 +1,72 @@
-from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Type, TypeVar, Union
+from typing import IO, Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Type, TypeVar, Union
 
-from aiohttp.web import Request, Response
+from aiohttp import hdrs
+from multidict import CIMultiDict
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.web import BaseRequest, HTTPNotModified, Request, Response, StreamResponse
 import aiohttp.web
+import asyncio
+from contextvars import ContextVar
+import hashlib
+import io
 import json
+import os
+import pathlib
 from json.decoder import JSONDecodeError
 
+from typing_extensions import Protocol
+
+# Faster JSON encoders are used for compact output, if available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# Whether JSON responses should be indented, for the benefit of humans;
+# this is set per request by cogs.routes.middleware
+pretty_json: ContextVar[bool] = ContextVar("pretty_json", default=False)
+
+
+def _encode_json(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def _encode_ujson(obj: Any) -> bytes:
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode()
+
+
+def _encode_orjson(obj: Any) -> bytes:
+    # Our link collections are keyed by ID
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+JSON_ENCODERS: Dict[str, Callable[[Any], bytes]] = {"json": _encode_json}
+if ujson is not None:
+    JSON_ENCODERS["ujson"] = _encode_ujson
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = _encode_orjson
+
+# The fastest available encoder
+_encode_compact = JSON_ENCODERS.get("orjson") or JSON_ENCODERS.get("ujson") or _encode_json
+
+
+def encode_json(obj: Any) -> bytes:
+    """Encode an object as JSON, compactly unless pretty_json is set."""
+    if pretty_json.get():
+        return json.dumps(obj, indent=4).encode()
+    return _encode_compact(obj)
+
 
 class HTTPError(aiohttp.web.HTTPError):
     def __init__(self, *, status: int, message: str):
         self.status_code = status
-        super(HTTPError, self).__init__(body=json.dumps({"status_message": message}, indent=4))
+        super(HTTPError, self).__init__(text=encode_json({"status_message": message}).decode())
 
 
 # Since even typing.Mapping is invariant in the key type, there's no good way
@@ -19,8 +76,13 @@ def JSONResonse(*,
                 data: Any = None,
                 items: Any = None,
                 status: int=200,
-                status_message="success") -> Response:
-    """Return a Response containing JSON."""
+                status_message="success",
+                etag: Optional[str] = None) -> Response:
+    """Return a Response containing JSON.
+
+    If no entity tag is given, one is derived from the body (see
+    cogs.routes.middleware).
+    """
     if status == 204:
         # Returning a request body with a 204 (No Content) is invalid and leads
         # to subtle and hard-to-diagnose issues!
@@ -43,13 +105,209 @@ def JSONResonse(*,
         status = 500
     body["status_message"] = status_message
     return Response(status=status,
-                    body=json.dumps(body,
-                                    indent=4))
+                    body=encode_json(body),
+                    content_type="text/plain",
+                    charset="utf-8",
+                    headers={hdrs.ETAG: etag} if etag else None)
+
+
+class _Versioned(Protocol):
+    # A mapped model with the Versioned mixin (see cogs.db.models)
+    __tablename__: str
+    id: int
+    version: int
+
+
+def entity_tag(*models: _Versioned) -> str:
+    """Compute a strong entity tag from the versions of the models.
+
+    This must be given every model which the response's body depends on,
+    including the authenticated user, if what they may see depends on
+    their role.
+    """
+    digest = hashlib.sha1()
+    for model in models:
+        digest.update(f"{model.__tablename__}:{model.id}:{model.version};".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+# Content codings that responses may be compressed with (see
+# cogs.routes.middleware), in order of preference
+CONTENT_CODINGS = ("gzip", "deflate")
+
+
+def coded_etag(etag: str, coding: str) -> str:
+    """
+    Derive the entity tag for a representation in the given content
+    coding; this must differ from that of the uncompressed
+    representation, as strong tags identify the bytes sent
+    """
+    return f'{etag[:-1]}-{coding}"'
+
+
+def matching_etag(request: BaseRequest, etag: str) -> Optional[str]:
+    """
+    Return the tag in the request's If-None-Match header that matches
+    the entity tag, in any content coding, or None if there isn't one
+    """
+    if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+    if if_none_match is None:
+        return None
+
+    # If-None-Match uses weak comparison (RFC 7232, section 3.2)
+    variants = {etag, *(coded_etag(etag, coding) for coding in CONTENT_CODINGS)}
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return etag
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in variants:
+            return tag
+
+    return None
+
+
+def check_not_modified(request: Request, etag: str) -> str:
+    """
+    Respond with 304 Not Modified if the client already has the current
+    version of the resource, otherwise return its entity tag
+    """
+    matched = matching_etag(request, etag)
+    if matched:
+        raise HTTPNotModified(headers={hdrs.ETAG: matched})
+    return etag
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """Compute a strong entity tag for a file, from its size and modification time."""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+class FileResponse(aiohttp.web.FileResponse):
+    """Send a file, with an entity tag.
+
+    aiohttp's FileResponse sends the file with sendfile (i.e., without
+    reading it into memory) and handles Range requests and the date
+    preconditions, but (as of 3.5) knows nothing of entity tags: it
+    doesn't send one, and serves the requested range for an If-Range
+    with an entity tag even if the file has since changed. This fills
+    those gaps, so that interrupted downloads can be resumed safely.
+    """
+
+    _filename: str
+
+    def __init__(self, path: Union[str, pathlib.Path], **kwargs: Any) -> None:
+        super().__init__(path, **kwargs)
+        self._filename = str(path)
+
+    async def prepare(self, request: BaseRequest) -> Optional[AbstractStreamWriter]:
+        stat = os.stat(self._filename)
+        etag = file_etag(stat)
+        self.headers[hdrs.ETAG] = etag
+
+        headers = CIMultiDict(request.headers)
+        if hdrs.IF_NONE_MATCH in headers:
+            matched = matching_etag(request, etag)
+            if matched:
+                self.headers[hdrs.ETAG] = matched
+                self.set_status(HTTPNotModified.status_code)
+                self._length_check = False
+                return await aiohttp.web.StreamResponse.prepare(self, request)
+
+            # If-None-Match takes precedence (RFC 7232, section 6)
+            headers.popall(hdrs.IF_MODIFIED_SINCE, None)
+
+        if_range = headers.get(hdrs.IF_RANGE, "").strip()
+        if if_range.startswith(("\"", "W/")):
+            # If-Range uses strong comparison (RFC 7233, section 3.2); if
+            # the tag doesn't match, the whole file is sent
+            if if_range != etag:
+                headers.popall(hdrs.RANGE, None)
+            headers.popall(hdrs.IF_RANGE)
+
+        if len(headers) != len(request.headers):
+            request = request.clone(headers=headers)
+        return await super().prepare(request)
+
+
+class _QueueWriter(io.RawIOBase):
+    """
+    Unseekable file-like object, for writing from another thread to a
+    queue that's consumed on the event loop; writes block while the
+    queue is full
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> None:
+        super().__init__()
+        self._loop = loop
+        self._queue = queue
+        self.abandoned = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.abandoned:
+            raise ConnectionResetError("The response is no longer being sent")
+        asyncio.run_coroutine_threadsafe(self._queue.put(bytes(data)), self._loop).result()
+        return len(data)
+
+
+# Size of the chunks in which the output of stream_from_thread is sent,
+# and how many of them may be waiting to be sent
+_STREAM_CHUNK_SIZE = 64 * 1024
+_STREAM_QUEUE_SIZE = 16
+
+
+async def stream_from_thread(request: Request, response: StreamResponse, write: Callable[[IO[bytes]], None]) -> StreamResponse:
+    """Send the response, with a body written by a blocking function.
+
+    The function is run in a thread, and is given an (unseekable) file
+    object to write the body to; the body is sent as it is written, and
+    the function is held up while the client catches up, so at most a
+    few chunks of the body are held in memory. If the client goes away,
+    the function's writes raise ConnectionResetError.
+    """
+    loop = asyncio.get_event_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+    writer = _QueueWriter(loop, queue)
+
+    def run() -> None:
+        with io.BufferedWriter(writer, _STREAM_CHUNK_SIZE) as output:
+            write(output)
+
+    producer = loop.run_in_executor(None, run)
+    # The end of the body is marked with None
+    producer.add_done_callback(lambda _: asyncio.ensure_future(queue.put(None)))
+
+    try:
+        await response.prepare(request)
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            await response.write(chunk)
+    except BaseException:
+        # Unblock the producer, which will stop at its next write
+        writer.abandoned = True
+        while not queue.empty():
+            queue.get_nowait()
+        await asyncio.wait([producer])
+        producer.exception()
+        raise
+
+    # Errors after the response has started can't be sent to the
+    # client, but this at least cuts the response short and logs it
+    await producer
+    await response.write_eof()
+    return response
+
 
 T = TypeVar("T")
 
 
-def get_match_info_or_error(request, match_info: Union[str, List[str]], lookup_function: Callable[..., T]) -> T:
+async def get_match_info_or_error(request, match_info: Union[str, List[str]], lookup_function: Callable[..., Awaitable[Optional[T]]]) -> T:
     """Obtain information from the URL, or respond with an error.
 
     This is used to get what aiohttp calls "matches". If you declare a
@@ -58,15 +316,16 @@ def get_match_info_or_error(request, match_info: Union[str, List[str]], lookup_f
         /api/projects/{project_id}/mark
 
     then you can ask for the "project_id" match, and get that part of
-    the URL provided in the request.
+    the URL provided in the request. The lookup function should be one
+    of the asynchronous database interface's methods.
     """
     object_id: Union[int, List[int]]
     if isinstance(match_info, str):
         object_id = match_info_to_id(request, match_info)
-        database_model = lookup_function(object_id)
+        database_model = await lookup_function(object_id)
     else:
         object_id = [match_info_to_id(request, match) for match in match_info]
-        database_model = lookup_function(*object_id)
+        database_model = await lookup_function(*object_id)
 
     if database_model is None:
         raise HTTPError(status=404,
@@ -83,6 +342,39 @@ def match_info_to_id(request: Request, match_info: str) -> int:
                         message=f"{match_info} ({request.match_info[match_info]}) not an integer")
 
 
+def get_query_values(request: Request, name: str) -> Optional[List[str]]:
+    """Get the values of an optional query parameter, or None if absent.
+
+    Values may be given repeatedly (as "name" or "name[]", like
+    get_params() accepts) and/or comma-separated.
+    """
+    query = request.rel_url.query
+    if name not in query and f"{name}[]" not in query:
+        return None
+
+    return [value
+            for values in query.getall(name, []) + query.getall(f"{name}[]", [])
+            for value in values.split(",")
+            if value]
+
+
+def get_query_flag(request: Request, name: str) -> bool:
+    """Is an optional boolean query parameter set (to anything but 0)?"""
+    return request.rel_url.query.get(name, "0").lower() not in {"0", "false", ""}
+
+
+def get_query_int(request: Request, name: str, default: Optional[int] = None) -> Optional[int]:
+    """Get an optional, non-negative integer query parameter."""
+    value = request.rel_url.query.get(name)
+    if value is None:
+        return default
+
+    if not value.isdigit():
+        raise HTTPError(status=400,
+                        message=f"{name} ({value}) not a non-negative integer")
+    return int(value)
+
+
 # TODO: can the types for this be made any better?
 async def get_params(request: Request, params: Dict[str, Type]) -> Any:
     """Get parameters from the request.
@@ -3,7 +3,7 @@ import traceback
 from aiohttp.web import Request, Response
 from jinja2.exceptions import TemplateError
 
-from ._format import JSONResonse, HTTPError, get_params
+from ._format import JSONResonse, HTTPError, check_not_modified, entity_tag, get_params
 
 from cogs.mail import sanitise
 from cogs.security.middleware import permit
@@ -12,25 +12,39 @@ from cogs.security.middleware import permit
 async def get_all(request: Request) -> Response:
     """Get a list of all email templates."""
     db = request.app["db"]
-    emails = db.get_all_templates()
+    emails = await db.get_all_templates()
     return JSONResonse(links={email.name: f"/api/emails/{email.name}" for email in emails},
                        items=[email.serialise() for email in emails])
 
 
+@permit("create_project_groups")
+async def get_outbox(request: Request) -> Response:
+    """Get the depth of the outbox (see Database.get_outbox_depth)."""
+    db = request.app["db"]
+    depth = await db.get_outbox_depth()
+    if depth["oldest_pending"] is not None:
+        depth["oldest_pending"] = depth["oldest_pending"].isoformat()
+    return JSONResonse(links={"parent": "/api/emails"},
+                       data=depth)
+
+
 async def get(request: Request) -> Response:
     """Get a specific email template."""
     db = request.app["db"]
     template_name = request.match_info["email_name"]
 
-    email = db.get_template_by_name(template_name)
+    email = await db.get_template_by_name(template_name)
     if email is None:
         raise HTTPError(
             status=404,
             message="Invalid email template name",
         )
 
+    etag = check_not_modified(request, entity_tag(email))
+
     return JSONResonse(links={"parent": "/api/emails"},
-                       data=email.serialise())
+                       data=email.serialise(),
+                       etag=etag)
 
 
 @permit("create_project_groups")
@@ -85,8 +99,9 @@ Error in email content:
 {err}"""
         return JSONResonse(status=400, status_message=message)
 
-    template = db.get_template_by_name(template_name)
+    template = await db.get_template_by_name(template_name)
     template.subject = template_data.subject
     template.content = sanitise(template_data.content)
-    db.commit()
+    await db.commit()
+    mail.invalidate(template_name)
     return JSONResonse(status=204)
@@ -1,10 +1,12 @@
+import asyncio
+import os.path
 from datetime import date
 from typing import List, Dict, Optional
-from zipfile import ZipFile, BadZipFile
 
-from aiohttp.web import Request, Response
+from aiohttp import BodyPartReader
+from aiohttp.web import Request, Response, StreamResponse
 
-from ._format import JSONResonse, HTTPError, get_match_info_or_error, get_params
+from ._format import FileResponse, JSONResonse, HTTPError, check_not_modified, entity_tag, get_match_info_or_error, get_params
 from cogs.common.constants import GRADES
 from cogs.db.models import Project, ProjectGrade
 from cogs.mail import sanitise
@@ -12,6 +14,10 @@ from cogs.scheduler.constants import SUBMISSION_GRACE_TIME
 from cogs.security.middleware import permit, permit_any
 
 
+# Size of the chunks in which uploads are read and written
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
 def serialise_project_to_json(project, include_mark_ids=False):
     return {
         "links": {
@@ -24,24 +30,28 @@ def serialise_project_to_json(project, include_mark_ids=False):
     }
 
 
-def serialise_project(project, status=200, include_mark_ids=False):
+def serialise_project(project, status=200, include_mark_ids=False, etag=None):
     return JSONResonse(status=status,
+                       etag=etag,
                        **serialise_project_to_json(project, include_mark_ids))
 
 
 async def get(request: Request) -> Response:
     """Get information about a project."""
     db = request.app["db"]
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
 
     user = request["user"]
     if not user.can_view_group(project.group):
         raise HTTPError(status=403,
                         message="Cannot view projects in this rotation")
 
+    etag = check_not_modified(request, entity_tag(project, project.group, user))
+
     return serialise_project(
         project,
-        include_mark_ids=user in {project.supervisor, project.cogs_marker, project.student} or user.role.view_all_submitted_projects
+        include_mark_ids=user in {project.supervisor, project.cogs_marker, project.student} or user.role.view_all_submitted_projects,
+        etag=etag
     )
 
 
@@ -50,7 +60,7 @@ async def create(request: Request) -> Response:
     """Create a new project, in the most recent rotation."""
     db = request.app["db"]
     user = request["user"]
-    group = db.get_most_recent_group()
+    group = await db.get_most_recent_group()
 
     if group.read_only:
         raise HTTPError(status=403,
@@ -81,8 +91,8 @@ async def create(request: Request) -> Response:
 
     student_id = project_data.student
     if student_id is not None:
-        student = db.get_user_by_id(student_id)
-        student_project = db.get_projects_by_student(student, group)
+        student = await db.get_user_by_id(student_id)
+        student_project = await db.get_projects_by_student(student, group)
         if student_project is not None:
             raise HTTPError(
                 status=400,
@@ -115,7 +125,7 @@ async def create(request: Request) -> Response:
         # so the padding on the end will be used instead.
         student.second_option, student.third_option, *_ = choices + [None]*3
 
-    db.commit()
+    await db.commit()
 
     return serialise_project(project, status=201, include_mark_ids=True)
 
@@ -125,7 +135,7 @@ async def edit(request: Request) -> Response:
     """Edit an existing project."""
     db = request.app["db"]
     user = request["user"]
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
     group = project.group
 
     if user != project.supervisor and not user.role.modify_permissions:
@@ -162,8 +172,8 @@ async def edit(request: Request) -> Response:
             message="Cannot reassign students once projects are finalised",
         )
     if student_id is not None:
-        student = db.get_user_by_id(student_id)
-        student_project = db.get_projects_by_student(student, group)
+        student = await db.get_user_by_id(student_id)
+        student_project = await db.get_projects_by_student(student, group)
         if student_project is not None and project != student_project:
             raise HTTPError(
                 status=403,
@@ -191,7 +201,7 @@ async def edit(request: Request) -> Response:
         # so the padding on the end will be used instead.
         student.second_option, student.third_option, *_ = choices + [None]*3
 
-    db.commit()
+    await db.commit()
     return serialise_project(project, include_mark_ids=True)
 
 
@@ -200,7 +210,7 @@ async def delete(request: Request) -> Response:
     """Delete a project."""
     db = request.app["db"]
     user = request["user"]
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
 
     if user != project.supervisor and not user.role.modify_permissions:
         raise HTTPError(status=403,
@@ -211,8 +221,8 @@ async def delete(request: Request) -> Response:
             message="This rotation is now read-only"
         )
 
-    db.session.delete(project)
-    db.commit()
+    await db.delete(project)
+    await db.commit()
     return JSONResonse(status=204)
 
 
@@ -221,7 +231,7 @@ async def mark(request: Request) -> Response:
     db = request.app["db"]
     user = request["user"]
     mail = request.app["mailer"]
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
 
     if user not in (project.supervisor, project.cogs_marker) and not user.role.modify_permissions:
         raise HTTPError(status=403,
@@ -240,7 +250,7 @@ async def mark(request: Request) -> Response:
     })
 
     marker_id = grade_data.marker
-    marker = db.get_user_by_id(marker_id)
+    marker = await db.get_user_by_id(marker_id)
     if (
         user in (project.supervisor, project.cogs_marker)
         and not user.role.modify_permissions
@@ -275,28 +285,24 @@ async def mark(request: Request) -> Response:
                          general_feedback=sanitise(grade_data.general_feedback))
 
     db.add(grade)
-    db.session.flush()
+    await db.flush()
 
     if marker == project.supervisor:
         project.supervisor_feedback_id = grade.id
     elif marker == project.cogs_marker:
         project.cogs_feedback_id = grade.id
     else:
-        # XXX FIXME: the session should not be shared between requests! This is
-        # unsound in the case that another request has added something to the
-        # session but not comitted it yet -- their new data will be lost.
-        # Alternatively, someone else could commit the session before we have a
-        # chance to roll it back, meaning that the invalid ProjectGrade we've
-        # just created is persisted when it shouldn't be.
-        db.session.rollback()
+        # The session belongs to this request alone, so this only
+        # discards the invalid ProjectGrade we've just created.
+        await db.rollback()
         raise HTTPError(
             status=403,
             message="Only the assigned supervisor and CoGS member can submit feedback",
         )
 
-    db.commit()
-
-    mail.send(project.student, "feedback_given", project=project, grade=grade, marker=marker)
+    await db.run(mail.send, project.student, "feedback_given", project=project, grade=grade, marker=marker,
+                 idempotency_key=f"feedback_given-{grade.id}")
+    await db.commit()
 
     return serialise_project(project, include_mark_ids=True)
 
@@ -305,7 +311,7 @@ async def get_marks(request: Request) -> Response:
     """Get the marks for a project from both users."""
     db = request.app["db"]
     user = request["user"]
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
 
     if user not in (project.supervisor, project.cogs_marker, project.student) and not user.role.view_all_submitted_projects:
         raise HTTPError(status=403,
@@ -323,10 +329,10 @@ async def set_cogs(request: Request) -> Response:
     project_data = await get_params(request, {"projects": Dict[str, Optional[int]]})
 
     for project_id, cogs_member_id in project_data.projects.items():
-        project = db.get_project_by_id(int(project_id))
+        project = await db.get_project_by_id(int(project_id))
         project.cogs_marker_id = cogs_member_id
 
-    db.commit()
+    await db.commit()
 
     return JSONResonse(links={},
                        data={})
@@ -340,7 +346,7 @@ async def upload(request: Request) -> Response:
     scheduler = request.app["scheduler"]
     user = request["user"]
 
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
 
     if user != project.student and not user.role.modify_permissions:
         return JSONResonse(
@@ -353,20 +359,36 @@ async def upload(request: Request) -> Response:
             status_message="Grace time exceeded"
         )
 
-    current_size = 0
-    max_size = file_handler.get_max_filesize()
-    with file_handler.get_project(project, mode="wb") as project_file:
+    # The upload is streamed into a new file, off the event loop, which
+    # only replaces the existing report once it's complete
+    loop = asyncio.get_event_loop()
+    upload = await loop.run_in_executor(None, file_handler.upload_project, project)
+    committed = False
+    try:
+        current_size = 0
+        max_size = file_handler.get_max_filesize()
         reader = await request.multipart()
         while True:
             part = await reader.next()
             if part is None:
                 break
-            data = await part.read()
-            current_size += len(data)
-            if current_size > max_size:
-                return JSONResonse(status=400,
-                                   status_message="File too large. (Previous file possibly partially overwritten)")
-            project_file.write(data)
+            # The upload form has no nested multipart bodies
+            assert isinstance(part, BodyPartReader)
+            while True:
+                chunk = await part.read_chunk(_UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                current_size += len(chunk)
+                if current_size > max_size:
+                    return JSONResonse(status=400,
+                                       status_message="File too large")
+                await loop.run_in_executor(None, upload.write, chunk)
+
+        manifest = await loop.run_in_executor(None, upload.commit)
+        committed = True
+    finally:
+        if not committed:
+            await loop.run_in_executor(None, upload.abort)
 
     if not project.uploaded:
         project.uploaded = True
@@ -381,39 +403,29 @@ async def upload(request: Request) -> Response:
             # TODO: what to do here? For now, just schedule the deadline ASAP.
             grace_date = today
 
-        scheduler.schedule_user_deadline(grace_date,
-                                         "grace_deadline",
-                                         f"project={project.id}",
-                                         project_id=project.id)
+        # The grace period is closed by the scheduler's sweeper, at the
+        # time that a deadline job on that date would have run
+        project.grace_deadline = scheduler.fix_time(grace_date)
+
         # Email grad office if no CoGS marker
         if project.cogs_marker is None:
-            for grad_office_user in db.get_users_by_permission("create_project_groups"):
-                mail.send(grad_office_user,
-                          "cogs_not_found",
-                          project=project)
-    db.commit()
-
-    # Same code as upload_information to get the file names. These are sent in response so they can be displayed on the frontend. 
-
-    with file_handler.get_project(project, "rb") as project_file:
-        try:
-            with ZipFile(project_file) as project_zip:
-                file_names = project_zip.namelist()
-        except BadZipFile:
-            file_names = []
+            grad_office_users = await db.get_users_by_permission("create_project_groups")
+            await db.run(mail.send_bulk, grad_office_users, "cogs_not_found", project=project)
+    await db.commit()
 
+    # The file names are sent in response so they can be displayed on the frontend
     # TODO: return upload_information here!
-    return JSONResonse(status=200, data={"file_names": file_names})
+    return JSONResonse(status=200, data={"file_names": [file["name"] for file in manifest["files"]]})
 
 
-async def download(request: Request) -> Response:
+async def download(request: Request) -> StreamResponse:
     """Download a project."""
 
     db = request.app["db"]
     user = request["user"]
     file_handler = request.app["file_handler"]
 
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
 
     if not project.uploaded:
         return JSONResonse(
@@ -421,19 +433,21 @@ async def download(request: Request) -> Response:
             status_message="Project not yet uploaded"
         )
 
-    if user in (project.student, project.cogs_marker, project.supervisor) or user.role.view_all_submitted_projects:
+    if user.can_download_report(project):
         save_name = f"{project.student.name}_{project.group.series}_{project.group.part}.zip"
-        try:
-            with file_handler.get_project(project, "rb") as project_file:
-                return Response(status=200,
-                                headers={"Content-Disposition": f'inline; filename="{save_name}"',
-                                         "Content-Type": "application/zip"},
-                                body=project_file.read())
-        except FileNotFoundError:
+        loop = asyncio.get_event_loop()
+        filename = await loop.run_in_executor(None, file_handler.get_filename_for_project, project)
+        if not await loop.run_in_executor(None, os.path.isfile, filename):
             return JSONResonse(
                 status=500,
                 status_message="Project not found on server - internal error"
             )
+
+        # Sent straight from the file, which also takes care of
+        # conditional and Range requests (i.e., resumed downloads)
+        return FileResponse(filename,
+                            headers={"Content-Disposition": f'inline; filename="{save_name}"',
+                                     "Content-Type": "application/zip"})
     return JSONResonse(
         status=403,
         status_message="Not authorised to download project"
@@ -446,10 +460,9 @@ async def upload_information(request: Request) -> Response:
     This information includes the project's grace period and filenames.
     """
     db = request.app["db"]
-    scheduler = request.app["scheduler"]
     file_handler = request.app["file_handler"]
 
-    project = get_match_info_or_error(request, "project_id", db.get_project_by_id)
+    project = await get_match_info_or_error(request, "project_id", db.get_project_by_id)
 
     if not project.uploaded:
         return JSONResonse(
@@ -457,21 +470,23 @@ async def upload_information(request: Request) -> Response:
             status_message="Project not yet uploaded"
         )
 
-    # TODO: this should use some constant somewhere instead of
-    # hard-coding the project ID format in two places!
-    job = scheduler.get_job(f"grace_deadline_project={project.id}")
     grace_time = None
-    if job:
-        grace_time = job.next_run_time.strftime('%Y-%m-%d %H:%M')
-
-    with file_handler.get_project(project, "rb") as project_file:
-        try:
-            with ZipFile(project_file) as project_zip:
-                file_names = project_zip.namelist()
-        except BadZipFile:
-            file_names = []
+    if not project.grace_passed and project.grace_deadline is not None:
+        grace_time = project.grace_deadline.strftime('%Y-%m-%d %H:%M')
+
+    # The report's contents are summarised in its manifest, rather than
+    # reopening the archive every time this is polled
+    loop = asyncio.get_event_loop()
+    manifest = await loop.run_in_executor(None, file_handler.get_manifest, project)
+    if manifest is None:
+        return JSONResonse(
+            status=500,
+            status_message="Project not found on server - internal error"
+        )
 
     return JSONResonse(data={
         "grace_time": grace_time,
-        "file_names": file_names
+        "file_names": [file["name"] for file in manifest["files"]],
+        "uncompressed_size": manifest["uncompressed_size"],
+        "sha256": manifest["sha256"]
     })
@@ -1,11 +1,13 @@
-from aiohttp.web import Request, Response, HTTPTemporaryRedirect
+from aiohttp.web import Request, Response, HTTPTemporaryRedirect, StreamResponse
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Optional
 
-from ._format import JSONResonse, get_match_info_or_error, match_info_to_id, get_params, HTTPError
+from ._format import JSONResonse, check_not_modified, entity_tag, get_match_info_or_error, match_info_to_id, get_params, HTTPError, stream_from_thread
+from .projects import serialise_project_to_json
 from cogs.common.constants import DEADLINE_CHANGE_NOTIFICATIONS
 from cogs.scheduler.constants import GROUP_DEADLINES
-from cogs.db.models import ProjectGroup
+from cogs.db.models import ProjectGroup, User
+from cogs.file_handler import write_archive
 
 from cogs.security.middleware import permit
 
@@ -14,7 +16,7 @@ async def get_all(request: Request) -> Response:
     """Get information about all rotations."""
     db = request.app["db"]
     rotations = {f"{rotation.series}-{rotation.part}": f"/api/series/{rotation.series}/{rotation.part}"
-                 for rotation in db.get_all_series()}
+                 for rotation in await db.get_all_series()}
     return JSONResonse(links=rotations)
 
 
@@ -22,24 +24,116 @@ async def get(request: Request) -> Response:
     """Get information about a specific rotation."""
     db = request.app["db"]
 
-    rotation = get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
+    rotation = await get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
     year = match_info_to_id(request, "group_series")
 
     user = request["user"]
-    if user.can_view_group(rotation):
-        projects = [f"/api/projects/{project.id}" for project in rotation.projects]
-    else:
-        projects = []
+    visible_projects = rotation.projects if user.can_view_group(rotation) else []
+    etag = check_not_modified(request, entity_tag(rotation, user, *visible_projects))
 
     return JSONResonse(links={"parent": f"/api/series/{year}",
-                              "projects": projects},
-                       data=rotation.serialise())
+                              "projects": [f"/api/projects/{project.id}" for project in visible_projects]},
+                       data=rotation.serialise(),
+                       etag=etag)
+
+
+def _summarise_user(user: Optional[User]) -> Optional[Dict]:
+    """Summarise a user, for embedding in a serialised project."""
+    if user is None:
+        return None
+    return {"id": user.id, "name": user.name}
+
+
+async def projects(request: Request) -> Response:
+    """Get all the projects in a specific rotation.
+
+    Each project is serialised as it would be individually, along with
+    summaries of the people involved in it.
+    """
+    db = request.app["db"]
+
+    rotation = await get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
+
+    user = request["user"]
+    visible_projects = await db.get_projects_by_group(rotation) if user.can_view_group(rotation) else []
+    etag = check_not_modified(request, entity_tag(rotation, user, *(
+        model
+        for project in visible_projects
+        for model in (project, project.supervisor, project.cogs_marker, project.student)
+        if model is not None)))
+
+    items = []
+    if visible_projects:
+        view_all_marks = user.role.view_all_submitted_projects
+
+        for project in visible_projects:
+            include_mark_ids = view_all_marks or user in {project.supervisor, project.cogs_marker, project.student}
+            serialised = serialise_project_to_json(project, include_mark_ids)
+            serialised["people"] = {"supervisor": _summarise_user(project.supervisor),
+                                    "cogs_marker": _summarise_user(project.cogs_marker),
+                                    "student": _summarise_user(project.student)}
+            items.append(serialised)
+
+    return JSONResonse(links={"parent": f"/api/series/{rotation.series}/{rotation.part}"},
+                       items=items,
+                       etag=etag)
+
+
+async def files(request: Request) -> StreamResponse:
+    """Download the reports for a specific rotation, as a ZIP archive.
+
+    This includes every uploaded report the user could download
+    individually or, with the "marker" parameter (a user ID, or "me"),
+    only those of the projects that user supervises or CoGS-marks. The
+    archive is streamed as it's put together.
+    """
+    db = request.app["db"]
+    file_handler = request.app["file_handler"]
+
+    rotation = await get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
+
+    user = request["user"]
+    projects = [project for project in await db.get_projects_by_group(rotation)
+                if project.uploaded and project.student is not None and user.can_download_report(project)]
+
+    marker = request.rel_url.query.get("marker")
+    if marker is not None:
+        if marker == "me":
+            marker_id = user.id
+        elif marker.isdigit():
+            marker_id = int(marker)
+        else:
+            raise HTTPError(status=400,
+                            message=f"marker ({marker}) not a user ID")
+        projects = [project for project in projects
+                    if marker_id in (project.supervisor_id, project.cogs_marker_id)]
+
+    # Reports are named as they are when downloaded individually, as
+    # far as that's unambiguous
+    names = set()
+    reports = []
+    for project in projects:
+        name = f"{project.student.name}_{rotation.series}_{rotation.part}".replace("/", "_")
+        if name in names:
+            name = f"{name}_{project.id}"
+        names.add(name)
+        reports.append((f"{name}.zip", project))
+
+    def write(output):
+        # Finding the files may block, so is also done in the thread
+        write_archive(((name, file_handler.get_filename_for_project(project))
+                       for name, project in reports), output)
+
+    response = StreamResponse(headers={
+        "Content-Disposition": f'attachment; filename="reports_{rotation.series}_{rotation.part}.zip"',
+        "Content-Type": "application/zip"})
+    return await stream_from_thread(request, response, write)
 
 
 async def latest(request: Request) -> Response:
     """Redirect to the latest rotation."""
     db = request.app["db"]
-    latest = db.get_most_recent_group()
+    latest = await db.get_most_recent_group()
     return HTTPTemporaryRedirect(f"/api/series/{latest.series}/{latest.part}")
 
 
@@ -67,7 +161,7 @@ async def create(request: Request) -> Response:
         raise HTTPError(status=400,
                         message="Not all deadlines follow YYYY-MM-DD format")
 
-    old_group = db.get_project_group(rotation_data.series, rotation_data.part)
+    old_group = await db.get_project_group(rotation_data.series, rotation_data.part)
     if old_group:
         raise HTTPError(status=400,
                         message="Cannot create a rotation with the same series and part as an existing rotation")
@@ -85,14 +179,13 @@ async def create(request: Request) -> Response:
     )
 
     db.add(rotation)
-    db.commit()
+    await db.flush()
+
+    supervisors = await db.get_users_by_permission("create_projects")
+    await db.run(mail.send_bulk, supervisors, "supervisor_invite", rotation=rotation)
 
-    for supervisor in db.get_users_by_permission("create_projects"):
-        mail.send(
-            supervisor,
-            f"supervisor_invite",
-            rotation=rotation,
-        )
+    # The invitations are sent along with the rotation (see Outbox)
+    await db.commit()
 
     for deadline in deadlines:
         scheduler.schedule_deadline(deadlines[deadline], deadline, rotation)
@@ -107,7 +200,7 @@ async def edit(request: Request) -> Response:
     mail = request.app["mailer"]
     scheduler = request.app["scheduler"]
 
-    rotation = get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
+    rotation = await get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
 
     rotation_data = await get_params(request, {"deadlines": Dict[str, str], "attrs": Dict[str, bool]})
     try:
@@ -127,16 +220,17 @@ async def edit(request: Request) -> Response:
             # Email relevant users, if there are any.
             cfg = DEADLINE_CHANGE_NOTIFICATIONS.get(deadline, None)
             if cfg:
-                for recipient in db.get_users_by_permission(*cfg.permissions):
-                    mail.send(
-                        recipient,
-                        "change_of_deadline",
-                        rotation=rotation,
-                        old_deadline=old_deadline,
-                        new_deadline=new_deadline,
-                        user_description=cfg.user_description,
-                        description=cfg.description,
-                    )
+                recipients = await db.get_users_by_permission(*cfg.permissions)
+                await db.run(
+                    mail.send_bulk,
+                    recipients,
+                    "change_of_deadline",
+                    rotation=rotation,
+                    old_deadline=old_deadline,
+                    new_deadline=new_deadline,
+                    user_description=cfg.user_description,
+                    description=cfg.description,
+                )
             # Update the stored deadline.
             setattr(rotation, deadline, new_deadline)
 
@@ -145,7 +239,7 @@ async def edit(request: Request) -> Response:
             raise HTTPError(status=400, message=f"Illegal rotation attribute {attr!r}")
         setattr(rotation, attr, value)
 
-    db.commit()
+    await db.commit()
 
     return JSONResonse(links={"parent": f"/api/series/{rotation.series}",
                               "projects": [f"/api/projects/{project.id}" for project in rotation.projects]},
@@ -158,17 +252,13 @@ async def remind(request: Request) -> Response:
     db = request.app["db"]
     mail = request.app["mailer"]
 
-    rotation = get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
+    rotation = await get_match_info_or_error(request, ["group_series", "group_part"], db.get_project_group)
     rotation.manual_supervisor_reminders = datetime.now().date()
-    db.commit()
-
-    for supervisor in db.get_users_by_permission("create_projects"):
-        mail.send(
-            supervisor,
-            f"supervisor_invite",
-            rotation=rotation,
-            reminder=True,
-        )
+
+    supervisors = await db.get_users_by_permission("create_projects")
+    await db.run(mail.send_bulk, supervisors, "supervisor_invite", rotation=rotation, reminder=True)
+
+    await db.commit()
 
     return JSONResonse(links={"parent": f"/api/series/{rotation.series}",
                               "projects": [f"/api/projects/{project.id}" for project in rotation.projects]},
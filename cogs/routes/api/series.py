@@ -8,7 +8,7 @@ from ._format import JSONResonse, match_info_to_id
 async def get_all(request: Request) -> Response:
     """Get links to all series."""
     db = request.app["db"]
-    rotations = {year: f"/api/series/{year}" for year in db.get_all_years()}
+    rotations = {year: f"/api/series/{year}" for year in await db.get_all_years()}
     return JSONResonse(links=rotations)
 
 
@@ -18,6 +18,6 @@ async def get(request: Request) -> Response:
     year = match_info_to_id(request, "group_series")
 
     rotations = {rotation.part: f"/api/series/{year}/{rotation.part}"
-                 for rotation in db.get_project_groups_by_series(year)}
+                 for rotation in await db.get_project_groups_by_series(year)}
     return JSONResonse(links=rotations)
 
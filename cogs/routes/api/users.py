@@ -2,17 +2,21 @@ from typing import List, Dict, Union, Optional
 
 from aiohttp.web import Request, Response, HTTPTemporaryRedirect
 
-from ._format import JSONResonse, get_match_info_or_error, get_params, HTTPError
+from ._format import JSONResonse, check_not_modified, entity_tag, get_match_info_or_error, get_params, get_query_flag, get_query_int, get_query_values, HTTPError
 from .projects import serialise_project_to_json
 from cogs.db.models import User, Project
 from cogs.common.constants import JOB_HAZARD_FORM
 from cogs.security.middleware import permit
 
 
-def serialise_user_to_json(db, user):
-    supervising_projects = db.get_projects_by_supervisor(user)
-    cogs_projects = db.get_projects_by_cogs_marker(user)
-    student_projects = db.get_projects_by_student(user)
+async def serialise_user_to_json(db, user):
+    return _serialise_user(user,
+                           await db.get_projects_by_supervisor(user),
+                           await db.get_projects_by_cogs_marker(user),
+                           await db.get_projects_by_student(user))
+
+
+def _serialise_user(user, supervising_projects, cogs_projects, student_projects, fields=None):
     can_upload_project = False
     current_student_project = None
     if student_projects:
@@ -20,6 +24,14 @@ def serialise_user_to_json(db, user):
         can_upload_project = bool(most_recent.group.student_uploadable and not most_recent.grace_passed)
         current_student_project = most_recent.id
 
+    data = {
+        "can_upload_project": can_upload_project,
+        "current_student_project": current_student_project,
+        **user.serialise()
+    }
+    if fields is not None:
+        data = {key: value for key, value in data.items() if key in fields or key == "id"}
+
     return {
         "links": {
             "parent": "/api/users",
@@ -30,14 +42,73 @@ def serialise_user_to_json(db, user):
             "cogs_projects": [f"/api/projects/{project.id}" for project in cogs_projects],
             "student_projects": [f"/api/projects/{project.id}" for project in student_projects]
         },
-        "data": {
-            "can_upload_project": can_upload_project,
-            "current_student_project": current_student_project,
-            **user.serialise()
-        }
+        "data": data
     }
 
 
+# Fields of a serialised user, besides its columns
+_USER_FIELDS = {"can_upload_project", "current_student_project", "permissions"}
+
+
+async def _embedded_users(request: Request, permissions: Optional[List[str]] = None) -> Response:
+    """Respond with fully serialised users, rather than links to them.
+
+    The users are ordered by ID and can be restricted with the "ids",
+    "offset" and "limit" query parameters; "fields" restricts the data
+    returned for each user. Regardless of how many users there are, this
+    only takes two queries.
+    """
+    db = request.app["db"]
+
+    try:
+        values = get_query_values(request, "ids")
+        ids = [int(uid) for uid in values] if values is not None else None
+    except ValueError:
+        raise HTTPError(status=400,
+                        message="User IDs must be integers")
+
+    fields = get_query_values(request, "fields")
+    if fields is not None:
+        unknown = set(fields) - _USER_FIELDS - set(User.__table__.columns.keys())
+        if unknown:
+            raise HTTPError(status=400,
+                            message=f"Unknown user fields: {', '.join(sorted(unknown))}")
+
+    offset = get_query_int(request, "offset") or 0
+    limit = get_query_int(request, "limit")
+
+    # Fetch one more than we need, to find out if there's another page
+    fetch = None
+    if limit is not None:
+        fetch = limit + 1
+    users = await db.get_users(ids=ids,
+                               permissions=permissions,
+                               offset=offset,
+                               limit=fetch)
+    links = {"parent": "/api/users"}
+    if limit is not None and len(users) > limit:
+        users = users[:limit]
+        links["next"] = str(request.rel_url.update_query(offset=offset + limit))
+
+    supervising: Dict[int, List[Project]] = {user.id: [] for user in users}
+    marking: Dict[int, List[Project]] = {user.id: [] for user in users}
+    studying: Dict[int, List[Project]] = {user.id: [] for user in users}
+    for project in await db.get_projects_by_users(users):
+        for projects, user_id in ((supervising, project.supervisor_id),
+                                  (marking, project.cogs_marker_id),
+                                  (studying, project.student_id)):
+            if user_id in projects:
+                projects[user_id].append(project)
+
+    return JSONResonse(links=links, items=[
+        _serialise_user(user,
+                        supervising[user.id],
+                        marking[user.id],
+                        sorted(studying[user.id], key=lambda project: project.group_id),
+                        fields)
+        for user in users])
+
+
 async def me(request: Request) -> Response:
     """Get information about the currently logged-in user."""
     user_id = request["user"].id
@@ -45,33 +116,54 @@ async def me(request: Request) -> Response:
 
 
 async def get_all(request: Request) -> Response:
-    """Get links to information about all users."""
+    """Get links to information about all users.
+
+    With the "embed" query parameter, the users themselves are returned;
+    see _embedded_users.
+    """
+    if get_query_flag(request, "embed"):
+        return await _embedded_users(request)
+
     db = request.app["db"]
-    users = {user.id: f"/api/users/{user.id}" for user in db.get_all_users()}
+    users = {user.id: f"/api/users/{user.id}" for user in await db.get_all_users()}
     return JSONResonse(links=users)
 
 
 async def get_with_permission(request: Request) -> Response:
-    """Get information about users with any of a list of permissions."""
+    """Get information about users with any of a list of permissions.
+
+    This can also embed the users; see get_all.
+    """
     db = request.app["db"]
     permissions = await get_params(request, {"permissions": List[str]})
-    users = {user.id: f"/api/users/{user.id}" for user in db.get_users_by_permission(*set(permissions.permissions))}
+    if get_query_flag(request, "embed"):
+        return await _embedded_users(request, list(set(permissions.permissions)))
+
+    users = {user.id: f"/api/users/{user.id}" for user in await db.get_users_by_permission(*set(permissions.permissions))}
     return JSONResonse(links=users)
 
 
 async def get(request: Request) -> Response:
     """Get information about a specific user, by ID."""
     db = request.app["db"]
-    user = get_match_info_or_error(request, "user_id", db.get_user_by_id)
+    user = await get_match_info_or_error(request, "user_id", db.get_user_by_id)
 
-    return JSONResonse(**serialise_user_to_json(db, user))
+    supervising_projects = await db.get_projects_by_supervisor(user)
+    cogs_projects = await db.get_projects_by_cogs_marker(user)
+    student_projects = await db.get_projects_by_student(user)
+    etag = check_not_modified(request, entity_tag(
+        user, *supervising_projects, *cogs_projects, *student_projects,
+        *(project.group for project in student_projects)))
+
+    return JSONResonse(etag=etag,
+                       **_serialise_user(user, supervising_projects, cogs_projects, student_projects))
 
 
 @permit("modify_permissions")
 async def edit(request: Request) -> Response:
     """Modify a user."""
     db = request.app["db"]
-    user = get_match_info_or_error(request, "user_id", db.get_user_by_id)
+    user = await get_match_info_or_error(request, "user_id", db.get_user_by_id)
 
     user_data = await get_params(request, {"name": str,
                                          "email": Optional[str],
@@ -91,8 +183,8 @@ async def edit(request: Request) -> Response:
     user.user_type = "|".join(user_data.user_type)
     user.priority = min(100, max(0, user_data.priority))
 
-    db.commit()
-    return JSONResonse(**serialise_user_to_json(db, user))
+    await db.commit()
+    return JSONResonse(**await serialise_user_to_json(db, user))
 
 
 @permit("modify_permissions")
@@ -112,9 +204,9 @@ async def create(request: Request) -> Response:
                 user_type="|".join(user_data.user_type))
 
     db.add(user)
-    db.commit()
+    await db.commit()
 
-    return JSONResonse(**serialise_user_to_json(db, user))
+    return JSONResonse(**await serialise_user_to_json(db, user))
 
 
 # User model attributes for project options
@@ -129,7 +221,7 @@ async def vote(request: Request) -> Response:
 
     voting_data = await get_params(request, {"project_id": int, "choice": int})
 
-    project = db.get_project_by_id(voting_data.project_id)
+    project = await db.get_project_by_id(voting_data.project_id)
     if not user.can_choose_project(project):
         raise HTTPError(status=403,
                         message="You cannot choose this project")
@@ -141,7 +233,7 @@ async def vote(request: Request) -> Response:
         elif getattr(user, attr) == project.id:
             # If they already had that as a different priority, unset the old one
             setattr(user, attr, None)
-    db.commit()
+    await db.commit()
     return JSONResonse(status=204)
 
 
@@ -152,8 +244,9 @@ async def send_receipt(request: Request) -> Response:
     db = request.app["db"]
     mail = request.app["mailer"]
     user = request["user"]
-    rotation = db.get_rotation_by_id(await get_params(request, {"rotation": int}))
-    mail.send(
+    rotation = await db.get_rotation_by_id(await get_params(request, {"rotation": int}))
+    await db.run(
+        mail.send,
         user,
         "project_choice_receipt",
         rotation=rotation,
@@ -161,6 +254,8 @@ async def send_receipt(request: Request) -> Response:
             getattr(user, f"{nth}_option") for nth in ["first", "second", "third"]
         ],
     )
+    # Sends the e-mail (see Outbox)
+    await db.commit()
     return JSONResonse(status=204)
 
 
@@ -175,15 +270,15 @@ async def assign_projects(request: Request) -> Response:
         "choices": Dict[str, Dict[str, Union[str, int]]],
         "rotation": int,
     })
-    group = db.get_rotation_by_id(params.rotation)
+    group = await db.get_rotation_by_id(params.rotation)
     if group is None:
         raise HTTPError(status=404, message="No such rotation")
 
-    def get_project(project_id, student_id):
-        return db.get_project_by_id(project_id), None
+    async def get_project(project_id, student_id):
+        return await db.get_project_by_id(project_id), None
 
-    def get_supervisor(supervisor_id, student_id):
-        student = db.get_user_by_id(student_id)
+    async def get_supervisor(supervisor_id, student_id):
+        student = await db.get_user_by_id(student_id)
         project = Project(
             title=f"Dummy project for {student.name}",
             small_info="",
@@ -213,15 +308,15 @@ async def assign_projects(request: Request) -> Response:
         choice_type = choice["type"]
         choice_id = int(choice["id"])
 
-        project, student = choice_map[choice_type](choice_id, student_id)
+        project, student = await choice_map[choice_type](choice_id, student_id)
         project.student_id = student_id
         projects.append(project)
         if student:
             students.append(student)
-    db.commit()
+    await db.commit()
 
     serialised_projects = [serialise_project_to_json(project) for project in group.projects]
-    serialised_users = [serialise_user_to_json(db, user) for user in students]
+    serialised_users = [await serialise_user_to_json(db, user) for user in students]
     return JSONResonse(status=200,
                        data={
                            "projects": serialised_projects,
@@ -239,12 +334,13 @@ async def unset_votes(request: Request) -> Response:
     db = request.app["db"]
     mail = request.app["mailer"]
 
-    group = db.get_rotation_by_id(await get_params(request, {"rotation": int}))
+    group = await db.get_rotation_by_id(await get_params(request, {"rotation": int}))
     group.student_uploadable = True
     group.can_finalise = False
     group.student_choosable = False
 
     priorities = {}
+    assigned = {}
 
     for project in filter(lambda p: p.student, group.projects):
         student = project.student
@@ -261,16 +357,23 @@ async def unset_votes(request: Request) -> Response:
         student.second_option = None
         student.third_option = None
 
-        mail.send(student, "project_selected_student", project=project)
+        assigned[student] = project
 
-    for supervisor in db.get_users_by_permission("create_projects"):
-        projects = db.get_projects_by_supervisor(supervisor, group)
+    await db.run(mail.send_bulk, list(assigned), "project_selected_student",
+                 per_user_context=lambda student: {"project": assigned[student]})
 
+    supervisors = await db.get_users_by_permission("create_projects")
+    supervising = {}
+    for supervisor in supervisors:
+        projects = await db.get_projects_by_supervisor(supervisor, group)
         if projects:
-            mail.send(supervisor, "project_selected_supervisor", JOB_HAZARD_FORM, projects=projects)
-        mail.send(supervisor, "supervisor_student_project_list", projects=group.projects)
+            supervising[supervisor] = projects
+
+    await db.run(mail.send_bulk, list(supervising), "project_selected_supervisor", JOB_HAZARD_FORM,
+                 per_user_context=lambda supervisor: {"projects": supervising[supervisor]})
+    await db.run(mail.send_bulk, supervisors, "supervisor_student_project_list", projects=group.projects)
 
-    db.commit()
+    await db.commit()
     return JSONResonse(data={
         "priorities": priorities
     })
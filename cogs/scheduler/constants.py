@@ -57,8 +57,8 @@ GROUP_DEADLINES: Dict[str, Deadline] = {
 
     "marking_complete": Deadline(
         # NB: no reminders here because the project marking reminders
-        # are handled specially -- see cogs.scheduler.jobs.mark_project
-        # (and grace_deadline, which schedules the initial one).
+        # are handled specially -- see cogs.scheduler.jobs.marking_digest
+        # (and grace_deadlines, which schedules the initial one).
         name               = "Markers should submit feedback by:",
         pester_content     = "submit feedback for the project you're marking"),
 }
@@ -68,17 +68,17 @@ GROUP_DEADLINES: Dict[str, Deadline] = {
 # things assert that a passed deadline is contained within DEADLINES or
 # USER_DEADLINES, but that could be handled with a simple list.)
 USER_DEADLINES = {
-    "grace_deadline": Deadline(
-        # TODO
-        name               = "Deadline for student to reupload project"),
-
     "reminder": Deadline(
         # TODO
         name               = "When the system should consider sending out bulk email"),
 
     "mark_project": Deadline(
         # TODO
-        name               = "Remind people that there are projects to be marked.")
+        name               = "Remind people that there are projects to be marked."),
+
+    "marking_digest": Deadline(
+        # TODO
+        name               = "Remind markers of all the projects they have to mark.")
 }
 
 DEADLINES = {**GROUP_DEADLINES, **USER_DEADLINES}
@@ -0,0 +1,188 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import atexit
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import Context, ContextVar
+from datetime import datetime
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cogs.common import logging
+from cogs.db.interface import Database
+from cogs.db.models import OutboxMessage
+
+
+class JobTimeout(Exception):
+    """Raised when a job's run is abandoned for taking too long."""
+
+
+class JobRun(object):
+    """Statistics for a single run of a job."""
+
+    job: str
+    started: datetime
+    wall_time: Optional[float]
+    rows: int
+    mails: int
+    outcome: Optional[str]
+
+    def __init__(self, job: str) -> None:
+        self.job = job
+        self.started = datetime.now()
+        self.wall_time = None
+        self.rows = 0
+        self.mails = 0
+        self.outcome = None
+
+
+# The run, if any, that's being executed in the current context; the
+# database events below count what it does
+_current_run: ContextVar[Optional[JobRun]] = ContextVar("_current_run", default=None)
+
+
+@event.listens_for(OutboxMessage, "after_insert")
+def _count_mail(mapper, connection, target: OutboxMessage) -> None:
+    run = _current_run.get()
+    if run is not None:
+        run.mails += 1
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _count_rows(connection, cursor, statement, parameters, context, executemany) -> None:
+    run = _current_run.get()
+    if run is not None and (context.isinsert or context.isupdate or context.isdelete) \
+            and cursor.rowcount > 0:
+        run.rows += cursor.rowcount
+
+
+class JobExecutor(logging.LogWriter):
+    """Runs scheduled jobs off the event loop.
+
+    Each run of a job is executed on a worker thread, in its own context
+    (and so with its own database session), within a transaction that's
+    committed when it succeeds. At most a limited number of runs of each
+    type of job (i.e., with the same name) are executed at once; others
+    wait their turn. A run that takes longer than its job's timeout is
+    abandoned: its caller gets a JobTimeout, and its transaction is
+    rolled back, whenever the thread it's on finishes with it (threads
+    can't be interrupted), so the e-mails it queued are never sent.
+
+    The wall time, the number of rows inserted, updated or deleted, and
+    the number of e-mails queued, are logged for each run, and the most
+    recent are kept in the history.
+    """
+
+    _database: Database
+    _executor: ThreadPoolExecutor
+
+    _concurrency: Dict[str, int]
+    _timeouts: Dict[str, float]
+    _semaphores: Dict[str, asyncio.Semaphore]
+    _history: Deque[JobRun]
+
+    def __init__(self, database: Database, *,
+                 workers: int = 4,
+                 concurrency: Optional[Dict[str, int]] = None,
+                 timeouts: Optional[Dict[str, float]] = None,
+                 history: int = 100) -> None:
+        """
+        Constructor: the concurrency limits and timeouts are given for
+        each job name, with a "default" for those that aren't given
+        """
+        self._database = database
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="scheduler")
+        atexit.register(self._executor.shutdown)
+
+        self._concurrency = {"default": 1, **(concurrency or {})}
+        self._timeouts = {"default": 600, **(timeouts or {})}
+        self._semaphores = {}
+        self._history = deque(maxlen=history)
+
+    @property
+    def history(self) -> List[JobRun]:
+        """The most recent runs of jobs, oldest first."""
+        return list(self._history)
+
+    def _semaphore(self, job: str) -> asyncio.Semaphore:
+        if job not in self._semaphores:
+            limit = self._concurrency.get(job, self._concurrency["default"])
+            self._semaphores[job] = asyncio.Semaphore(int(limit))
+        return self._semaphores[job]
+
+    def _execute(self, run: JobRun, fn: Callable[..., Coroutine[Any, Any, None]], args, kwargs,
+                 abandoned: threading.Event) -> None:
+        """Execute a run of a job (on a worker thread)."""
+        _current_run.set(run)
+        start = time.monotonic()
+        try:
+            with self._database.session_scope():
+                # Jobs are coroutines, for historical reasons, but don't
+                # do anything asynchronous; they're driven on their own
+                # event loop here, rather than the application's
+                asyncio.run(fn(*args, **kwargs))
+                if abandoned.is_set():
+                    raise JobTimeout(f"Run of {run.job} was abandoned")
+        except Exception:
+            run.outcome = "timed out" if abandoned.is_set() else "failed"
+            raise
+        else:
+            run.outcome = "succeeded"
+        finally:
+            run.wall_time = time.monotonic() - start
+            self._history.append(run)
+            self.log(logging.INFO if run.outcome == "succeeded" else logging.ERROR,
+                     f"Job {run.job} {run.outcome} in {run.wall_time:.3f}s; "
+                     f"{run.rows} rows touched, {run.mails} e-mails queued")
+
+    async def run(self, job: str, fn: Callable[..., Coroutine[Any, Any, None]], *args: Any, **kwargs: Any) -> JobRun:
+        """Run a job, when its concurrency limit allows, and wait for it.
+
+        This raises whatever the job raised, or JobTimeout if it was
+        abandoned.
+        """
+        semaphore = self._semaphore(job)
+        await semaphore.acquire()
+
+        run = JobRun(job)
+        abandoned = threading.Event()
+        loop = asyncio.get_event_loop()
+        # The run gets a new, empty context, so it doesn't share anything
+        # (like the database session) with whatever scheduled it
+        future = loop.run_in_executor(self._executor, Context().run,
+                                      self._execute, run, fn, args, kwargs, abandoned)
+        # Abandoned runs still count towards the limit until they finish
+        future.add_done_callback(lambda _: semaphore.release())
+
+        timeout = float(self._timeouts.get(job, self._timeouts["default"]))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            abandoned.set()
+            self.log(logging.ERROR, f"Job {job} took longer than {timeout}s; abandoning it")
+            raise JobTimeout(f"Job {job} took longer than {timeout}s")
+        return run
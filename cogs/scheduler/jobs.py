@@ -19,14 +19,15 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import asyncio
 from datetime import date, datetime, timedelta
-from typing import List, Tuple, TYPE_CHECKING
+from typing import Dict, List, Tuple, TYPE_CHECKING
 from typing_extensions import Protocol
 
 from cogs.common import logging
 from cogs.db.interface import Database
-from cogs.db.models import User
-from cogs.mail import Postman
+from cogs.db.models import Project, User
+from cogs.mail import Attachment, Postman
 from cogs.file_handler import FileHandler
 from .constants import GROUP_DEADLINES, MARK_LATE_TIME
 
@@ -66,6 +67,11 @@ def _get_refs(scheduler: "Scheduler") -> Tuple[Database, Postman, FileHandler]:
 # interface is injected into the coroutine at runtime and provides
 # access to the database interface, e-mailing interface and logging.
 
+# Jobs may be run more than once (e.g., if the process dies part way
+# through one, it's run again when the scheduler next starts), so the
+# e-mails they send have idempotency keys (see cogs.mail.outbox) that
+# identify the job run that sent them.
+
 # FIXME? Wouldn't these be better as methods of Scheduler? Then the
 # argument structure would be conventional, rather than this pretence.
 # The only "benefit" of having them separated is that they can live here
@@ -91,8 +97,8 @@ async def supervisor_submit(scheduler: "Scheduler", *, rotation_id: int, **kwarg
     grad_office_users = db.get_users_by_permission("create_project_groups")
     no_students = len(db.get_users_by_permission("join_projects"))
 
-    for user in grad_office_users:
-        mail.send(user, "supervisor_submit_grad_office", group=group, no_students=no_students)
+    mail.send_bulk(grad_office_users, "supervisor_submit_grad_office", group=group, no_students=no_students,
+                   idempotency_key=f"supervisor_submit-{rotation_id}-{date.today()}")
 
 
 @job
@@ -112,8 +118,8 @@ async def student_invite(scheduler: "Scheduler", *, rotation_id: int, **kwargs)
     rotation.student_choosable = True
 
     students = db.get_users_by_permission("join_projects")
-    for user in students:
-        mail.send(user, f"student_invite", rotation=rotation)
+    mail.send_bulk(students, "student_invite", rotation=rotation,
+                   idempotency_key=f"student_invite-{rotation_id}-{date.today()}")
 
 
 @job
@@ -133,8 +139,8 @@ async def student_choice(scheduler: "Scheduler", *, rotation_id: int, **kwargs)
     group.read_only = True
 
     grad_office = db.get_users_by_permission("set_readonly")
-    for user in grad_office:
-        mail.send(user, "can_set_projects", group=group)
+    mail.send_bulk(grad_office, "can_set_projects", group=group,
+                   idempotency_key=f"student_choice-{rotation_id}-{date.today()}")
 
 
 @job
@@ -149,9 +155,11 @@ async def student_complete(scheduler: "Scheduler", *, rotation_id: int, **kawrgs
 
     group = db.get_rotation_by_id(rotation_id)
     assert group is not None
-    for project in group.projects:
-        if project.student and not project.uploaded:
-            mail.send([project.student, project.supervisor], "late_submission_reminder", project=project)
+    late = {project.student: project for project in group.projects if project.student and not project.uploaded}
+    mail.send_bulk([[student, project.supervisor] for student, project in late.items()],
+                   "late_submission_reminder",
+                   per_user_context=lambda student: {"project": late[student]},
+                   idempotency_key=f"student_complete-{rotation_id}-{date.today()}")
 
 
 @job
@@ -161,49 +169,54 @@ async def marking_complete(scheduler: "Scheduler", *args, **kwargs) -> None:
 
 
 @job
-async def grace_deadline(scheduler: "Scheduler", *, project_id: int, **kwargs) -> None:
+async def grace_deadlines(scheduler: "Scheduler", *args, **kwargs) -> None:
     """
-    Set the project's grace upload period as up, making it so the project can no longer
-    be re-uploaded.
-    This deadline is called a fixed amount of time after the deadline for that project.
-    An email is sent out to the project supervisor and CoGS marker with a request to
-    give out feedback.
-    A new deadline is scheduled for both which checks to make sure the project is
-    marked on time.
+    Set the grace upload period as up for every project whose grace
+    deadline has passed, making it so they can no longer be re-uploaded.
+    Each project's grace deadline is a fixed amount of time after the
+    deadline for its rotation (see cogs.routes.api.projects.upload).
+    An email is sent out to each project's supervisor and CoGS marker
+    with a request to give out feedback.
+    The rotation's marking digest is scheduled, to remind them if they
+    haven't marked it in time.
     """
     db, mail, file_handler = _get_refs(scheduler)
 
-    project = db.get_project_by_id(project_id)
-    assert project is not None, f"No such project {project_id}"
-    project.grace_passed = True
-
-    assert project.group.student_complete is not None
-    assert project.group.marking_complete is not None
+    projects = db.pass_grace_deadlines(datetime.utcnow())
+    if not projects:
+        return
+    scheduler.log(logging.INFO, f"Grace period has passed for {len(projects)} projects")
 
-    # TODO: whilst the logic behind this calculation isn't totally
-    # nonsensical, it doesn't necessarily make sense to anyone who
-    # hasn't read the source code. Probably the reminder date should
-    # just be set to marking_complete (though there does need to be a
-    # fallback in case of very late submission).
-    # Usually ≈ student_complete + SUBMISSION_GRACE_TIME.
     today = date.today()
-    # How much time were markers meant to have to give feedback?
-    delta = project.group.marking_complete - project.group.student_complete
-    # Give them that much time before sending a reminder.
-    reminder_date = today + delta
-
-    for user in filter(None, (project.supervisor, project.cogs_marker)):
-        # Send an email to the project supervisor and cogs member
-        attachment = file_handler.get_filename_for_project(project)
-        mail.send(user, "student_uploaded", attachment, project=project)
-
-        # And prepare to send them emails asking them to mark it
-        scheduler.schedule_user_deadline(
-            reminder_date,
-            "mark_project",
-            f"user={user.id}_project={project.id}",
-            user_id    = user.id,
-            project_id = project.id)
+    reminder_dates = {}
+    for project in projects:
+        assert project.group.student_complete is not None
+        assert project.group.marking_complete is not None
+
+        # TODO: whilst the logic behind this calculation isn't totally
+        # nonsensical, it doesn't necessarily make sense to anyone who
+        # hasn't read the source code. Probably the reminder date should
+        # just be set to marking_complete (though there does need to be a
+        # fallback in case of very late submission).
+        # Usually ≈ student_complete + SUBMISSION_GRACE_TIME.
+        # How much time were markers meant to have to give feedback?
+        delta = project.group.marking_complete - project.group.student_complete
+        # Give them that much time before sending a reminder.
+        reminder_dates[project.group.id] = today + delta
+
+        # Send an email to the project supervisor and cogs member, as
+        # one mailing, since they both get the project attached
+        markers = [user for user in (project.supervisor, project.cogs_marker) if user is not None]
+        if markers:
+            attachment = Attachment(file_handler.get_filename_for_project(project),
+                                    link=f"/projects/{project.id}/download")
+            mail.send_bulk(markers, "student_uploaded", attachment, project=project,
+                           idempotency_key=f"grace_deadline-{project.id}")
+
+    # And prepare to send them emails asking them to mark them (along
+    # with any other projects they have to mark in the rotation)
+    for rotation_id, reminder_date in reminder_dates.items():
+        scheduler.schedule_marking_digest(reminder_date, rotation_id)
 
 
 @job
@@ -225,53 +238,76 @@ async def reminder(scheduler: "Scheduler", *, deadline: str, rotation_id: int, *
     _predicate = GROUP_DEADLINES[deadline].pester_predicate
 
     # mypy has poor support for functools.partial, so we don't use it here.
-    def predicate(user: User):
+    def predicate(user: User) -> bool:
         return _predicate(user, rotation=group)
 
     template = GROUP_DEADLINES[deadline].pester_template
     delta_time = (scheduler.fix_time(getattr(group, deadline)) - datetime.now())
-    for user in filter(predicate, users):
-        mail.send(
-            user,
-            template,
-            delta_time=round(delta_time / timedelta(days=1)),
-            pester_content=GROUP_DEADLINES[deadline].pester_content,
-            deadline_name=deadline,
-            rotation=group,
-        )
+    recipients: List[User] = list(filter(predicate, users))
+    mail.send_bulk(
+        recipients,
+        template,
+        delta_time=round(delta_time / timedelta(days=1)),
+        pester_content=GROUP_DEADLINES[deadline].pester_content,
+        deadline_name=deadline,
+        rotation=group,
+        idempotency_key=f"reminder-{deadline}-{rotation_id}-{date.today()}",
+    )
 
 
 @job
-async def mark_project(scheduler: "Scheduler", *, user_id: int, project_id: int, late_time: int = 0, **kwargs) -> None:
+async def mark_project(scheduler: "Scheduler", *, project_id: int, **kwargs) -> None:
     """
-    E-mail a given user (project marker) to remind them that a specific
-    project is ready for marking, if they have not already marked it. An
-    additional job to remind them again is also scheduled.
+    Remind a project marker to mark a specific project
+
+    NOTE This has been superseded by the rotation's marking digest; it's
+    kept for reminders that were scheduled before that existed, each of
+    which now just brings forward the digest, so one e-mail is sent to
+    each marker, however many of these are scheduled
     """
-    db, mail, file_handler = _get_refs(scheduler)
+    db, _, _ = _get_refs(scheduler)
 
-    user = db.get_user_by_id(user_id)
-    assert user is not None, f"No such user {user_id}"
     project = db.get_project_by_id(project_id)
     assert project is not None, f"No such project {project_id}"
+    scheduler.schedule_marking_digest(date.today(), project.group.id,
+                                      late_time=kwargs.get("late_time", 0))
 
-    if not project.can_solicit_feedback(user):
-        scheduler.log(logging.INFO, f"Project {project_id} cannot solicit feedback from user {user_id}, not pestering")
+
+@job
+async def marking_digest(scheduler: "Scheduler", *, rotation_id: int, late_time: int = 0, **kwargs) -> None:
+    """
+    E-mail each marker in a rotation a single reminder, listing all the
+    projects that they have yet to mark (if any), then schedule the next
+    digest if anything remains to be marked
+    """
+    db, mail, _ = _get_refs(scheduler)
+
+    group = db.get_rotation_by_id(rotation_id)
+    assert group is not None, f"No such rotation {rotation_id}"
+
+    outstanding: Dict[User, List[Project]] = {}
+    for project in db.get_projects_by_group(group):
+        if not project.grace_passed:
+            continue
+        for marker in filter(None, (project.supervisor, project.cogs_marker)):
+            if project.can_solicit_feedback(marker):
+                outstanding.setdefault(marker, []).append(project)
+
+    if not outstanding:
+        scheduler.log(logging.INFO, f"Nothing left to mark in rotation {rotation_id}")
         return
 
-    attachment = file_handler.get_filename_for_project(project)
-    mail.send(user, "student_uploaded", attachment, project=project, late_time=late_time)
+    scheduler.log(logging.INFO, f"Reminding {len(outstanding)} markers of rotation {rotation_id} to mark projects")
+    mail.send_bulk(list(outstanding), "marking_digest",
+                   per_user_context=lambda marker: {"projects": outstanding[marker]},
+                   rotation=group,
+                   late_time=late_time,
+                   idempotency_key=f"marking_digest-{rotation_id}-{late_time}-{date.today()}")
 
-    assert project.group.marking_complete is not None
-    if date.today() > project.group.marking_complete:
+    assert group.marking_complete is not None
+    if date.today() > group.marking_complete:
         reschedule_date = date.today() + MARK_LATE_TIME
     else:
-        reschedule_date = project.group.marking_complete
-
-    scheduler.schedule_user_deadline(
-        reschedule_date,
-        "mark_project",
-        f"user={user.id}_project={project.id}",
-        user_id    = user_id,
-        project_id = project.id,
-        late_time  = late_time + 1)
+        reschedule_date = group.marking_complete
+
+    scheduler.schedule_marking_digest(reschedule_date, rotation_id, late_time=late_time + 1)
@@ -0,0 +1,199 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from typing import Callable, Optional
+
+from aiohttp.web import Application
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from cogs.common import logging
+
+
+# The advisory lock held by the leader ("CoGS", as an integer); it fits
+# in 32 bits, so it appears in pg_locks with a classid of 0
+_LOCK_ID = 0x436f4753
+
+
+class LeaderElection(logging.LogWriter):
+    """Elects one of the application's processes as the leader.
+
+    The leader is whichever process holds a PostgreSQL advisory lock,
+    which is held for as long as the connection that took it is open.
+    Every interval seconds, the leader renews its lease by checking (over
+    that connection) that it still holds the lock, and stepping down if
+    it doesn't, or can't tell; the other processes try to take the lock.
+    The lock is released as soon as the leader stops, or its connection
+    is closed, and the connection's TCP keepalives are set to detect a
+    leader that's gone away within about keepalive seconds, so another
+    process takes over within an interval or so of that.
+
+    On databases other than PostgreSQL (e.g., SQLite, for testing), there
+    are no advisory locks, so there can only be one process, which is
+    always the leader.
+    """
+
+    _engine: Engine
+    _on_elected: Callable[[], None]
+    _on_deposed: Callable[[], None]
+    _on_renewed: Optional[Callable[[], None]]
+
+    _lock_id: int
+    _interval: float
+    _keepalive: int
+
+    _connection: Optional[Connection]
+    _leader: bool
+    _campaign: Optional[asyncio.Task]
+
+    def __init__(self, engine: Engine, *,
+                 on_elected: Callable[[], None],
+                 on_deposed: Callable[[], None],
+                 on_renewed: Optional[Callable[[], None]] = None,
+                 lock_id: int = _LOCK_ID,
+                 interval: float = 5,
+                 keepalive: int = 15) -> None:
+        """
+        Constructor: on_elected and on_deposed are called when this
+        process becomes, or stops being, the leader, and on_renewed is
+        called each time the leader renews its lease
+        """
+        self._engine = engine
+        self._on_elected = on_elected
+        self._on_deposed = on_deposed
+        self._on_renewed = on_renewed
+
+        self._lock_id = lock_id
+        self._interval = interval
+        self._keepalive = keepalive
+
+        self._connection = None
+        self._leader = False
+        self._campaign = None
+
+    @property
+    def leader(self) -> bool:
+        """Whether this process is currently the leader."""
+        return self._leader
+
+    @property
+    def _supported(self) -> bool:
+        return self._engine.dialect.name == "postgresql"
+
+    def _disconnect(self) -> None:
+        if self._connection is not None:
+            # Invalidating, rather than closing, the connection means
+            # that it's not returned to the pool, so any lock it holds
+            # is released with it
+            self._connection.invalidate()
+            self._connection.close()
+            self._connection = None
+
+    def _try_acquire(self) -> bool:
+        """Try to take the lock (which blocks), returning whether it was taken."""
+        try:
+            if self._connection is None:
+                # Each statement is committed, so the connection isn't
+                # left idle in a transaction for as long as it's open
+                self._connection = self._engine.connect().execution_options(autocommit=True)
+                idle = max(1, self._keepalive // 3)
+                self._connection.execute(f"SET tcp_keepalives_idle = {idle}; "
+                                         f"SET tcp_keepalives_interval = {idle}; "
+                                         f"SET tcp_keepalives_count = 2")
+            return bool(self._connection.scalar(text("SELECT pg_try_advisory_lock(:id)"), id=self._lock_id))
+        except Exception as e:
+            self.log(logging.WARNING, f"Could not take the leader lock: {e!r}")
+            self._disconnect()
+            return False
+
+    def _renew(self) -> bool:
+        """Check that the lock is still held (which blocks)."""
+        assert self._connection is not None
+        try:
+            return bool(self._connection.scalar(text(
+                "SELECT count(*) FROM pg_locks "
+                "WHERE locktype = 'advisory' AND classid = 0 AND objid = :id AND objsubid = 1 "
+                "AND pid = pg_backend_pid() AND granted"), id=self._lock_id))
+        except Exception as e:
+            self.log(logging.WARNING, f"Could not renew the leader lease: {e!r}")
+            self._disconnect()
+            return False
+
+    def _release(self) -> None:
+        """Release the lock, if it's held (which blocks)."""
+        if self._connection is None:
+            return
+        try:
+            self._connection.execute(text("SELECT pg_advisory_unlock(:id)"), id=self._lock_id)
+        except Exception as e:
+            self.log(logging.WARNING, f"Could not release the leader lock: {e!r}")
+        finally:
+            self._disconnect()
+
+    def _elected(self) -> None:
+        self.log(logging.INFO, "Elected leader")
+        self._leader = True
+        self._on_elected()
+
+    def _deposed(self) -> None:
+        self.log(logging.WARNING, "No longer the leader")
+        self._leader = False
+        self._on_deposed()
+
+    async def _campaign_forever(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                if self._leader:
+                    if await loop.run_in_executor(None, self._renew):
+                        if self._on_renewed is not None:
+                            self._on_renewed()
+                    else:
+                        self._deposed()
+                elif await loop.run_in_executor(None, self._try_acquire):
+                    self._elected()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log(logging.ERROR, f"Leader election failed: {e!r}")
+
+            await asyncio.sleep(self._interval)
+
+    async def start(self, _app: Application) -> None:
+        """Start campaigning for leadership (an on_startup signal handler)."""
+        if not self._supported:
+            self._elected()
+            return
+        self._campaign = asyncio.ensure_future(self._campaign_forever())
+
+    async def stop(self, _app: Application) -> None:
+        """Stop campaigning, and step down (an on_cleanup signal handler)."""
+        if self._campaign is not None:
+            self._campaign.cancel()
+            try:
+                await self._campaign
+            except asyncio.CancelledError:
+                pass
+            self._campaign = None
+
+        if self._leader:
+            self._deposed()
+        await asyncio.get_event_loop().run_in_executor(None, self._release)
@@ -21,7 +21,7 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import atexit
 from datetime import date, timedelta, datetime
-from typing import ClassVar, List
+from typing import ClassVar, Dict, List, Optional
 
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -36,6 +36,8 @@ from cogs.db.models import ProjectGroup
 from cogs.mail import Postman
 from cogs.file_handler import FileHandler
 from . import jobs
+from .executor import JobExecutor
+from .leader import LeaderElection
 from .constants import GROUP_DEADLINES, USER_DEADLINES
 
 
@@ -46,16 +48,20 @@ class Scheduler(logging.LogWriter):
     _db: Database
     _mail: Postman
     _file_handler: FileHandler
+    _executor: JobExecutor
+    election: LeaderElection
     proxy: ClassVar["Scheduler"]
 
-    def __init__(self, database: Database, mail: Postman, file_handler: FileHandler) -> None:
+    def __init__(self, database: Database, mail: Postman, file_handler: FileHandler, executor: Optional[Dict] = None, election: Optional[Dict] = None) -> None:
         """
-        Constructor
+        Constructor: the job executor and leader election settings (see
+        JobExecutor and LeaderElection) are optional
         """
         Scheduler.proxy = self
         self._db = database
         self._mail = mail
         self._file_handler = file_handler
+        self._executor = JobExecutor(database, **(executor or {}))
 
         job_defaults = {
             # APScheduler will only fire events that are up to 31 days out of date
@@ -72,7 +78,16 @@ class Scheduler(logging.LogWriter):
             job_defaults=job_defaults,
             jobstores=jobstores)
 
-        self._scheduler.start()
+        # Every process can add, modify and remove jobs, but only the
+        # leader runs them (see LeaderElection); until it's elected, the
+        # scheduler is paused. The leader is woken each time it renews
+        # its lease, so it notices jobs that other processes have added.
+        self._scheduler.start(paused=True)
+        self.election = LeaderElection(database.engine,
+                                       on_elected=self._scheduler.resume,
+                                       on_deposed=self._scheduler.pause,
+                                       on_renewed=self._scheduler.wakeup,
+                                       **(election or {}))
 
         for job in self._scheduler.get_jobs():
             self.log(logging.DEBUG, f"name: {job.name}; "
@@ -84,6 +99,28 @@ class Scheduler(logging.LogWriter):
                                     f"kwargs: {job.kwargs}; "
                                     f"misfire: {job.misfire_grace_time}")
 
+        # Housekeeping, which isn't associated with any deadline
+        self._scheduler.add_job(
+            self._job,
+            trigger = CronTrigger(hour=3, minute=0),
+            id = "collect_garbage",
+            args = ("collect_garbage",),
+            replace_existing = True,
+            coalesce = True,
+        )
+
+        # Projects' grace periods are closed by a single sweeper, rather
+        # than a job for each project (see jobs.grace_deadlines)
+        self._scheduler.add_job(
+            self._job,
+            trigger = CronTrigger(minute="*/15"),
+            id = "grace_deadlines",
+            args = ("grace_deadlines",),
+            replace_existing = True,
+            coalesce = True,
+        )
+        self._migrate_grace_deadlines()
+
         # TODO: is this useful/correct? (see #18)
         atexit.register(self._scheduler.shutdown)
 
@@ -110,9 +147,34 @@ class Scheduler(logging.LogWriter):
         pickled just fine. Switching to just passing the job directly
         would potentially allow proper type-checking of jobs, which
         might mean that the manky "_Job" protocol could be removed.
+
+        The job is run off the event loop by the job executor, within its
+        own database session scope, which is committed when the job
+        completes successfully (see JobExecutor).
         """
         print(f"Running job: {__deadline}(*{args}, **{kwargs})")
-        await getattr(jobs, __deadline)(Scheduler.proxy, *args, **kwargs)
+        scheduler = Scheduler.proxy
+        await scheduler._executor.run(__deadline, getattr(jobs, __deadline), scheduler, *args, **kwargs)
+
+    def _migrate_grace_deadlines(self) -> None:
+        """Move any per-project grace deadline jobs into their projects.
+
+        TODO: remove this once there are no instances with per-project
+        grace deadline jobs
+        """
+        legacy = [job for job in self._scheduler.get_jobs()
+                  if job.id.startswith("grace_deadline_project=")]
+        if not legacy:
+            return
+
+        self.log(logging.INFO, f"Moving {len(legacy)} grace deadlines out of the scheduler")
+        with self._db.session_scope():
+            for job in legacy:
+                project = self._db.get_project_by_id(job.kwargs["project_id"])
+                if project is not None and job.next_run_time is not None:
+                    project.grace_deadline = job.next_run_time.astimezone(utc).replace(tzinfo=None)
+        for job in legacy:
+            self._scheduler.remove_job(job.id)
 
     def reset_all(self) -> None:
         """Remove all jobs."""
@@ -206,6 +268,32 @@ class Scheduler(logging.LogWriter):
                                 kwargs           = kwargs,
                                 replace_existing = True)
 
+    def schedule_marking_digest(self, when: date, rotation_id: int, late_time: int = 0) -> None:
+        """Schedule the digest of projects to be marked in the rotation.
+
+        There's (at most) one digest job for each rotation; if it's
+        already scheduled to run no later than the given date, it's left
+        alone, so any number of projects can ask for a digest, and their
+        markers still only get one e-mail.
+        """
+        schedule_time = self.fix_time(when)
+        job_id = f"marking_digest_{rotation_id}"
+
+        existing = self._scheduler.get_job(job_id)
+        if existing is not None and existing.next_run_time is not None:
+            if existing.next_run_time.replace(tzinfo=None) <= schedule_time:
+                return
+            # Bringing the digest forward mustn't forget how late it is
+            late_time = max(late_time, existing.kwargs.get("late_time", 0))
+
+        self.log(logging.DEBUG, f"Scheduling a marking digest `{job_id}` to be ran at `{schedule_time}`")
+        self._scheduler.add_job(self._job,
+                                trigger          = DateTrigger(run_date=schedule_time),
+                                id               = job_id,
+                                args             = ("marking_digest",),
+                                kwargs           = {"rotation_id": rotation_id, "late_time": late_time},
+                                replace_existing = True)
+
     def fix_time(self, when: date) -> datetime:
         """Return the actual time a deadline should be scheduled for.
 
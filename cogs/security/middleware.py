@@ -26,6 +26,7 @@ from aiohttp.web import HTTPForbidden, Request, StreamResponse
 
 from cogs.common.constants import PERMISSIONS
 from cogs.common.types import Handler
+from .model import Role
 from .roles import zero
 
 
@@ -43,6 +44,8 @@ def permit(*permissions: str) -> Callable[[Handler], Handler]:
     assert permissions
     assert set(permissions) <= set(PERMISSIONS)
 
+    required = Role.mask_of(*permissions)
+
     def decorator(fn: Handler) -> Handler:
         @wraps(fn)
         async def decorated(request: Request) -> StreamResponse:
@@ -52,7 +55,7 @@ def permit(*permissions: str) -> Callable[[Handler], Handler]:
             user = request.get("user")
             role = user.role if user else zero
 
-            if not all(getattr(role, p) for p in permissions):
+            if role.mask & required != required:
                 raise HTTPForbidden(text="Permission denied")
 
             return await fn(request)
@@ -76,6 +79,8 @@ def permit_any(*permissions: str) -> Callable[[Handler], Handler]:
     assert permissions
     assert set(permissions) <= set(PERMISSIONS)
 
+    required = Role.mask_of(*permissions)
+
     def decorator(fn: Handler) -> Handler:
         @wraps(fn)
         async def decorated(request: Request) -> StreamResponse:
@@ -85,7 +90,7 @@ def permit_any(*permissions: str) -> Callable[[Handler], Handler]:
             user = request.get("user")
             role = user.role if user else zero
 
-            if not any(getattr(role, p) for p in permissions):
+            if not role.mask & required:
                 raise HTTPForbidden(text="Permission denied")
 
             return await fn(request)
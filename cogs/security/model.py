@@ -23,8 +23,7 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 # hard-coded. All this does is make the code harder to read and
 # impossible to type-check.
 
-import textwrap
-from typing import Any, Dict, Type, TYPE_CHECKING
+from typing import Any, Dict, Tuple, Type, TYPE_CHECKING
 
 from cogs.common.constants import PERMISSIONS
 
@@ -32,77 +31,105 @@ from cogs.common.constants import PERMISSIONS
 class _BaseRole(object):
     """Base role object.
 
-    NOTE Do not instantiate!
+    Permissions are held as bits of an integer mask, so roles are cheap
+    to combine and compare, and a permission check is a single AND.
+    Roles are immutable, so they can be freely shared between users.
+
+    NOTE Do not instantiate! Use _build_role to build a role class for
+    a given set of permissions.
     """
-    _permissions: Dict[str, bool]
+    __slots__ = ("_mask",)
+
+    # Set per role class by _build_role
+    _permissions: Tuple[str, ...]
+    _bits: Dict[str, int]
+
+    _mask: int
 
     def __init__(self, **permissions: bool) -> None:
-        self._permissions = permissions
+        missing = [p for p in self._permissions if p not in permissions]
+        if missing:
+            raise TypeError(f"{self.__class__.__name__}() missing permissions: {', '.join(missing)}")
+
+        unknown = [p for p in permissions if p not in self._bits]
+        if unknown:
+            raise TypeError(f"{self.__class__.__name__}() got unknown permissions: {', '.join(unknown)}")
+
+        object.__setattr__(self, "_mask", sum(self._bits[p] for p, v in permissions.items() if v))
+
+    @classmethod
+    def _from_mask(cls, mask: int) -> "_BaseRole":
+        """Build a role directly from its permission mask."""
+        role = object.__new__(cls)
+        object.__setattr__(role, "_mask", mask)
+        return role
+
+    @classmethod
+    def mask_of(cls, *permissions: str) -> int:
+        """Return the mask of the specified permissions."""
+        mask = 0
+        for p in permissions:
+            mask |= cls._bits[p]
+        return mask
+
+    @property
+    def mask(self) -> int:
+        return self._mask
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
 
     def __repr__(self):
-        params = ", ".join("{}={}".format(k, repr(v)) for k, v in self._permissions.items())
+        params = ", ".join("{}={}".format(k, repr(v)) for k, v in self.serialise().items())
         return f"{self.__class__.__name__}({params})"
 
     def __bool__(self):
-        return any(self._permissions.values())
+        return self._mask != 0
 
     def __eq__(self, other: object) -> bool:
         """ Role equivalence """
         if not isinstance(other, _BaseRole):
             return NotImplemented
-        return self.__class__ == other.__class__ \
-           and all(v == other._permissions[k]
-                   for k, v in self._permissions.items())
+        return self.__class__ == other.__class__ and self._mask == other._mask
+
+    def __hash__(self) -> int:
+        return hash((self.__class__, self._mask))
 
     def __or__(self, other: "_BaseRole") -> "_BaseRole":
         """ Logical disjunction of equivalent permissions """
         assert self.__class__ == other.__class__
-        return self.__class__(**{k: v | other._permissions[k]
-                                 for k, v in self._permissions.items()})
+        return self._from_mask(self._mask | other._mask)
 
     def __and__(self, other: "_BaseRole") -> "_BaseRole":
         """ Logical conjunction of equivalent permissions """
         assert self.__class__ == other.__class__
-        return self.__class__(**{k: v & other._permissions[k]
-                                 for k, v in self._permissions.items()})
+        return self._from_mask(self._mask & other._mask)
 
     def serialise(self):
-        return self._permissions
+        return {p: bool(self._mask & bit) for p, bit in self._bits.items()}
+
+
+def _permission(bit: int) -> property:
+    """Build a read-only property for the permission at the given bit."""
+    return property(lambda self: self._mask & bit != 0)
 
 
 def _build_role(*permissions: str) -> Type[_BaseRole]:
     """
-    Build a role class with a constructor taking boolean arguments
-    matching the specified permissions, with respective, read-only
-    properties
-
-    This uses the same kind of ugly metaprogramming as the standard
-    library uses to build namedtuples... Approach with caution!
+    Build a role class with a constructor taking boolean keyword
+    arguments matching the specified permissions, with respective,
+    read-only properties
     """
     assert permissions  # Must have at least one
 
-    # Define constructor
-    src = """
-    class Role(_BaseRole):
-        def __init__(self, *, {init_params}) -> None:
-            super().__init__(**{{ {param_dict} }})
-    """.format(
-        init_params = ", ".join(map(lambda p: f"{p}:bool", permissions)),
-        param_dict  = ", ".join(map(lambda p: f"\"{p}\": {p}", permissions))
-    )
-
-    # Define properties
-    for p in permissions:
-        src += """
-        @property
-        def {p}(self) -> bool:
-            return self._permissions["{p}"]
-        """.format(p=p)
-
-    # Oh god, now I'm going to need to take a shower :P
-    namespace = {"_BaseRole": _BaseRole}
-    exec(textwrap.dedent(src), namespace)
-    return namespace["Role"]
+    bits = {p: 1 << i for i, p in enumerate(permissions)}
+    namespace: Dict[str, Any] = {
+        "__slots__": (),
+        "_permissions": permissions,
+        "_bits": bits,
+        **{p: _permission(bit) for p, bit in bits.items()}}
+
+    return type("Role", (_BaseRole,), namespace)
 
 
 # Role is fundamentally impossible to typecheck, unfortunately; this
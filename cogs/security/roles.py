@@ -18,6 +18,9 @@ You should have received a copy of the GNU Affero General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
+from functools import reduce
+from typing import Dict, List
+
 from .model import Role
 
 
@@ -86,3 +89,37 @@ archive = Role(
     join_projects               = False,
     view_projects_predeadline   = False,
     view_all_submitted_projects = False)
+
+
+# Roles that can be assigned to users, by the name used in user types
+ROLES: Dict[str, Role] = {
+    "grad_office": grad_office,
+    "supervisor":  supervisor,
+    "cogs_member": cogs_member,
+    "student":     student,
+    "archive":     archive}
+
+
+def with_any_permission(*permissions: str) -> List[str]:
+    """Return the names of the roles that have any of the permissions."""
+    return [name for name, role in ROLES.items()
+            if any(getattr(role, p) for p in permissions)]
+
+
+# Interned roles by user type; there are only as many entries as there
+# are distinct combinations of roles in use, so this stays tiny
+_by_user_type: Dict[str, Role] = {}
+
+
+def for_user_type(user_type: str) -> Role:
+    """
+    Return the disjunction of the roles in the given (pipe-separated)
+    user type, shared by every user of that type
+    """
+    try:
+        return _by_user_type[user_type]
+    except KeyError:
+        role = reduce(lambda acc, this: acc | this,
+                      [ROLES[name] for name in user_type.split("|") if name],
+                      zero)
+        return _by_user_type.setdefault(user_type, role)
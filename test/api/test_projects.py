@@ -34,6 +34,7 @@ from asyncio import Future
 import cogs
 import cogs.routes
 from cogs.auth.dummy import DummyAuthenticator
+from cogs.db.asynchronous import AsyncDatabase
 from cogs.db.interface import Database
 from cogs.db.models import Project, User
 from cogs.file_handler import FileHandler
@@ -50,7 +51,7 @@ def future(x):
 class TestProjectsApi(AioHTTPTestCase):
     async def get_application(self):
         app = web.Application(middlewares=[cogs.auth.middleware])
-        app["db"] = db = MagicMock(spec=Database)
+        app["db"] = AsyncDatabase(MagicMock(spec=Database))
         app["auth"] = auth = MagicMock(spec=DummyAuthenticator)
         app["mailer"] = MagicMock(spec=Postman)
         app["scheduler"] = MagicMock(spec=Scheduler)
@@ -62,7 +63,8 @@ class TestProjectsApi(AioHTTPTestCase):
     @unittest_run_loop
     async def test_upload_incorrect_user(self, student_id, user_id, project_id):
         assume(user_id != student_id)
-        auth, db = (self.app[x] for x in ["auth", "db"])
+        auth = self.app["auth"]
+        db = self.app["db"].database
         user = User(id=user_id, user_type="student")
         student = User(id=student_id, user_type="student")
         auth.get_user_from_request.return_value = future(user)
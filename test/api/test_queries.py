@@ -0,0 +1,173 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import unittest
+from tempfile import TemporaryDirectory
+from datetime import date
+from typing import Any, List
+from unittest.mock import MagicMock
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from sqlalchemy import event
+
+import cogs
+import cogs.routes
+from cogs.auth.dummy import DummyAuthenticator
+from cogs.db import middleware as session_middleware
+from cogs.db.asynchronous import AsyncDatabase
+from cogs.db.models import Project, ProjectGroup, User
+from cogs.export import ExportCache
+from cogs.file_handler import FileHandler
+from cogs.mail import Postman
+from cogs.scheduler.scheduler import Scheduler
+
+from test.db_helper import SQLiteDatabase
+
+
+class TestQueryCounts(AioHTTPTestCase):
+    """
+    Count the SQL statements issued by each endpoint, to catch queries
+    creeping back into loops (e.g., lazy loads while serialising)
+    """
+
+    statements: List[str]
+
+    async def get_application(self):
+        self.database = SQLiteDatabase({})
+        self.populate()
+
+        self.statements = []
+        event.listen(self.database.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: self.statements.append(statement))
+
+        app = web.Application(middlewares=[session_middleware, cogs.auth.middleware, cogs.routes.middleware])
+        app["db"] = db = AsyncDatabase(self.database, max_workers=1)
+        app["auth"] = DummyAuthenticator(db)
+        app["mailer"] = MagicMock(spec=Postman)
+        app["scheduler"] = MagicMock(spec=Scheduler)
+        app["file_handler"] = MagicMock(spec=FileHandler)
+        app["config"] = {"webserver": {"service": "https://example.com"}}
+
+        exports = TemporaryDirectory()
+        self.addCleanup(exports.cleanup)
+        app["exports"] = ExportCache(db, exports.name, "https://example.com/projects/{}/download")
+        cogs.routes.setup(app)
+        return app
+
+    def populate(self, projects: int = 5) -> None:
+        deadlines = {deadline: date(2018, 1, 1) for deadline in (
+            "supervisor_submit", "student_invite", "student_choice",
+            "student_complete", "marking_complete")}
+
+        with self.database.session_scope() as session:
+            students = [User(name=f"Student {n}", user_type="student") for n in range(projects)]
+
+            for part in (1, 2):
+                group = ProjectGroup(series=2018, part=part, student_viewable=True,
+                                     student_choosable=True, student_uploadable=True,
+                                     can_finalise=True, read_only=False, **deadlines)
+                session.add(group)
+
+                for n, student in enumerate(students):
+                    session.add(Project(
+                        title=f"Project {part}.{n}", programmes="", group=group, student=student,
+                        supervisor=User(name=f"Supervisor {part}.{n}", user_type="supervisor"),
+                        cogs_marker=User(name=f"Marker {part}.{n}", user_type="cogs_member")))
+
+            session.flush()
+            self.student_id = students[0].id
+            self.project_id = students[0].projects_as_student[0].id
+
+    async def assertWithinBudget(self, path: str, budget: int) -> Any:
+        """
+        Assert the number of statements issued by a GET request, which
+        includes looking up the authenticated user (the administrator),
+        returning the decoded response
+        """
+        self.statements.clear()
+        response = await self.client.get(path)
+        self.assertEqual(response.status, 200, path)
+        self.assertLessEqual(len(self.statements), budget,
+                             "{} issued {} statements (budget {}):\n{}".format(
+                                 path, len(self.statements), budget, "\n".join(self.statements)))
+        return json.loads(await response.text())
+
+    @unittest_run_loop
+    async def test_project(self):
+        await self.assertWithinBudget(f"/api/projects/{self.project_id}", 2)
+
+    @unittest_run_loop
+    async def test_user(self):
+        await self.assertWithinBudget("/api/users/1", 4)
+        await self.assertWithinBudget(f"/api/users/{self.student_id}", 5)
+
+    @unittest_run_loop
+    async def test_rotations(self):
+        await self.assertWithinBudget("/api/series/2018", 2)
+        await self.assertWithinBudget("/api/series/2018/1", 3)
+        await self.assertWithinBudget("/api/series/2018/1/projects", 3)
+
+    @unittest_run_loop
+    async def test_export(self):
+        # Rendering the workbook, then sending it from the cache
+        for budget in (4, 2):
+            self.statements.clear()
+            response = await self.client.get("/api/series/2018/export.xlsx")
+            self.assertEqual(response.status, 200)
+            body = await response.read()
+            self.assertEqual(len(body), int(response.headers["Content-Length"]))
+            self.assertTrue(body.startswith(b"PK"))
+            self.assertLessEqual(len(self.statements), budget)
+
+    @unittest_run_loop
+    async def test_users(self):
+        await self.assertWithinBudget("/api/users", 2)
+
+    @unittest_run_loop
+    async def test_users_embedded(self):
+        users = await self.assertWithinBudget("/api/users?embed=1", 3)
+        ids = [user["data"]["id"] for user in users["items"]]
+        self.assertEqual(ids, sorted(ids))
+        self.assertNotIn("next", users["links"])
+
+        student = next(user for user in users["items"] if user["data"]["id"] == self.student_id)
+        self.assertEqual(len(student["links"]["student_projects"]), 2)
+        self.assertEqual(student["data"]["current_student_project"],
+                         int(student["links"]["student_projects"][-1].rsplit("/", 1)[1]))
+
+        # Pagination, restricted to some users and fields
+        page = await self.assertWithinBudget(f"/api/users?embed=1&ids={','.join(map(str, ids[:5]))}&limit=3&fields=name,permissions", 3)
+        self.assertEqual([user["data"]["id"] for user in page["items"]], ids[:3])
+        self.assertEqual(set(page["items"][0]["data"]), {"id", "name", "permissions"})
+        page = await self.assertWithinBudget(page["links"]["next"], 3)
+        self.assertEqual([user["data"]["id"] for user in page["items"]], ids[3:5])
+        self.assertNotIn("next", page["links"])
+
+        students = await self.assertWithinBudget("/api/users/permissions?permissions=join_projects&embed=1", 3)
+        self.assertEqual(len(students["items"]), 5)
+
+        response = await self.client.get("/api/users?embed=1&fields=password")
+        self.assertEqual(response.status, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
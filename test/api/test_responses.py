@@ -0,0 +1,216 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import unittest
+from datetime import date
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest.mock import MagicMock
+from zipfile import ZipFile
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+
+import cogs
+import cogs.routes
+from cogs.auth.dummy import DummyAuthenticator
+from cogs.db import middleware as session_middleware
+from cogs.db.asynchronous import AsyncDatabase
+from cogs.db.models import OutboxMessage, Project, ProjectGroup, User
+from cogs.file_handler import FileHandler
+from cogs.mail import Postman
+from cogs.scheduler.scheduler import Scheduler
+
+from test.db_helper import SQLiteDatabase
+
+
+class TestResponses(AioHTTPTestCase):
+    async def get_application(self):
+        self.database = SQLiteDatabase({})
+        with self.database.session_scope() as session:
+            group = ProjectGroup(series=2018, part=1, student_viewable=True, read_only=False,
+                                 **{deadline: date(2018, 1, 1) for deadline in (
+                                     "supervisor_submit", "student_invite", "student_choice",
+                                     "student_complete", "marking_complete")})
+            session.add(Project(title="Project", programmes="", group=group, supervisor_id=2))
+            session.add(Project(title="Uploaded project", programmes="", group=group, supervisor_id=2,
+                                student=User(name="Student", user_type="student"), uploaded=True))
+            session.flush()
+            self.project_id, self.uploaded_id = (project.id for project in group.projects)
+
+        app = web.Application(middlewares=[session_middleware, cogs.auth.middleware, cogs.routes.middleware])
+        app["db"] = db = AsyncDatabase(self.database, max_workers=1)
+        app["auth"] = DummyAuthenticator(db)
+        app["mailer"] = MagicMock(spec=Postman)
+        app["scheduler"] = MagicMock(spec=Scheduler)
+
+        uploads = TemporaryDirectory()
+        self.addCleanup(uploads.cleanup)
+        app["file_handler"] = FileHandler(uploads.name, 1024 * 1024)
+        cogs.routes.setup(app)
+        return app
+
+    async def assertConditional(self, path: str, modify) -> None:
+        response = await self.client.get(path)
+        self.assertEqual(response.status, 200)
+        etag = response.headers["ETag"]
+
+        response = await self.client.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+
+        with self.database.session_scope():
+            modify()
+
+        response = await self.client.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    @unittest_run_loop
+    async def test_versioned(self):
+        def modify_project():
+            self.database.get_project_by_id(self.project_id).title = "Modified"
+
+        def modify_rotation():
+            self.database.get_project_group(2018, 1).student_choosable = True
+
+        await self.assertConditional(f"/api/projects/{self.project_id}", modify_project)
+        await self.assertConditional("/api/series/2018/1", modify_rotation)
+        await self.assertConditional("/api/series/2018/1/projects", modify_project)
+
+    @unittest_run_loop
+    async def test_derived_from_body(self):
+        def add_rotation():
+            self.database.add(ProjectGroup(series=2019, part=1))
+
+        await self.assertConditional("/api/series", add_rotation)
+
+    @unittest_run_loop
+    async def test_json_formatting(self):
+        compact = await self.client.get("/api/series/2018/1")
+        self.assertNotIn(b"\n", await compact.read())
+
+        pretty = await self.client.get("/api/series/2018/1?pretty=1")
+        self.assertIn(b'\n    "links": {', await pretty.read())
+        self.assertEqual(json.loads(await compact.text()), json.loads(await pretty.text()))
+
+    @unittest_run_loop
+    async def test_compression(self):
+        # E-mail templates are large enough to be worth compressing
+        path = "/api/emails"
+        plain = await self.client.get(path, headers={"Accept-Encoding": "identity"})
+        self.assertNotIn("Content-Encoding", plain.headers)
+
+        for coding in ("gzip", "deflate"):
+            compressed = await self.client.get(path, headers={"Accept-Encoding": f"{coding}, br;q=0"})
+            self.assertEqual(compressed.headers["Content-Encoding"], coding)
+            self.assertEqual(await compressed.read(), await plain.read())
+            etag = compressed.headers["ETag"]
+            self.assertNotEqual(etag, plain.headers["ETag"])
+
+            response = await self.client.get(path, headers={"Accept-Encoding": coding, "If-None-Match": etag})
+            self.assertEqual(response.status, 304)
+
+        response = await self.client.get(path, headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    @unittest_run_loop
+    async def test_download(self):
+        path = f"/api/projects/{self.uploaded_id}/file"
+        response = await self.client.get(path)
+        self.assertEqual(response.status, 500)
+
+        file_handler = self.app["file_handler"]
+        with self.database.session_scope():
+            upload = file_handler.upload_project(self.database.get_project_by_id(self.uploaded_id))
+            upload.write(bytes(range(256)) * 16)
+            upload.commit()
+
+        response = await self.client.get(path)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/zip")
+        self.assertEqual(await response.read(), bytes(range(256)) * 16)
+        etag = response.headers["ETag"]
+
+        response = await self.client.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+
+        # Resuming a download
+        response = await self.client.get(path, headers={"Range": "bytes=4000-", "If-Range": etag})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(await response.read(), bytes(range(160, 256)))
+
+        # ...of a file that has since changed
+        response = await self.client.get(path, headers={"Range": "bytes=4000-", "If-Range": '"stale"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(await response.read()), 4096)
+
+    @unittest_run_loop
+    async def test_upload(self):
+        path = f"/api/projects/{self.uploaded_id}/file"
+        response = await self.client.put(path, data={"file": BytesIO(b"report")})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await (await self.client.get(path)).read(), b"report")
+
+        response = await self.client.get(f"{path}/status")
+        status = json.loads(await response.text())["data"]
+        self.assertEqual(status["file_names"], [])
+        self.assertEqual(status["sha256"], hashlib.sha256(b"report").hexdigest())
+
+        # Oversized uploads don't touch the existing report
+        response = await self.client.put(path, data={"file": BytesIO(bytes(2 * 1024 * 1024))})
+        self.assertEqual(response.status, 400)
+        self.assertEqual(await (await self.client.get(path)).read(), b"report")
+
+    @unittest_run_loop
+    async def test_bulk_download(self):
+        with self.database.session_scope():
+            upload = self.app["file_handler"].upload_project(self.database.get_project_by_id(self.uploaded_id))
+            upload.write(b"report")
+            upload.commit()
+
+        async def names(query: str = ""):
+            response = await self.client.get(f"/api/series/2018/1/files.zip{query}")
+            self.assertEqual(response.status, 200)
+            with ZipFile(BytesIO(await response.read())) as archive:
+                self.assertIsNone(archive.testzip())
+                return {name: archive.read(name) for name in archive.namelist()}
+
+        self.assertEqual(await names(), {"Student_2018_1.zip": b"report"})
+        self.assertEqual(await names("?marker=2"), {"Student_2018_1.zip": b"report"})
+        self.assertEqual(await names("?marker=me"), {})
+
+    @unittest_run_loop
+    async def test_outbox(self):
+        with self.database.session_scope():
+            self.database.add(OutboxMessage(idempotency_key="key", sender="sender@example.com",
+                                            recipient="user@example.com", subject="Subject", body="Body"))
+
+        response = await self.client.get("/api/emails/outbox")
+        self.assertEqual(response.status, 200)
+        depth = json.loads(await response.text())["data"]
+        self.assertEqual((depth["pending"], depth["due"], depth["sent"], depth["dead"]), (1, 1, 0, 0))
+        self.assertIsInstance(depth["oldest_pending"], str)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -37,8 +37,9 @@ from asyncio import Future
 import cogs
 import cogs.routes
 from cogs.auth.dummy import DummyAuthenticator
+from cogs.db.asynchronous import AsyncDatabase
 from cogs.db.interface import Database, ProjectGroup
-from cogs.db.models import User
+from cogs.db.models import Project, User
 from cogs.mail import Postman
 from cogs.scheduler.scheduler import Scheduler
 
@@ -57,7 +58,7 @@ def todatetime(date):
 class TestRotationApi(AioHTTPTestCase):
     async def get_application(self):
         app = web.Application(middlewares=[cogs.auth.middleware])
-        app["db"] = db = MagicMock(spec=Database)
+        app["db"] = AsyncDatabase(MagicMock(spec=Database))
         app["auth"] = auth = MagicMock(spec=DummyAuthenticator)
         app["mailer"] = MagicMock(spec=Postman)
         app["scheduler"] = MagicMock(spec=Scheduler)
@@ -73,13 +74,14 @@ class TestRotationApi(AioHTTPTestCase):
     )
     @unittest_run_loop
     async def test_rotation_create(self, series, part, num_users, initial_deadline):
-        auth, db, mailer, scheduler = (self.app[x] for x in ["auth", "db", "mailer", "scheduler"])
+        auth, mailer, scheduler = (self.app[x] for x in ["auth", "mailer", "scheduler"])
+        db = self.app["db"].database
         auth.get_user_from_request.return_value = future(User(user_type="grad_office"))
         db.get_project_group.return_value = None
         db.get_users_by_permission.return_value = [User()] * num_users
         db.add.reset_mock()
         db.commit.reset_mock()
-        mailer.send.reset_mock()
+        mailer.send_bulk.reset_mock()
         scheduler.schedule_deadline.reset_mock()
 
         data = {
@@ -103,7 +105,8 @@ class TestRotationApi(AioHTTPTestCase):
         # The request should succeed.
         self.assertLess(resp.status, 400)
         # Mail should be sent to each user.
-        self.assertEqual(mailer.send.call_count, num_users)
+        mailer.send_bulk.assert_called_once()
+        self.assertEqual(len(mailer.send_bulk.call_args[0][0]), num_users)
         # All project deadlines should be scheduled.
         self.assertEqual(scheduler.schedule_deadline.call_count, len(cogs.scheduler.constants.GROUP_DEADLINES))
         # The project should be added to the database.
@@ -129,7 +132,8 @@ class TestRotationApi(AioHTTPTestCase):
     )
     @unittest_run_loop
     async def test_rotation_edit(self, series, part, num_users, orig_deadline, new_deadline):
-        auth, db, mailer, scheduler = (self.app[x] for x in ["auth", "db", "mailer", "scheduler"])
+        auth, mailer, scheduler = (self.app[x] for x in ["auth", "mailer", "scheduler"])
+        db = self.app["db"].database
         auth.get_user_from_request.return_value = future(User(user_type="grad_office"))
         db.get_project_group.return_value = ProjectGroup(
             supervisor_submit=orig_deadline,
@@ -141,7 +145,7 @@ class TestRotationApi(AioHTTPTestCase):
         db.get_users_by_permission.return_value = [User()] * num_users
         db.add.reset_mock()
         db.commit.reset_mock()
-        mailer.send.reset_mock()
+        mailer.send_bulk.reset_mock()
         scheduler.schedule_deadline.reset_mock()
 
         resp = await self.client.put(f"/api/series/{series.year}/{part}", json={
@@ -164,6 +168,38 @@ class TestRotationApi(AioHTTPTestCase):
         if orig_deadline != new_deadline:
             # Mail should be sent to each user, once per changed deadline
             # (except student_invite).
-            self.assertEqual(mailer.send.call_count, num_users * 4)
+            self.assertEqual(mailer.send_bulk.call_count, 4)
+            self.assertEqual(sum(len(args[0]) for args, _ in mailer.send_bulk.call_args_list), num_users * 4)
             # All project deadlines should be scheduled.
             self.assertEqual(scheduler.schedule_deadline.call_count, len(cogs.scheduler.constants.GROUP_DEADLINES))
+
+    @unittest_run_loop
+    async def test_rotation_projects(self):
+        auth = self.app["auth"]
+        db = self.app["db"].database
+        supervisor = User(id=1, name="Supervisor", user_type="supervisor")
+        student = User(id=2, name="Student", user_type="student")
+        rotation = ProjectGroup(series=2018, part=1, student_viewable=False)
+        db.get_project_group.return_value = rotation
+        db.get_projects_by_group.return_value = [
+            Project(id=1, programmes="", group=rotation, supervisor=supervisor, student=student, supervisor_feedback_id=3),
+            Project(id=2, programmes="", group=rotation, supervisor=User(id=3), supervisor_feedback_id=4)]
+
+        # Supervisors can see their own projects' marks, but no others
+        auth.get_user_from_request.return_value = future(supervisor)
+        resp = await self.client.get("/api/series/2018/1/projects")
+        self.assertEqual(resp.status, 200)
+        db.get_projects_by_group.assert_called_once_with(rotation)
+        items = (await resp.json(content_type=None))["items"]
+        self.assertEqual([item["data"]["id"] for item in items], [1, 2])
+        self.assertEqual(items[0]["data"]["supervisor_feedback_id"], 3)
+        self.assertNotIn("supervisor_feedback_id", items[1]["data"])
+        self.assertEqual(items[0]["people"], {"supervisor": {"id": 1, "name": "Supervisor"},
+                                              "cogs_marker": None,
+                                              "student": {"id": 2, "name": "Student"}})
+
+        # Students can't see projects before the rotation is visible
+        auth.get_user_from_request.return_value = future(student)
+        resp = await self.client.get("/api/series/2018/1/projects")
+        self.assertEqual(resp.status, 200)
+        self.assertEqual((await resp.json(content_type=None))["items"], [])
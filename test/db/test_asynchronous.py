@@ -0,0 +1,58 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from cogs.db.asynchronous import AsyncDatabase
+from cogs.db.interface import Database
+from cogs.db.session import context_scoped_session
+
+from test.async_helper import async_test, AsyncTestCase
+
+
+class TestAsyncDatabase(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.database = MagicMock(spec=Database)
+        self.database.session = context_scoped_session(MagicMock(side_effect=lambda: MagicMock()))
+        self.db = AsyncDatabase(self.database, max_workers=2)
+
+    @async_test
+    async def test_delegates(self):
+        self.database.get_project_by_id.return_value = "project"
+        self.assertEqual(await self.db.get_project_by_id(123), "project")
+        self.database.get_project_by_id.assert_called_once_with(123)
+
+    @async_test
+    async def test_runs_off_loop_in_callers_session(self):
+        session = self.db.session()
+
+        def query():
+            return threading.current_thread(), self.database.session()
+
+        thread, thread_session = await self.db.run(query)
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertIs(thread_session, session)
+
+
+if __name__ == "__main__":
+    unittest.main()
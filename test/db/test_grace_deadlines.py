@@ -0,0 +1,76 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import json
+import unittest
+from datetime import date, datetime, timedelta
+
+from cogs.db.models import Project, ProjectGroup
+from cogs.routes.api._format import _encode_json, encode_json, pretty_json
+
+from test.db_helper import SQLiteDatabase
+
+
+class TestGraceDeadlines(unittest.TestCase):
+    def test_pass_grace_deadlines(self):
+        db = SQLiteDatabase({})
+        now = datetime(2019, 6, 1, 23, 59)
+        with db.session_scope() as session:
+            group = ProjectGroup(series=2019, part=1, student_complete=date(2019, 5, 29))
+            projects = [Project(group=group, uploaded=True, grace_passed=False, grace_deadline=now),
+                        Project(group=group, uploaded=True, grace_passed=False, grace_deadline=now + timedelta(days=1)),
+                        Project(group=group, uploaded=True, grace_passed=True, grace_deadline=now - timedelta(days=1)),
+                        Project(group=group, uploaded=False, grace_passed=False)]
+            session.add_all(projects)
+            session.flush()
+            ids = [project.id for project in projects]
+
+        with db.session_scope():
+            passed = db.pass_grace_deadlines(now)
+            self.assertEqual([project.id for project in passed], ids[:1])
+            self.assertTrue(passed[0].grace_passed)
+            self.assertEqual(passed[0].version, 2)
+            self.assertEqual(passed[0].group.student_complete, date(2019, 5, 29))
+
+        with db.session_scope():
+            self.assertEqual(db.pass_grace_deadlines(now), [])
+            self.assertEqual([db.get_project_by_id(project_id).grace_passed for project_id in ids],
+                             [True, False, True, False])
+
+    def test_serialise(self):
+        # Uploaded projects can be encoded by any of the JSON encoders
+        project = Project(uploaded=True, grace_passed=False, grace_deadline=datetime(2019, 6, 1, 23, 59))
+        serialised = project.serialise(include_mark_ids=False)
+        self.assertEqual(serialised["grace_deadline"], "2019-06-01T23:59:00")
+        self.assertEqual(json.loads(_encode_json(serialised))["grace_deadline"], "2019-06-01T23:59:00")
+
+        token = pretty_json.set(True)
+        try:
+            self.assertEqual(json.loads(encode_json(serialised))["grace_deadline"], "2019-06-01T23:59:00")
+        finally:
+            pretty_json.reset(token)
+
+        self.assertIsNone(Project().serialise(include_mark_ids=False)["grace_deadline"])
+
+
+
+if __name__ == "__main__":
+    unittest.main()
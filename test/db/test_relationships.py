@@ -21,6 +21,7 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 import unittest
 
 from cogs.db.models import Project, User
+from cogs.security import roles
 
 
 class TestRelationships(unittest.TestCase):
@@ -33,3 +34,25 @@ class TestRelationships(unittest.TestCase):
         self.assertEqual(user.projects_as_student, [project1])
         project2.student = user
         self.assertEqual(user.projects_as_student, [project1, project2])
+
+    def test_user_roles_follow_user_type(self):
+        user = User(user_type="student|supervisor")
+        self.assertEqual(sorted(r.role for r in user.user_roles), ["student", "supervisor"])
+        supervisor_role = next(r for r in user.user_roles if r.role == "supervisor")
+        user.user_type = "supervisor|cogs_member"
+        self.assertEqual(sorted(r.role for r in user.user_roles), ["cogs_member", "supervisor"])
+        # Roles which are kept aren't recreated.
+        self.assertIn(supervisor_role, user.user_roles)
+        user.user_type = ""
+        self.assertEqual(user.user_roles, [])
+
+    def test_user_role_follows_user_type(self):
+        user = User(user_type="student|supervisor")
+        other = User(user_type="student|supervisor")
+        self.assertEqual(user.role, roles.student | roles.supervisor)
+        # Users of the same type share the same role
+        self.assertIs(user.role, other.role)
+        user.user_type = "grad_office"
+        self.assertEqual(user.role, roles.grad_office)
+        user.user_type = ""
+        self.assertEqual(user.role, roles.zero)
@@ -0,0 +1,91 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import unittest
+from unittest.mock import MagicMock
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+
+import cogs.db
+from cogs.db.session import context_scoped_session
+
+from test.async_helper import async_test, AsyncTestCase
+
+
+class TestContextScopedSession(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = MagicMock(side_effect=lambda: MagicMock())
+        self.Session = context_scoped_session(self.factory)
+
+    @async_test
+    async def test_sessions_are_per_task(self):
+        async def get_session():
+            # Yield to the event loop, so the tasks interleave.
+            first = self.Session()
+            await asyncio.sleep(0)
+            self.assertIs(self.Session(), first)
+            return first
+
+        sessions = await asyncio.gather(*(get_session() for _ in range(5)))
+        self.assertEqual(len({id(session) for session in sessions}), 5)
+
+    @async_test
+    async def test_remove(self):
+        async def use_and_remove():
+            session = self.Session()
+            self.Session.remove()
+            session.close.assert_called_once()
+            self.assertFalse(self.Session.registry.has())
+
+        await asyncio.get_event_loop().create_task(use_and_remove())
+
+
+class TestSessionMiddleware(AioHTTPTestCase):
+    async def get_application(self):
+        self.sessions = []
+        factory = MagicMock(side_effect=lambda: MagicMock())
+
+        async def handler(request):
+            self.sessions.append(request.app["db"].session())
+            return web.Response(status=204)
+
+        app = web.Application(middlewares=[cogs.db.middleware])
+        app["db"] = db = MagicMock()
+        db.session = context_scoped_session(factory)
+        app.router.add_get("/", handler)
+        return app
+
+    @unittest_run_loop
+    async def test_session_per_request(self):
+        for _ in range(3):
+            resp = await self.client.get("/")
+            self.assertEqual(resp.status, 204)
+
+        # Each request had its own session, which was closed afterwards.
+        self.assertEqual(len({id(session) for session in self.sessions}), 3)
+        for session in self.sessions:
+            session.close.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+from cogs.db.interface import Database
+
+
+class SQLiteDatabase(Database):
+    """Database interface backed by a private, in-memory database.
+
+    This lets tests run real queries without a PostgreSQL server; the
+    one connection is shared between threads, so it's only suitable for
+    tests which don't make queries concurrently.
+    """
+
+    def _connect(self, config):
+        engine = create_engine("sqlite://",
+                               poolclass=StaticPool,
+                               connect_args={"check_same_thread": False})
+
+        # pysqlite doesn't begin transactions before SAVEPOINTs, so they
+        # end up committing everything; transactions are begun here
+        # instead, as the SQLAlchemy documentation suggests, so that
+        # savepoints behave as they do in PostgreSQL
+        @event.listens_for(engine, "connect")
+        def _connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def _begin(connection):
+            # Directly, so it isn't counted as a query
+            connection.connection.execute("BEGIN")
+
+        return engine
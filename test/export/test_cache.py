@@ -0,0 +1,139 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import asyncio
+import os
+import unittest
+from datetime import date
+from tempfile import TemporaryDirectory
+
+from sqlalchemy import event
+
+from cogs.db.asynchronous import AsyncDatabase
+from cogs.db.models import Project, ProjectGroup, User
+from cogs.export import ExportCache
+
+from test.db_helper import SQLiteDatabase
+
+
+class TestExportCache(unittest.TestCase):
+    def setUp(self):
+        self.database = SQLiteDatabase({})
+
+        deadlines = {deadline: date(2018, 1, 1) for deadline in (
+            "supervisor_submit", "student_invite", "student_choice",
+            "student_complete", "marking_complete")}
+
+        with self.database.session_scope() as session:
+            student = User(name="Student", user_type="student")
+            supervisor = User(name="Supervisor", user_type="supervisor")
+            for series in (2018, 2019):
+                group = ProjectGroup(series=series, part=1, **deadlines)
+                session.add(Project(title="Project", group=group,
+                                    student=student, supervisor=supervisor))
+
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+        self.cache = self.create_cache(grace=0)
+
+        self.statements = []
+        event.listen(self.database.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: self.statements.append(statement))
+
+    def create_cache(self, grace: float) -> ExportCache:
+        return ExportCache(AsyncDatabase(self.database, max_workers=1), self.directory.name,
+                           "https://example.com/projects/{}/download", max_entries=1, grace=grace)
+
+    def get(self, series: int) -> str:
+        async def get():
+            with self.database.session_scope():
+                return await self.cache.get(series)
+        return self.loop.run_until_complete(get())
+
+    def rename_project(self, title: str) -> None:
+        with self.database.session_scope() as session:
+            session.query(Project).join(ProjectGroup).filter(ProjectGroup.series == 2018).one().title = title
+
+    def test_get(self):
+        filename = self.get(2018)
+        with open(filename, "rb") as workbook:
+            self.assertTrue(workbook.read().startswith(b"PK"))
+
+        # Cache hits only look up the version
+        self.statements.clear()
+        self.assertEqual(self.get(2018), filename)
+        self.assertEqual(len(self.statements), 1)
+
+        # Changes to the series invalidate the cached workbook, which is
+        # evicted as only one is kept
+        self.rename_project("Renamed project")
+        renamed = self.get(2018)
+        self.assertNotEqual(renamed, filename)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(os.listdir(self.directory.name), [os.path.basename(renamed)])
+
+    def test_evicted_while_in_use(self):
+        self.cache = self.create_cache(grace=60)
+
+        # A workbook that's just been looked up isn't evicted when
+        # another series is rendered, as it may be about to be opened
+        filename = self.get(2018)
+        other = self.get(2019)
+        with open(filename, "rb") as workbook:
+            self.assertTrue(workbook.read().startswith(b"PK"))
+        self.assertCountEqual(os.listdir(self.directory.name),
+                              [os.path.basename(filename), os.path.basename(other)])
+
+        # ...but it is once it's been unused for the grace period
+        os.utime(filename, (0, 0))
+        self.rename_project("Renamed project")
+        renamed = self.get(2018)
+        self.assertFalse(os.path.exists(filename))
+        self.assertCountEqual(os.listdir(self.directory.name),
+                              [os.path.basename(renamed), os.path.basename(other)])
+
+    def test_refresh(self):
+        filename = self.get(2018)
+        self.loop.run_until_complete(self.cache.refresh())
+        self.assertEqual(os.listdir(self.directory.name), [os.path.basename(filename)])
+
+        # Changed series are only re-rendered once they've settled
+        self.rename_project("Renamed project")
+        self.loop.run_until_complete(self.cache.refresh())
+        self.assertEqual(os.listdir(self.directory.name), [os.path.basename(filename)])
+        self.rename_project("Renamed again")
+        self.loop.run_until_complete(self.cache.refresh())
+        self.assertEqual(os.listdir(self.directory.name), [os.path.basename(filename)])
+        self.loop.run_until_complete(self.cache.refresh())
+
+        self.statements.clear()
+        refreshed = self.get(2018)
+        self.assertNotEqual(refreshed, filename)
+        self.assertEqual(os.listdir(self.directory.name), [os.path.basename(refreshed)])
+        self.assertEqual(len(self.statements), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
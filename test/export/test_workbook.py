@@ -0,0 +1,86 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import unittest
+from datetime import date
+from io import BytesIO
+from zipfile import ZipFile
+
+from sqlalchemy import event
+
+from cogs.db.models import Project, ProjectGrade, ProjectGroup, User
+from cogs.export import write_group_export
+
+from test.db_helper import SQLiteDatabase
+
+
+class TestGroupExport(unittest.TestCase):
+    def setUp(self):
+        self.database = SQLiteDatabase({})
+
+        deadlines = {deadline: date(2018, 1, 1) for deadline in (
+            "supervisor_submit", "student_invite", "student_choice",
+            "student_complete", "marking_complete")}
+
+        with self.database.session_scope() as session:
+            students = [User(name=f"Student {n}", user_type="student") for n in range(10)]
+            for part in (1, 2, 3):
+                group = ProjectGroup(series=2018, part=part, **deadlines)
+                for n, student in enumerate(students[:-1]):
+                    session.add(Project(
+                        title=f"Project {part}.{n}", group=group, student=student,
+                        supervisor=User(name=f"Supervisor {part}.{n}", user_type="supervisor"),
+                        cogs_marker=User(name=f"Marker {part}.{n}", user_type="cogs_member"),
+                        supervisor_feedback=ProjectGrade(grade_id=0, good_feedback="<p>Good</p>")))
+
+            # Projects in other series aren't exported
+            group = ProjectGroup(series=2017, part=1, **deadlines)
+            session.add(Project(title="Old project", group=group, student=students[-1],
+                                supervisor=User(name="Old supervisor")))
+
+    def test_export(self):
+        statements = []
+        event.listen(self.database.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+
+        output = BytesIO()
+        with self.database.session_scope():
+            write_group_export(self.database, 2018, "https://example.com/projects/{}/download", output)
+
+        # Everything is fetched up front, regardless of the number of
+        # students and rotations
+        self.assertEqual(len(statements), 2)
+
+        with ZipFile(output) as workbook:
+            sheets = [name for name in workbook.namelist() if name.startswith("xl/worksheets/")]
+            self.assertEqual(len(sheets), 4)
+
+            schedule = workbook.read("xl/worksheets/sheet1.xml").decode()
+            feedback = workbook.read("xl/worksheets/sheet2.xml").decode()
+
+        self.assertIn("Student 0", schedule)
+        self.assertIn("Supervisor 3.8", schedule)
+        self.assertNotIn("Student 9", schedule)
+        self.assertNotIn("Old project", schedule)
+        self.assertIn("https://example.com/projects/1/download", feedback)
+
+
+if __name__ == "__main__":
+    unittest.main()
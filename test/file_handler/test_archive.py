@@ -0,0 +1,64 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import io
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from zipfile import ZIP_STORED, ZipFile
+
+from cogs.file_handler import write_archive
+
+
+class _Unseekable(io.RawIOBase):
+    def __init__(self):
+        super().__init__()
+        self.written = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+
+class TestArchive(unittest.TestCase):
+    def test_write_archive(self):
+        with TemporaryDirectory() as directory:
+            contents = {"a.zip": os.urandom(200 * 1024), "b.zip": b""}
+            for name, data in contents.items():
+                with open(os.path.join(directory, name), "wb") as output:
+                    output.write(data)
+
+            output = _Unseekable()
+            write_archive([(name, os.path.join(directory, name)) for name in ("a.zip", "missing.zip", "b.zip")],
+                          output)
+
+        with ZipFile(io.BytesIO(output.written)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ["a.zip", "b.zip"])
+            self.assertTrue(all(info.compress_type == ZIP_STORED for info in archive.infolist()))
+            self.assertEqual({name: archive.read(name) for name in contents}, contents)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import hashlib
+import os
+import unittest
+import zlib
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
+
+from cogs.db.models import Project, ProjectGroup, User
+from cogs.file_handler import FileHandler
+from cogs.file_handler.interface import manifest_filename
+
+
+class TestFileHandler(unittest.TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_handler = FileHandler(directory.name, 1024)
+        self.project = Project(id=1, group=ProjectGroup(series=2018, part=1), student=User(id=2))
+        self.filename = self.file_handler.get_filename_for_project(self.project)
+
+    def upload(self, data: bytes, commit: bool) -> None:
+        upload = self.file_handler.upload_project(self.project)
+        upload.write(data)
+        if commit:
+            upload.commit()
+        else:
+            upload.abort()
+
+    def read(self) -> bytes:
+        with self.file_handler.get_project(self.project, "rb") as report:
+            return report.read()
+
+    def test_upload(self):
+        self.upload(b"first", commit=True)
+        self.assertEqual(self.read(), b"first")
+        self.upload(b"second", commit=True)
+        self.assertEqual(self.read(), b"second")
+
+    def test_abort(self):
+        self.upload(b"aborted", commit=False)
+        self.assertFalse(os.path.exists(self.filename))
+
+        self.upload(b"first", commit=True)
+        self.upload(b"aborted", commit=False)
+        self.assertEqual(self.read(), b"first")
+
+        # Nothing is left behind
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.filename))),
+                         [os.path.basename(self.filename), os.path.basename(manifest_filename(self.filename))])
+
+    def test_manifest(self):
+        self.assertIsNone(self.file_handler.get_manifest(self.project))
+
+        archive = BytesIO()
+        with ZipFile(archive, "w") as report:
+            report.writestr("report.txt", "Report")
+            report.writestr("data.csv", "1,2,3\n")
+        self.upload(archive.getvalue(), commit=True)
+
+        manifest = self.file_handler.get_manifest(self.project)
+        self.assertEqual(manifest["files"], [
+            {"name": "report.txt", "size": 6, "crc": zlib.crc32(b"Report")},
+            {"name": "data.csv", "size": 6, "crc": zlib.crc32(b"1,2,3\n")}])
+        self.assertEqual(manifest["uncompressed_size"], 12)
+        self.assertEqual(manifest["sha256"], hashlib.sha256(archive.getvalue()).hexdigest())
+        self.assertTrue(os.path.exists(manifest_filename(self.filename)))
+
+        # Reports changed behind our back have their manifest rebuilt
+        with open(self.filename, "wb") as report:
+            report.write(b"Not an archive")
+        manifest = self.file_handler.get_manifest(self.project)
+        self.assertEqual(manifest["files"], [])
+        self.assertEqual(manifest["sha256"], hashlib.sha256(b"Not an archive").hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
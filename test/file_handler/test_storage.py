@@ -0,0 +1,118 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import hashlib
+import os
+import tempfile
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from cogs.file_handler import ContentAddressedStorage, LocalStorage, SharedStorage, Storage
+
+
+def store(storage: Storage, key: str, data: bytes) -> str:
+    fd, temporary = tempfile.mkstemp(dir=storage.staging_directory(key))
+    with os.fdopen(fd, "wb") as output:
+        output.write(data)
+    return storage.store(key, temporary, hashlib.sha256(data).hexdigest())
+
+
+def read(filename: str) -> bytes:
+    with open(filename, "rb") as stored:
+        return stored.read()
+
+
+def files(directory: str):
+    return sorted(os.path.relpath(os.path.join(path, name), directory)
+                  for path, _, names in os.walk(directory)
+                  for name in names)
+
+
+# Collect garbage regardless of its age
+@patch("cogs.file_handler.storage._GARBAGE_GRACE_TIME", -1)
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_local(self):
+        storage = LocalStorage(self.directory)
+        filename = store(storage, "1/report.zip", b"first")
+        self.assertEqual(filename, storage.path("1/report.zip"))
+        self.assertEqual(read(filename), b"first")
+
+        store(storage, "1/report.zip", b"second")
+        self.assertEqual(read(filename), b"second")
+        self.assertEqual(files(self.directory), ["1/report.zip"])
+
+    def test_content_addressed(self):
+        storage = ContentAddressedStorage(self.directory)
+        first = store(storage, "1/report.zip", b"report")
+        second = store(storage, "2/report.zip", b"report")
+        self.assertEqual(read(first), b"report")
+        self.assertTrue(os.path.samefile(first, second))
+
+        # Re-uploads of the same content change nothing
+        stat = os.stat(first)
+        store(storage, "1/report.zip", b"report")
+        self.assertEqual(os.stat(first), stat)
+
+        self.assertEqual(storage.collect_garbage(), 0)
+
+        store(storage, "1/report.zip", b"new report")
+        store(storage, "2/report.zip", b"new report")
+        self.assertEqual(read(second), b"new report")
+        self.assertEqual(len(files(os.path.join(self.directory, ".blobs"))), 2)
+
+        # The old content is no longer referenced
+        self.assertEqual(storage.collect_garbage(), 1)
+        self.assertEqual(files(os.path.join(self.directory, ".blobs")),
+                         [os.path.join(hashlib.sha256(b"new report").hexdigest()[:2],
+                                       hashlib.sha256(b"new report").hexdigest())])
+        self.assertEqual(read(second), b"new report")
+
+    def test_shared(self):
+        shared = os.path.join(self.directory, "shared")
+        replicas = [SharedStorage(shared, os.path.join(self.directory, f"cache{n}")) for n in range(2)]
+
+        self.assertFalse(os.path.exists(replicas[0].path("1/report.zip")))
+
+        filename = store(replicas[0], "1/report.zip", b"report")
+        self.assertEqual(os.path.basename(filename), "report.zip")
+        self.assertEqual(read(replicas[1].path("1/report.zip")), b"report")
+
+        store(replicas[1], "2/report.zip", b"report")
+        self.assertEqual(len(files(os.path.join(shared, "objects"))), 1)
+
+        store(replicas[1], "1/report.zip", b"new report")
+        store(replicas[1], "2/report.zip", b"new report")
+        self.assertEqual(read(replicas[0].path("1/report.zip")), b"new report")
+
+        # The old content, and the cached copy of it, are removed
+        self.assertEqual(replicas[0].collect_garbage(), 2)
+        self.assertEqual(len(files(os.path.join(shared, "objects"))), 1)
+        self.assertEqual(read(replicas[0].path("2/report.zip")), b"new report")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import asyncore
+import smtpd
+import threading
+from typing import Dict, List
+
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """Local SMTP server, for testing mail delivery.
+
+    This runs in its own thread, and records the messages it receives
+    and the number of connections made to it. It's used as a context
+    manager, which starts and stops it:
+
+    >>> with StandInSMTPServer() as server:
+    ...     send_mail("localhost", server.port)
+    ...     server.messages
+    """
+
+    connections: int
+    messages: List[Dict]
+
+    def __init__(self) -> None:
+        self._map: Dict = {}
+        super().__init__(("127.0.0.1", 0), None, map=self._map, decode_data=False)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self._running = False
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super().handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages.append({"from": mailfrom, "to": rcpttos, "data": data})
+
+    def disconnect_all(self) -> None:
+        """Drop all the connections to the server."""
+        for channel in list(self._map.values()):
+            if channel is not self:
+                channel.close()
+
+    def _serve(self) -> None:
+        while self._running:
+            asyncore.loop(timeout=0.01, map=self._map, count=1)
+
+    def __enter__(self) -> "StandInSMTPServer":
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._running = False
+        self._thread.join()
+        self.disconnect_all()
+        self.close()
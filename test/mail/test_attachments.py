@@ -0,0 +1,91 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from cogs.mail.attachments import Attachment, AttachmentProvider
+from cogs.mail.message import TemplatedEMail
+
+
+class TestAttachmentProvider(unittest.TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def file(self, name: str, size: int) -> str:
+        filename = os.path.join(self.directory, name)
+        with open(filename, "wb") as f:
+            f.write(os.urandom(size))
+        return filename
+
+    def render(self, provider: AttachmentProvider, *attachments: Attachment):
+        mail = TemplatedEMail.prerendered("Subject", "<p>Body</p>")
+        mail.sender = "sender@example.com"
+        mail.recipient = "user@example.com"
+        for attachment in attachments:
+            mail.add_attachment(attachment)
+        return mail.render(provider)
+
+    def test_cached(self):
+        provider = AttachmentProvider(cache_size=2000, max_cached_size=1000)
+        form = Attachment(self.file("form.docx", 500))
+        report = Attachment(self.file("report.zip", 2000))
+
+        part = provider.part(form)
+        self.assertIs(provider.part(form), part)
+        self.assertEqual(part.get_filename(), "form.docx")
+        # Too large to cache
+        self.assertIsNot(provider.part(report), provider.part(report))
+
+        # Replaced files aren't sent from the cache
+        os.utime(form.filename, ns=(0, 0))
+        self.assertIsNot(provider.part(form), part)
+
+        # Least recently used files are evicted
+        others = [Attachment(self.file(f"other{n}.docx", 500)) for n in range(3)]
+        first = provider.part(others[0])
+        for other in others[1:]:
+            provider.part(other)
+        self.assertIsNot(provider.part(others[0]), first)
+
+        message = self.render(provider, form, report)
+        self.assertEqual([part.get_filename() for part in message.iter_attachments()],
+                         ["form.docx", "report.zip"])
+        self.assertEqual(message.get_payload()[1].get_content(), open(form.filename, "rb").read())
+
+    def test_linked(self):
+        provider = AttachmentProvider(link_threshold=1000)
+        form = Attachment(self.file("form.docx", 500), link="https://example.com/form")
+        report = Attachment(self.file("report.zip", 2000), link="https://example.com/projects/1/download")
+        unlinkable = Attachment(self.file("poster.zip", 2000))
+
+        message = self.render(provider, form, report, unlinkable)
+        self.assertEqual([part.get_filename() for part in message.iter_attachments()],
+                         ["form.docx", "poster.zip"])
+        html = message.get_body(("html",)).get_content()
+        self.assertIn('<a href="https://example.com/projects/1/download">report.zip</a>', html)
+        self.assertNotIn("form.docx", html)
+
+
+if __name__ == "__main__":
+    unittest.main()
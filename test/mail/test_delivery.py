@@ -0,0 +1,96 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import time
+import unittest
+
+from jinja2 import Template
+
+from cogs.mail.delivery import DeliveryEngine
+from cogs.mail.message import TemplatedEMail
+
+from test.mail.smtp_helper import StandInSMTPServer
+
+
+def _mail(recipient: str) -> TemplatedEMail:
+    mail = TemplatedEMail(Template("Subject"), Template("Hello, {{ name }}"))
+    mail.sender = "sender@example.com"
+    mail.recipient = recipient
+    mail.set_context("name", recipient)
+    return mail
+
+
+class TestDeliveryEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInSMTPServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def engine(self, **kwargs) -> DeliveryEngine:
+        engine = DeliveryEngine("127.0.0.1", self.server.port, 5, **kwargs)
+        self.addCleanup(engine.close)
+        return engine
+
+    def test_connections_reused(self):
+        engine = self.engine(connections=2)
+        for n in range(20):
+            engine.submit(_mail(f"user{n}@example.com"))
+        engine.join()
+
+        self.assertEqual(sorted(message["to"][0] for message in self.server.messages),
+                         sorted(f"user{n}@example.com" for n in range(20)))
+        self.assertIn(b"Hello, user0@example.com", next(
+            message["data"] for message in self.server.messages if message["to"] == ["user0@example.com"]))
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_reconnect(self):
+        engine = self.engine(connections=1)
+        engine.submit(_mail("first@example.com"))
+        engine.join()
+
+        self.server.disconnect_all()
+        engine.submit(_mail("second@example.com"))
+        engine.join()
+
+        self.assertEqual([message["to"] for message in self.server.messages],
+                         [["first@example.com"], ["second@example.com"]])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_rate_limit(self):
+        engine = self.engine(connections=1, rate=50)
+        start = time.monotonic()
+        for n in range(6):
+            engine.submit(_mail(f"user{n}@example.com"))
+        engine.join()
+
+        # The first message is free, then they're 20ms apart
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(len(self.server.messages), 6)
+
+    def test_close(self):
+        engine = self.engine(connections=1)
+        engine.submit(_mail("user@example.com"))
+        engine.close()
+        self.assertEqual(len(self.server.messages), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
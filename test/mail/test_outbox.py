@@ -0,0 +1,166 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import socket
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from jinja2 import Template
+
+from cogs.db.models import OutboxMessage, ProjectGroup
+from cogs.mail.delivery import DeliveryEngine
+from cogs.mail.message import TemplatedEMail
+from cogs.mail.outbox import Outbox
+
+from test.db_helper import SQLiteDatabase
+from test.mail.smtp_helper import StandInSMTPServer
+
+
+def _mail(recipient: str) -> TemplatedEMail:
+    mail = TemplatedEMail(Template("Subject"), Template("Hello, {{ name }}"))
+    mail.sender = "sender@example.com"
+    mail.recipient = recipient
+    mail.set_context("name", recipient)
+    mail.render_templates()
+    return mail
+
+
+def _unused_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInSMTPServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.db = SQLiteDatabase({})
+
+    def outbox(self, port: int = None, **kwargs) -> Outbox:
+        engine = DeliveryEngine("127.0.0.1", port or self.server.port, 5, connections=1)
+        self.addCleanup(engine.close)
+        return Outbox(self.db, engine, "example.com", **kwargs)
+
+    def messages(self):
+        with self.db.session_scope() as session:
+            return [(message.recipient, message.status, message.attempts)
+                    for message in session.query(OutboxMessage).order_by(OutboxMessage.id)]
+
+    def test_sent_on_commit(self):
+        outbox = self.outbox()
+        with self.db.session_scope():
+            outbox.enqueue(_mail("committed@example.com"))
+        try:
+            with self.db.session_scope():
+                outbox.enqueue(_mail("rolled-back@example.com"))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([message["to"] for message in self.server.messages], [["committed@example.com"]])
+        self.assertIn(b"Hello, committed@example.com", self.server.messages[0]["data"])
+        self.assertEqual(self.messages(), [("committed@example.com", "sent", 1)])
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_idempotency_key(self):
+        outbox = self.outbox()
+        with self.db.session_scope():
+            self.assertTrue(outbox.enqueue(_mail("user@example.com"), "key"))
+            self.assertFalse(outbox.enqueue(_mail("user@example.com"), "key"))
+        outbox.drain()
+        with self.db.session_scope():
+            self.assertFalse(outbox.enqueue(_mail("user@example.com"), "key"))
+
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertIn(b"Message-ID: <key@example.com>", self.server.messages[0]["data"])
+
+    def test_retry(self):
+        outbox = self.outbox(port=_unused_port(), max_attempts=2, retry_delay=3600)
+        with self.db.session_scope():
+            outbox.enqueue(_mail("user@example.com"))
+
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(self.messages(), [("user@example.com", "pending", 1)])
+        # Backing off
+        self.assertEqual(outbox.drain(), 0)
+        depth = outbox.depth()
+        self.assertEqual((depth["pending"], depth["due"]), (1, 0))
+
+        with self.db.session_scope() as session:
+            message = session.query(OutboxMessage).one()
+            self.assertGreater(message.next_attempt, datetime.now())
+            message.next_attempt = datetime.now()
+
+        # Dead-lettered after its last attempt
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(self.messages(), [("user@example.com", "dead", 2)])
+        depth = outbox.depth()
+        self.assertEqual((depth["pending"], depth["dead"], depth["oldest_pending"]), (0, 1, None))
+
+    def test_claimed_before_sending(self):
+        outbox = self.outbox()
+        with self.db.session_scope():
+            outbox.enqueue(_mail("user@example.com"))
+
+        # E-mails are sent outside of the transaction that claimed them
+        submit = outbox._delivery.submit
+        def check_claimed(mail):
+            self.assertEqual(self.messages(), [("user@example.com", "sending", 0)])
+            return submit(mail)
+
+        with patch.object(outbox._delivery, "submit", side_effect=check_claimed):
+            self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(self.messages(), [("user@example.com", "sent", 1)])
+
+        # Claims that were never resolved expire
+        with self.db.session_scope() as session:
+            message = session.query(OutboxMessage).one()
+            message.status = "sending"
+            message.next_attempt = datetime.now()
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_enqueued_concurrently(self):
+        outbox = self.outbox()
+        with self.db.session_scope():
+            outbox.enqueue(_mail("user@example.com"), "key")
+
+        # As if the other e-mail was committed after the outbox was
+        # checked: only the duplicate is undone, not the whole transaction
+        get_outbox_keys = self.db.get_outbox_keys
+        with self.db.session_scope() as session, \
+             patch.object(self.db, "get_outbox_keys", side_effect=[set(), get_outbox_keys({"key"})]):
+            session.add(ProjectGroup(series=2100, part=1))
+            self.assertEqual(outbox.enqueue_all([(_mail("user@example.com"), "key"),
+                                                 (_mail("other@example.com"), "other")]), [False, True])
+
+        with self.db.session_scope() as session:
+            self.assertEqual(session.query(ProjectGroup).filter_by(series=2100).count(), 1)
+        self.assertEqual([recipient for recipient, _, _ in self.messages()],
+                         ["user@example.com", "other@example.com"])
+
+
+if __name__ == "__main__":
+    unittest.main()
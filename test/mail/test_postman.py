@@ -0,0 +1,124 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import unittest
+from datetime import date
+from tempfile import TemporaryDirectory
+from typing import List
+from unittest.mock import patch
+
+from cogs.db.models import OutboxMessage, ProjectGroup, User
+from cogs.mail import Postman
+
+from test.db_helper import SQLiteDatabase
+
+
+class TestPostman(unittest.TestCase):
+    def setUp(self):
+        self.db = SQLiteDatabase({})
+        with self.db.session_scope():
+            template = self.db.get_template_by_name("student_invite")
+            template.subject = "Invitation for {{ user.name }}"
+
+    def postman(self, **template_cache) -> Postman:
+        return Postman(self.db, "127.0.0.1", 25, 5, "sender@example.com", "bcc@example.com",
+                       "https://example.com", template_cache=template_cache)
+
+    def send(self, postman: Postman, *names: str) -> List[str]:
+        """Send the student_invite e-mail, returning the subjects sent."""
+        with self.db.session_scope() as session:
+            for name in names:
+                postman.send(User(name=name, email=f"{name}@example.com"), "student_invite",
+                         rotation=ProjectGroup(series=2018, part=1, student_choice=date(2018, 1, 1)))
+            session.flush()
+            return [message.subject for message in session.query(OutboxMessage).order_by(OutboxMessage.id.desc())
+                                                                               .limit(len(names))][::-1]
+
+    def edit(self, subject: str) -> None:
+        with self.db.session_scope():
+            self.db.get_template_by_name("student_invite").subject = subject
+
+    def test_compiled_once(self):
+        postman = self.postman()
+        with patch.object(self.db, "get_template_by_name", wraps=self.db.get_template_by_name) as lookup, \
+             patch.object(postman.environment, "from_string", wraps=postman.environment.from_string) as compile:
+            self.assertEqual(self.send(postman, "alice", "bob", "carol"),
+                             ["Invitation for alice", "Invitation for bob", "Invitation for carol"])
+            self.assertEqual(lookup.call_count, 1)
+            self.assertEqual(compile.call_count, 2)
+
+    def test_invalidated(self):
+        postman = self.postman()
+        self.send(postman, "alice")
+
+        # Edits only show up once the template's been invalidated...
+        self.edit("Welcome, {{ user.name }}")
+        self.assertEqual(self.send(postman, "bob"), ["Invitation for bob"])
+        postman.invalidate("student_invite")
+        self.assertEqual(self.send(postman, "carol"), ["Welcome, carol"])
+
+        # ...or revalidated
+        postman = self.postman(revalidate_after=0)
+        self.send(postman, "alice")
+        self.edit("Hello, {{ user.name }}")
+        self.assertEqual(self.send(postman, "bob"), ["Hello, bob"])
+
+    def test_bytecode_cache(self):
+        with TemporaryDirectory() as directory:
+            self.assertEqual(self.send(self.postman(bytecode_directory=directory), "alice"),
+                             ["Invitation for alice"])
+            cached = os.listdir(directory)
+            self.assertTrue(cached)
+
+            # A new postman (e.g., after a restart) uses the cached bytecode
+            postman = self.postman(bytecode_directory=directory)
+            with patch.object(postman.environment, "compile") as compile:
+                self.assertEqual(self.send(postman, "bob"), ["Invitation for bob"])
+                compile.assert_not_called()
+            self.assertEqual(os.listdir(directory), cached)
+
+    def test_send_bulk(self):
+        postman = self.postman()
+        users = [User(id=n, name=f"user{n}", email=f"user{n}@example.com") for n in range(3)]
+        users.append(User(id=3, name="nobody"))
+        rotation = ProjectGroup(series=2018, part=1, student_choice=date(2018, 1, 1))
+
+        with self.db.session_scope() as session, \
+             patch.object(self.db, "get_template_by_name", wraps=self.db.get_template_by_name) as lookup:
+            statuses = postman.send_bulk(users[:2], "student_invite", rotation=rotation, idempotency_key="invite")
+            self.assertEqual(statuses, [(users[0], "queued"), (users[1], "queued")])
+
+            # Per-user context, with CCs, and some duplicates
+            statuses = postman.send_bulk([[user, users[2]] for user in users], "student_invite",
+                                         per_user_context=lambda user: {"user": User(name=user.name.upper())},
+                                         rotation=rotation, idempotency_key="invite")
+            self.assertEqual([status for _, status in statuses], ["duplicate", "duplicate", "queued", "no address"])
+            self.assertEqual(lookup.call_count, 1)
+
+            messages = session.query(OutboxMessage).order_by(OutboxMessage.id).all()
+            self.assertEqual([(message.subject, message.cc) for message in messages],
+                             [("Invitation for user0", None), ("Invitation for user1", None),
+                              ("Invitation for USER2", "user2@example.com")])
+            self.assertEqual(messages[2].idempotency_key, "invite-2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import asyncio
+import threading
+import time
+import unittest
+
+from cogs.db.models import OutboxMessage, ProjectGroup
+from cogs.scheduler.executor import JobExecutor, JobTimeout
+
+from test.async_helper import async_test, AsyncTestCase
+from test.db_helper import SQLiteDatabase
+
+
+class TestJobExecutor(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = SQLiteDatabase({})
+
+    def groups(self):
+        with self.db.session_scope() as session:
+            return sorted(group.series for group in session.query(ProjectGroup))
+
+    @async_test
+    async def test_run(self):
+        executor = JobExecutor(self.db)
+        loop = self.loop
+
+        async def job(series: int):
+            self.assertIsNot(threading.current_thread(), threading.main_thread())
+            self.db.add(ProjectGroup(series=series, part=1))
+            self.db.add(OutboxMessage(idempotency_key="key", sender="sender@example.com",
+                                      recipient="user@example.com", subject="Subject", body="Body"))
+
+        run = await executor.run("job", job, 2100)
+        self.assertEqual((run.outcome, run.rows, run.mails), ("succeeded", 2, 1))
+        self.assertIn(2100, self.groups())
+
+        # Failed runs are rolled back
+        async def failing_job():
+            self.db.add(ProjectGroup(series=2101, part=1))
+            raise RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            await executor.run("failing_job", failing_job)
+        self.assertNotIn(2101, self.groups())
+        self.assertEqual([run.outcome for run in executor.history], ["succeeded", "failed"])
+        self.assertIs(asyncio.get_event_loop(), loop)
+
+    @async_test
+    async def test_concurrency(self):
+        executor = JobExecutor(self.db, concurrency={"limited": 1, "default": 2})
+        running = {"limited": 0, "unlimited": 0}
+        peak = dict(running)
+
+        async def job(name: str):
+            running[name] += 1
+            peak[name] = max(peak[name], running[name])
+            time.sleep(0.1)
+            running[name] -= 1
+
+        await asyncio.gather(*(executor.run(name, job, name) for name in ("limited", "unlimited") * 2))
+        self.assertEqual(peak, {"limited": 1, "unlimited": 2})
+
+    @async_test
+    async def test_timeout(self):
+        executor = JobExecutor(self.db, timeouts={"slow": 0.1})
+        finished = threading.Event()
+
+        async def job():
+            self.db.add(ProjectGroup(series=2102, part=1))
+            time.sleep(0.3)
+            finished.set()
+
+        with self.assertRaises(JobTimeout):
+            await executor.run("slow", job)
+        await self.loop.run_in_executor(None, finished.wait)
+        await asyncio.sleep(0.1)
+        self.assertEqual(executor.history[0].outcome, "timed out")
+        self.assertNotIn(2102, self.groups())
+
+
+if __name__ == "__main__":
+    unittest.main()
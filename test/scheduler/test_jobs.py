@@ -20,15 +20,17 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import unittest
-from unittest.mock import MagicMock, patch, call, ANY
+from unittest.mock import MagicMock, patch, ANY
 
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
 from test.async_helper import async_test, AsyncTestCase
 
 from cogs.db.models import User, ProjectGroup, Project
+from cogs.mail import Attachment
 
-from cogs.scheduler.jobs import supervisor_submit, student_invite, student_choice, grace_deadline, reminder, mark_project
+from cogs.scheduler.jobs import supervisor_submit, student_invite, student_choice, grace_deadlines, reminder, mark_project, \
+                                marking_digest
 import cogs.scheduler.jobs as jobs
 from cogs.scheduler.constants import DEADLINES, GROUP_DEADLINES
 
@@ -41,16 +43,14 @@ class TestScheduler(AsyncTestCase):
         empty_group = ProjectGroup()
         scheduler._db.get_rotation_by_id.return_value = empty_group
         for no_users in range(10):
-            scheduler._mail.send.reset_mock()
+            scheduler._mail.send_bulk.reset_mock()
             scheduler._db.get_users_by_permission.return_value = [empty_user] * no_users
             await supervisor_submit(scheduler, rotation_id=None)
-            calls = scheduler._mail.send.call_count
-            self.assertEqual(calls, no_users)
-            if no_users != 0:
-                scheduler._mail.send.assert_called_with(empty_user,
-                                                        "supervisor_submit_grad_office",
-                                                        group=empty_group,
-                                                        no_students=no_users)
+            scheduler._mail.send_bulk.assert_called_once_with([empty_user] * no_users,
+                                                              "supervisor_submit_grad_office",
+                                                              group=empty_group,
+                                                              no_students=no_users,
+                                                              idempotency_key=ANY)
 
     @async_test
     async def test_student_invite(self):
@@ -59,15 +59,13 @@ class TestScheduler(AsyncTestCase):
         empty_group = ProjectGroup(part="<Hello>")
         scheduler._db.get_rotation_by_id.return_value = empty_group
         for no_users in range(10):
-            scheduler._mail.send.reset_mock()
+            scheduler._mail.send_bulk.reset_mock()
             scheduler._db.get_users_by_permission.return_value = [empty_user] * no_users
             await student_invite(scheduler, rotation_id=None)
-            calls = scheduler._mail.send.call_count
-            self.assertEqual(calls, no_users)
-            if no_users != 0:
-                scheduler._mail.send.assert_called_with(empty_user,
-                                                        f"student_invite",
-                                                        rotation=empty_group)
+            scheduler._mail.send_bulk.assert_called_once_with([empty_user] * no_users,
+                                                              "student_invite",
+                                                              rotation=empty_group,
+                                                              idempotency_key=ANY)
         self.assertTrue(empty_group.student_viewable)
         self.assertTrue(empty_group.student_choosable)
         self.assertFalse(empty_group.read_only)
@@ -79,15 +77,13 @@ class TestScheduler(AsyncTestCase):
         empty_group = ProjectGroup()
         scheduler._db.get_rotation_by_id.return_value = empty_group
         for no_users in range(10):
-            scheduler._mail.send.reset_mock()
+            scheduler._mail.send_bulk.reset_mock()
             scheduler._db.get_users_by_permission.return_value = [empty_user] * no_users
             await student_choice(scheduler, rotation_id=None)
-            calls = scheduler._mail.send.call_count
-            self.assertEqual(calls, no_users)
-            if no_users != 0:
-                scheduler._mail.send.assert_called_with(empty_user,
-                                                        "can_set_projects",
-                                                        group=empty_group)
+            scheduler._mail.send_bulk.assert_called_once_with([empty_user] * no_users,
+                                                              "can_set_projects",
+                                                              group=empty_group,
+                                                              idempotency_key=ANY)
         self.assertFalse(empty_group.student_choosable)
         self.assertFalse(empty_group.student_uploadable)
         self.assertTrue(empty_group.can_finalise)
@@ -97,36 +93,41 @@ class TestScheduler(AsyncTestCase):
         for deadline in DEADLINES:
             self.assertTrue(hasattr(jobs, deadline))
 
-    @patch("cogs.scheduler.jobs.timedelta", spec=True)
     @async_test
-    async def test_grace_deadline(self, mock_timedelta):
-        mock_timedelta().__gt__.return_value = False
+    async def test_grace_deadlines(self):
         scheduler = MagicMock()
         supervisor = User(name="Bob")
         cogs_marker = User(name="Sue")
         scheduler._file_handler.get_filename_for_project.return_value = "project-files.zip"
         for s, c in ((None, None), (supervisor, None), (None, cogs_marker), (supervisor, cogs_marker)):
-            scheduler._mail.send.reset_mock()
-            empty_project = Project(group=MagicMock(),
+            scheduler.reset_mock()
+            group = ProjectGroup(id=1, student_complete=date(2018, 1, 1), marking_complete=date(2018, 1, 8))
+            empty_project = Project(group=group,
                                     supervisor=s,
                                     cogs_marker=c)
-            scheduler._db.get_project_by_id.return_value = empty_project
-            await grace_deadline(scheduler, project_id=0)
-
-            self.assertTrue(empty_project.grace_passed)
-
-            calls = [call(user,
-                          "student_uploaded",
-                          "project-files.zip",
-                          project=empty_project) for user in (s, c) if user]
-            scheduler._mail.send.assert_has_calls(calls)
-
-            calls = [call(ANY,
-                          "mark_project",
-                          f"user={user.id}_project={empty_project.id}",
-                          user_id=user.id,
-                          project_id=empty_project.id) for user in (s, c) if user]
-            scheduler.schedule_user_deadline.assert_has_calls(calls)
+            scheduler._db.pass_grace_deadlines.return_value = [empty_project]
+            await grace_deadlines(scheduler)
+
+            markers = [user for user in (s, c) if user]
+            if markers:
+                scheduler._mail.send_bulk.assert_called_once_with(
+                    markers,
+                    "student_uploaded",
+                    Attachment("project-files.zip", link=f"/projects/{empty_project.id}/download"),
+                    project=empty_project,
+                    idempotency_key=ANY)
+            else:
+                scheduler._mail.send_bulk.assert_not_called()
+            scheduler._mail.send.assert_not_called()
+
+            scheduler.schedule_marking_digest.assert_called_once_with(date.today() + timedelta(days=7), group.id)
+
+        # Nothing happens if no grace deadlines have passed
+        scheduler.reset_mock()
+        scheduler._db.pass_grace_deadlines.return_value = []
+        await grace_deadlines(scheduler)
+        scheduler._mail.send_bulk.assert_not_called()
+        scheduler.schedule_marking_digest.assert_not_called()
 
     @async_test
     async def test_reminder(self):
@@ -142,44 +143,68 @@ class TestScheduler(AsyncTestCase):
                 scheduler._db.get_rotation_by_id.return_value = empty_group
                 await reminder(scheduler, deadline=deadline_id, rotation_id=None)
 
-                scheduler._mail.send.assert_called_with(
-                    user,
+                scheduler._mail.send_bulk.assert_called_with(
+                    [user],
                     deadline.pester_template.format(group=empty_group),
                     deadline_name=deadline_id,
                     delta_time=0,
                     pester_content=deadline.pester_content,
                     rotation=empty_group,
+                    idempotency_key=ANY,
                 )
 
     @patch("cogs.scheduler.jobs.date", spec=True)
     @async_test
     async def test_mark_project(self, mock_date):
-        mock_date.today().__gt__.return_value = False
         scheduler = MagicMock()
-
-        user = User()
-        scheduler._db.get_user_by_id.return_value = user
-        scheduler._file_handler.get_filename_for_project.return_value = "attachment_name.zip"
-
         project = MagicMock()
-        project.can_solicit_feedback.return_value = True
         scheduler._db.get_project_by_id.return_value = project
 
         await mark_project(scheduler, user_id=None, project_id=None)
 
-        scheduler._mail.send.assert_called_with(user,
-                                                "student_uploaded",
-                                                "attachment_name.zip",
-                                                project=project,
-                                                late_time=0)
+        scheduler._mail.send.assert_not_called()
+        scheduler.schedule_marking_digest.assert_called_with(mock_date.today(), project.group.id, late_time=0)
 
-        scheduler.schedule_user_deadline.assert_called_with(ANY,
-                                                       "mark_project",
-                                                       f"user={user.id}_project={project.id}",
-                                                       user_id=user.id,
-                                                       project_id=project.id,
-                                                       late_time=1)
+        await mark_project(scheduler, user_id=None, project_id=None, late_time=2)
+        scheduler.schedule_marking_digest.assert_called_with(mock_date.today(), project.group.id, late_time=2)
 
+    @patch("cogs.scheduler.jobs.date", spec=True)
+    @async_test
+    async def test_marking_digest(self, mock_date):
+        mock_date.today().__gt__.return_value = False
+        scheduler = MagicMock()
+        group = MagicMock()
+        scheduler._db.get_rotation_by_id.return_value = group
+
+        bob, sue = User(name="Bob"), User(name="Sue")
+        marked = Project(supervisor=bob, cogs_marker=sue, grace_passed=True)
+        unsubmitted = Project(supervisor=bob, cogs_marker=sue, grace_passed=False)
+        unmarked = [Project(supervisor=bob, cogs_marker=sue, grace_passed=True) for _ in range(2)]
+        scheduler._db.get_projects_by_group.return_value = [marked, unsubmitted, *unmarked]
+
+        def can_solicit_feedback(project, user):
+            return project is not marked and (project, user) != (unmarked[1], sue)
+
+        with patch.object(Project, "can_solicit_feedback", can_solicit_feedback):
+            await marking_digest(scheduler, rotation_id=1)
+
+        scheduler._mail.send_bulk.assert_called_once_with([bob, sue], "marking_digest",
+                                                          per_user_context=ANY,
+                                                          rotation=group,
+                                                          late_time=0,
+                                                          idempotency_key=ANY)
+        per_user_context = scheduler._mail.send_bulk.call_args[1]["per_user_context"]
+        self.assertEqual(per_user_context(bob), {"projects": unmarked})
+        self.assertEqual(per_user_context(sue), {"projects": unmarked[:1]})
+        scheduler.schedule_marking_digest.assert_called_once_with(group.marking_complete, 1, late_time=1)
+
+        # Nothing is sent, or rescheduled, once everything is marked
+        scheduler.reset_mock()
+        scheduler._db.get_projects_by_group.return_value = [marked, unsubmitted]
+        with patch.object(Project, "can_solicit_feedback", can_solicit_feedback):
+            await marking_digest(scheduler, rotation_id=1)
+        scheduler._mail.send_bulk.assert_not_called()
+        scheduler.schedule_marking_digest.assert_not_called()
 
 if __name__ == "__main__":
     unittest.main()
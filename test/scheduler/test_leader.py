@@ -0,0 +1,71 @@
+"""
+Copyright (c) 2019 Genome Research Ltd.
+
+Authors:
+* Josh Holland <jh36@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at
+your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import asyncio
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+from cogs.scheduler.leader import LeaderElection
+
+from test.async_helper import async_test, AsyncTestCase
+from test.db_helper import SQLiteDatabase
+
+
+class TestLeaderElection(AsyncTestCase):
+    def election(self, engine) -> LeaderElection:
+        self.events = MagicMock()
+        return LeaderElection(engine, interval=0,
+                              on_elected=self.events.elected,
+                              on_deposed=self.events.deposed,
+                              on_renewed=self.events.renewed)
+
+    @async_test
+    async def test_unsupported(self):
+        # Without advisory locks, the only process is the leader
+        election = self.election(SQLiteDatabase({}).engine)
+        await election.start(None)
+        self.assertTrue(election.leader)
+        await election.stop(None)
+        self.assertFalse(election.leader)
+        self.assertEqual(self.events.mock_calls, [call.elected(), call.deposed()])
+
+    @async_test
+    async def test_campaign(self):
+        engine = MagicMock()
+        engine.dialect.name = "postgresql"
+        election = self.election(engine)
+
+        done = asyncio.Event()
+        with patch.object(election, "_try_acquire", side_effect=[False, True, False]), \
+             patch.object(election, "_renew", side_effect=[True, False]), \
+             patch.object(election, "_release") as release:
+            self.events.deposed.side_effect = lambda: done.set()
+            await election.start(None)
+            await asyncio.wait_for(done.wait(), 1)
+            await election.stop(None)
+
+        self.assertEqual(self.events.mock_calls, [call.elected(), call.renewed(), call.deposed()])
+        self.assertFalse(election.leader)
+        release.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -89,6 +89,24 @@ class TestModel(unittest.TestCase):
             view_projects_predeadline=False,
             view_all_submitted_projects=False)
 
+    def test_immutable(self):
+        role = self.role(a=True, b=False)
+        with self.assertRaises(AttributeError):
+            role.a = False
+        with self.assertRaises(AttributeError):
+            role._mask = 0
+
+    def test_hash(self):
+        self.assertEqual(hash(self.role(a=True, b=False)), hash(self.role(a=True, b=False)))
+        self.assertEqual(len({self.role(a=True, b=False), self.role(a=True, b=False),
+                              self.role(a=False, b=True)}), 2)
+
+    def test_mask(self):
+        role = self.role(a=True, b=False)
+        self.assertEqual(self.role.mask_of("a"), role.mask)
+        self.assertEqual(self.role.mask_of("a", "b"), (role | self.role(a=False, b=True)).mask)
+        self.assertEqual(role.serialise(), {"a": True, "b": False})
+
 
 if __name__ == "__main__":
     unittest.main()